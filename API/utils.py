@@ -1,4 +1,5 @@
 import pandas as pd
+import numpy as np
 import re
 import os
 import base64
@@ -27,6 +28,28 @@ from transformers import GPT2TokenizerFast
 import tiktoken
 from datetime import datetime
 import difflib
+import itertools
+import bisect
+import sys
+import hashlib
+import io
+import zipfile
+import tarfile
+import multiprocessing
+import mmap
+import sqlite3
+import threading
+import weakref
+from collections import OrderedDict
+from contextlib import contextmanager
+from collections.abc import MutableMapping
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from array import array
+try:
+    from re import _parser as sre_parse
+except ImportError:  # Python < 3.11
+    import sre_parse
 
 def parse_field(field_str):
     """
@@ -47,169 +70,518 @@ def parse_field(field_str):
             return field_name, size, lsb, msb
     return None, None, None, None
 
-def excel_to_uvm_ral(excel_file, output_file):
+RAL_COLUMN_MAP = {
+    'Register Name': 'register_name',
+    'Offset': 'offset',
+    'Read/Write': 'read_write',
+    'Fields': 'fields',
+    'Default value': 'default_value',
+    'Reset value': 'reset_value',
+    'Description': 'description'
+}
+RAL_FIELD_PATTERN = r"^([A-Za-z_][A-Za-z0-9_]*)(?:\s*\[(\d+):(\d+)\])?"
+
+
+def _register_frame(df):
+    """
+    Sheet read with header=None -> frame with the RAL columns renamed.
+    Raises ValueError if some of the template columns are missing.
+    """
+    df.columns = df.iloc[0].str.strip()
+    df = df[1:]
+
+    # Check if the necessary columns are present
+    missing_columns = [col for col in RAL_COLUMN_MAP if col not in df.columns]
+    if missing_columns:
+        raise ValueError(f"Missing required columns: {', '.join(missing_columns)}")
+    df = df.rename(columns=RAL_COLUMN_MAP)
+    df['register_name'] = df['register_name'].fillna("").astype(str)
+    df['fields'] = df['fields'].fillna("").astype(str)
+    return df
+
+
+def build_register_model(df, name: Optional[str] = None) -> Dict[str, Any]:
+    """
+    Register block (registers and their fields) from a normalized register frame, computed column-wise:
+    register rows are the ones with a name, following rows belong to it (forward fill),
+    and all field strings are parsed in one vectorized extract (same rules as parse_field).
+    """
+    n = len(df)
+    starts = np.flatnonzero(df['register_name'].str.strip().to_numpy() != "")
+    row_reg = np.searchsorted(starts, np.arange(n), side="right") - 1
+
+    fields = df['fields'].str.strip()
+    parsed = fields.str.extract(RAL_FIELD_PATTERN)
+    msb = pd.to_numeric(parsed[1]).fillna(0).astype("int64").to_numpy()
+    lsb = pd.to_numeric(parsed[2]).fillna(0).astype("int64").to_numpy()
+    # parse_field only trusts the range when both ends are non-zero
+    size = np.where((msb != 0) & (lsb != 0), msb - lsb + 1, 1)
+    valid = (df['fields'].to_numpy() != "") & parsed[0].notna().to_numpy() & (row_reg >= 0) & (size != 0)
+
+    names = df['register_name'].to_numpy()
+    access = df['read_write'].to_numpy()
+    defaults = df['default_value'].to_numpy()
+    offsets = df['offset'].to_numpy()
+    registers = []
+    for i, row in enumerate(starts):
+        # access / reset come from the row that closes the register: the next register's
+        # first row, or the sheet's last row for the final register
+        src = starts[i + 1] if i + 1 < len(starts) else n - 1
+        registers.append({"name": names[row].strip(), "offset": offsets[row], "access": access[src],
+                          "reset": defaults[src] if pd.notna(defaults[src]) else 0, "fields": []})
+    field_names = parsed[0].to_numpy()
+    for r, field, sz, lo, hi in zip(row_reg[valid], field_names[valid], size[valid], lsb[valid], msb[valid]):
+        registers[r]["fields"].append((field, int(sz), int(lo), int(hi)))
+    return _register_block(name, registers)
+
+
+def _ral_field_configure(reg: Dict[str, Any], field: Tuple) -> str:
+    # (name, size, lsb, msb) inherits the register's access/reset; readers that know
+    # per-field values append them as (name, size, lsb, msb, access, reset)
+    name, size, lsb, msb = field[:4]
+    access, reset = field[4:6] if len(field) > 4 else (reg['access'], reg['reset'])
+    return (
+        f"    {name} = uvm_reg_field::type_id::create(\"{name}\");\n"
+        f"    {name}.configure(.parent(this),\n"
+        f"                           .size({size}),\n"
+        f"                           .lsb_pos({lsb}),\n"
+        f"                           .msb_pos({msb}),\n"
+        f"                           .access(\"{access}\"),\n"
+        f"                           .volatile(0),\n"
+        f"                           .reset({reset}),\n"
+        f"                           .has_reset(1),\n"
+        f"                           .is_rand(1),\n"
+        f"                           .individually_accessible(0));\n"
+    )
+
+
+def _render_register(reg: Dict[str, Any], last: bool = False) -> str:
+    """One uvm_reg class as a single string."""
+    name = reg["name"]
+    out = [
+        f"class {name} extends uvm_reg;\n",
+        f"  `uvm_object_utils({name})\n\n",
+        "  //---------------------------------------\n",
+        "  // Constructor\n",
+        "  //---------------------------------------\n",
+        f"  function new(string name = \"{name}\");\n",
+        "    super.new(name, 32, UVM_NO_COVERAGE);\n",
+        "  endfunction\n\n",
+        "  //---------------------------------------\n",
+    ]
+    if last:
+        # the final register keeps its historical layout: declarations inline with the build code
+        for field in reg["fields"]:
+            out.append(f"    rand uvm_reg_field {field[0]};\n")
+            out.append(_ral_field_configure(reg, field))
+    else:
+        out.extend(f"    rand uvm_reg_field {field[0]};\n" for field in reg["fields"])
+        out.append("  //---------------------------------------\n")
+        out.append("  function void build;\n")
+        out.extend(_ral_field_configure(reg, field) for field in reg["fields"])
+    out.append("  endfunction\n")
+    out.append("endclass\n\n")
+    return "".join(out)
+
+
+# block class name when the map has a single block, and the composing block for multi-block maps
+RAL_BLOCK_NAME = "dma_reg_model"
+RAL_TOP_BLOCK_NAME = "top_reg_model"
+# blocks without an explicit base address are packed at this alignment (or their span, if larger)
+RAL_BLOCK_ALIGN = 0x1000
+
+
+def _ral_ident(name: str) -> str:
+    ident = re.sub(r"\W+", "_", str(name)).strip("_").lower()
+    return ident if ident and not ident[0].isdigit() else f"blk_{ident}"
+
+
+def _block_span(block: Dict[str, Any]) -> int:
+    return max((reg["offset"] for reg in block["registers"]), default=0) + 4
+
+
+def _block_bases(blocks: List[Dict[str, Any]]) -> List[int]:
+    """Explicit base addresses are kept; the others are packed after the highest block seen so far."""
+    bases = []
+    cursor = 0
+    for block in blocks:
+        span = _block_span(block)
+        base = block.get("base")
+        if not isinstance(base, int):
+            align = max(RAL_BLOCK_ALIGN, 1 << (span - 1).bit_length())
+            base = -(-cursor // align) * align
+        bases.append(base)
+        cursor = max(cursor, base + span)
+    return bases
+
+
+def _render_block(cls: str, registers: List[Tuple[str, Dict[str, Any]]]) -> str:
+    """uvm_reg_block `cls` holding (class name, register) pairs at their offsets."""
+    out = [
+        "//-------------------------------------------------------------------------\n",
+        "//\tRegister Block Definition\n",
+        "//-------------------------------------------------------------------------\n",
+        f"class {cls} extends uvm_reg_block;\n",
+        f"  `uvm_object_utils({cls})\n\n",
+        "  //---------------------------------------\n",
+        "  // Register Instances\n",
+        "  //---------------------------------------\n",
+    ]
+    out.extend(f"  rand {reg_cls} reg_{reg['name'].lower()};\n" for reg_cls, reg in registers)
+    out.extend([
+        "\n  //---------------------------------------\n",
+        "  // Constructor\n",
+        "  //---------------------------------------\n",
+        "  function new (string name = \"\");\n",
+        "    super.new(name, build_coverage(UVM_NO_COVERAGE));\n",
+        "  endfunction\n\n",
+        "  //---------------------------------------\n",
+        "  // Build Phase\n",
+        "  //---------------------------------------\n",
+        "  function void build();\n",
+    ])
+    for reg_cls, reg in registers:
+        inst = f"reg_{reg['name'].lower()}"
+        out.append(f"    {inst} = {reg_cls}::type_id::create(\"{inst}\");\n")
+        out.append(f"    {inst}.build();\n")
+        out.append(f"    {inst}.configure(this);\n")
+    out.extend([
+        "    //---------------------------------------\n",
+        "    // Memory Map Creation and Register Map\n",
+        "    //---------------------------------------\n",
+        "    default_map = create_map(\"my_map\", 0, 4, UVM_LITTLE_ENDIAN);\n",
+    ])
+    out.extend(f"    default_map.add_reg(reg_{reg['name'].lower()}, 'h{reg['offset']:X}, \"RW\");\n"
+               for _, reg in registers)
+    out.append("    lock_model();\n")
+    out.append("  endfunction\n")
+    out.append("endclass\n\n")
+    return "".join(out)
+
+
+def _render_top_block(blocks: List[Tuple[str, str, int]]) -> str:
+    """Top-level uvm_reg_block composing (instance, block class, base address) sub-blocks."""
+    out = [
+        "//-------------------------------------------------------------------------\n",
+        "//\tTop-Level Register Block\n",
+        "//-------------------------------------------------------------------------\n",
+        f"class {RAL_TOP_BLOCK_NAME} extends uvm_reg_block;\n",
+        f"  `uvm_object_utils({RAL_TOP_BLOCK_NAME})\n\n",
+        "  //---------------------------------------\n",
+        "  // Block Instances\n",
+        "  //---------------------------------------\n",
+    ]
+    out.extend(f"  rand {cls} {inst};\n" for inst, cls, _ in blocks)
+    out.extend([
+        "\n  //---------------------------------------\n",
+        "  // Constructor\n",
+        "  //---------------------------------------\n",
+        "  function new (string name = \"\");\n",
+        "    super.new(name, build_coverage(UVM_NO_COVERAGE));\n",
+        "  endfunction\n\n",
+        "  //---------------------------------------\n",
+        "  // Build Phase\n",
+        "  //---------------------------------------\n",
+        "  function void build();\n",
+        "    default_map = create_map(\"my_map\", 0, 4, UVM_LITTLE_ENDIAN);\n",
+    ])
+    for inst, cls, base in blocks:
+        out.append(f"    {inst} = {cls}::type_id::create(\"{inst}\");\n")
+        out.append(f"    {inst}.configure(this);\n")
+        out.append(f"    {inst}.build();\n")
+        out.append(f"    default_map.add_submap({inst}.default_map, 'h{base:X});\n")
+    out.append("    lock_model();\n")
+    out.append("  endfunction\n")
+    out.append("endclass\n\n")
+    return "".join(out)
+
+
+def render_uvm_ral(model: Dict[str, Any]):
+    """
+    Yield the RAL .sv text in chunks: header, one chunk per register class, one per block.
+    A single-block map renders as RAL_BLOCK_NAME; with several blocks every block gets its own
+    <block>_reg_model class (register classes prefixed with the block name so they cannot clash)
+    and RAL_TOP_BLOCK_NAME maps them at their base addresses.
+    """
+    yield "`ifndef REG_MODEL\n`define REG_MODEL\n\n"
+    blocks = model["blocks"]
+    multi = len(blocks) > 1
+    top = []
+    for block, base in zip(blocks, _block_bases(blocks)):
+        prefix = f"{_ral_ident(block['name'])}_" if multi else ""
+        registers = block["registers"]
+        classes = []
+        for i, reg in enumerate(registers):
+            cls = prefix + reg["name"]
+            yield _render_register(dict(reg, name=cls), last=i == len(registers) - 1)
+            classes.append((cls, reg))
+        block_cls = f"{prefix}reg_model" if multi else RAL_BLOCK_NAME
+        yield _render_block(block_cls, classes)
+        top.append((f"blk_{_ral_ident(block['name'])}", block_cls, base))
+    if multi:
+        yield _render_top_block(top)
+    yield "`endif // REG_MODEL\n"
+
+
+def _ral_int(value, default=0):
+    """'0x1F', "'h1F", '32' -> int; anything unparsable is returned as-is."""
+    if value is None:
+        return default
+    if isinstance(value, float) and value.is_integer():
+        return int(value)
+    text = str(value).strip().replace("_", "")
+    m = re.match(r"^(?:\d*)'([hHdDbBoO])([0-9a-fA-F]+)$", text)
+    if m:
+        return int(m.group(2), {"h": 16, "d": 10, "b": 2, "o": 8}[m.group(1).lower()])
     try:
-        # Read the Excel file
-        df = pd.read_excel(excel_file, header=None)
-
-        # Strip all column names of leading/trailing whitespace
-        df.columns = df.iloc[0].str.strip()
-        df = df[1:]
-
-        # Check if the necessary columns are present
-        required_columns = ['Register Name', 'Offset', 'Read/Write', 'Fields', 'Default value', 'Reset value', 'Description']
-        missing_columns = [col for col in required_columns if col not in df.columns]
-        if missing_columns:
-            print(f"Error: Missing required columns: {', '.join(missing_columns)}")
-            return
+        return int(text, 0)
+    except ValueError:
+        return text if text else default
+
+
+def _register_block(name: Optional[str], registers: List[Dict[str, Any]], base=None) -> Dict[str, Any]:
+    """Block dict with every register offset resolved to an int (missing ones follow the previous register)."""
+    offset = -4
+    for reg in registers:
+        value = _ral_int(reg["offset"], None) if pd.notna(reg["offset"]) else None
+        offset = value if isinstance(value, int) else offset + 4
+        reg["offset"] = offset
+    return {"name": name or "block", "base": _ral_int(base, None), "registers": registers}
+
+
+# below this much workbook data a process pool costs more than it saves
+PARALLEL_RAL_MIN_BYTES = 256 * 1024
+
+
+def _excel_sheet_block(data: bytes, sheet: str) -> Optional[Dict[str, Any]]:
+    """Worker: one sheet of the workbook -> register block, or None if it is not a register sheet."""
+    try:
+        df = _register_frame(pd.read_excel(io.BytesIO(data), sheet_name=sheet, header=None))
+    except ValueError:
+        return None
+    return build_register_model(df, sheet)
+
+
+def _read_excel_registers(source, workers: Optional[int] = None) -> Dict[str, Any]:
+    """
+    One block per register sheet. Each worker loads only its own sheet (openpyxl reads sheets
+    lazily), so a large workbook takes about as long as its largest sheet. Sheets without the
+    template columns (notes, revision history) are skipped.
+    """
+    if hasattr(source, "read"):
+        data = source.read()
+    else:
+        with open(source, "rb") as f:
+            data = f.read()
+    sheets = pd.ExcelFile(io.BytesIO(data)).sheet_names
+    if len(sheets) == 1:
+        return {"blocks": [build_register_model(_register_frame(pd.read_excel(io.BytesIO(data), header=None)), sheets[0])]}
+    workers = workers or os.cpu_count() or 1
+    blocks = None
+    if workers >= 2 and len(data) >= PARALLEL_RAL_MIN_BYTES:
+        blocks = _parallel_map(_excel_sheet_block, [data] * len(sheets), sheets)
+    if blocks is None:
+        blocks = [_excel_sheet_block(data, sheet) for sheet in sheets]
+    blocks = [block for block in blocks if block is not None]
+    if not blocks:
+        raise ValueError(f"Missing required columns: no sheet has {', '.join(RAL_COLUMN_MAP)}")
+    return {"blocks": blocks}
+
+
+def _read_csv_registers(source) -> Dict[str, Any]:
+    """CSV export of the register sheet: same columns as the Excel template."""
+    return {"blocks": [build_register_model(_register_frame(pd.read_csv(source, header=None)))]}
+
+
+def _json_field(entry) -> Tuple[Optional[str], Optional[int], Optional[int], Optional[int]]:
+    if isinstance(entry, str):
+        return parse_field(entry.strip())
+    name = entry.get("name")
+    if "bit_offset" in entry or "bitOffset" in entry:
+        lsb = int(entry.get("bit_offset", entry.get("bitOffset")))
+        width = int(entry.get("bit_width", entry.get("bitWidth", 1)))
+        return name, width, lsb, lsb + width - 1
+    msb = int(entry.get("msb", 0))
+    lsb = int(entry.get("lsb", msb))
+    return name, msb - lsb + 1, lsb, msb
+
+
+def _json_block(registers_data: List[Dict[str, Any]], name: Optional[str] = None, base=None) -> Dict[str, Any]:
+    registers = []
+    for reg in registers_data:
+        fields = []
+        for entry in reg.get("fields", []):
+            field, size, lsb, msb = _json_field(entry)
+            if field and size:
+                fields.append((field, size, lsb, msb))
+        registers.append({"name": str(reg["name"]).strip(), "offset": _ral_int(reg.get("offset")),
+                          "access": reg.get("access", "RW"), "reset": _ral_int(reg.get("reset")), "fields": fields})
+    return _register_block(name, registers, base)
+
+
+def _read_json_registers(source) -> Dict[str, Any]:
+    """
+    JSON register map: a list of registers, {"registers": [...]}, or {"blocks": [{"name", "base", "registers"}]}.
+    Registers are {"name", "offset", "access", "reset", "fields": ["CTRL [3:0]" | {"name", "msb", "lsb"} | {"name", "bit_offset", "bit_width"}]}.
+    """
+    if hasattr(source, "read"):
+        data = json.load(source)
+    else:
+        with open(source) as f:
+            data = json.load(f)
+    if isinstance(data, list):
+        return {"blocks": [_json_block(data)]}
+    if "blocks" in data:
+        return {"blocks": [_json_block(b.get("registers", []), b.get("name"), b.get("base")) for b in data["blocks"]]}
+    return {"blocks": [_json_block(data.get("registers", []), data.get("name"), data.get("base"))]}
 
-        # Map column names to expected names
-        column_map = {
-            'Register Name': 'register_name',
-            'Offset': 'offset',
-            'Read/Write': 'read_write',
-            'Fields': 'fields',
-            'Default value': 'default_value',
-            'Reset value': 'reset_value',
-            'Description': 'description'
-        }
-        df.rename(columns=column_map, inplace=True)
 
-        # Convert all relevant columns to strings and fill NaN with default values
-        df['register_name'] = df['register_name'].fillna("").astype(str)
-        df['fields'] = df['fields'].fillna("").astype(str)
+IPXACT_ACCESS = {
+    "read-write": "RW",
+    "read-only": "RO",
+    "write-only": "WO",
+    "read-writeOnce": "W1",
+    "writeOnce": "WO1",
+}
 
-        # Open the output file for writing
+
+def _local(tag: str) -> str:
+    return tag.rsplit("}", 1)[-1]
+
+
+def _ipxact_child(elem, name: str):
+    for child in elem:
+        if _local(child.tag) == name:
+            return child
+    return None
+
+
+def _ipxact_text(elem, *path: str) -> Optional[str]:
+    for name in path:
+        if elem is None:
+            return None
+        elem = _ipxact_child(elem, name)
+    return elem.text.strip() if elem is not None and elem.text else None
+
+
+def _ipxact_reset(elem) -> Optional[str]:
+    # 1685-2009: <reset><value>; 1685-2014/2022: <resets><reset><value>
+    return _ipxact_text(elem, "reset", "value") or _ipxact_text(elem, "resets", "reset", "value")
+
+
+def _read_ipxact_registers(source) -> Dict[str, Any]:
+    """
+    IP-XACT (SPIRIT 1.x / 1685-2009 / 2014 / 2022) register description, read incrementally:
+    every <register> is converted and then cleared, so memory stays flat for large maps.
+    Each <addressBlock> becomes a block at its baseAddress. Namespaces are ignored, only local
+    tag names are matched.
+    """
+    import xml.etree.ElementTree as ET
+
+    blocks = []
+    registers = []
+    for event, elem in ET.iterparse(source, events=("start", "end")):
+        tag = _local(elem.tag)
+        if event == "start":
+            if tag == "addressBlock":
+                registers = []
+            continue
+        if tag == "addressBlock":
+            blocks.append(_register_block(_ipxact_text(elem, "name"), registers, _ipxact_text(elem, "baseAddress")))
+            registers = []
+            elem.clear()
+            continue
+        if tag != "register":
+            continue
+        access = _ipxact_text(elem, "access")
+        reset = _ipxact_reset(elem)
+        raw_fields = []
+        for child in elem:
+            if _local(child.tag) != "field":
+                continue
+            lsb = int(_ral_int(_ipxact_text(child, "bitOffset")))
+            width = int(_ral_int(_ipxact_text(child, "bitWidth"), 1))
+            field_reset = _ipxact_reset(child)
+            raw_fields.append((_ipxact_text(child, "name"), width, lsb, _ipxact_text(child, "access"),
+                               None if field_reset is None else _ral_int(field_reset)))
+            access = access or raw_fields[-1][3]
+        access = IPXACT_ACCESS.get(access, access or "RW")
+        if reset is not None:
+            reset = _ral_int(reset)
+        else:
+            # no register-level reset: compose it from the field resets
+            reset = 0
+            for _, _, lsb, _, field_reset in raw_fields:
+                if isinstance(field_reset, int):
+                    reset |= field_reset << lsb
+        fields = []
+        for name, width, lsb, field_access, field_reset in raw_fields:
+            if field_reset is None:
+                # inherit the field's slice of the register reset
+                field_reset = (reset >> lsb) & ((1 << width) - 1) if isinstance(reset, int) else reset
+            fields.append((name, width, lsb, lsb + width - 1,
+                           IPXACT_ACCESS.get(field_access, field_access) if field_access else access, field_reset))
+        registers.append({"name": _ipxact_text(elem, "name"), "offset": _ral_int(_ipxact_text(elem, "addressOffset")),
+                          "access": access, "reset": reset, "fields": fields})
+        elem.clear()
+    if registers:
+        # registers outside any addressBlock
+        blocks.append(_register_block(None, registers))
+    return {"blocks": blocks}
+
+
+RAL_READERS = {
+    "xlsx": _read_excel_registers,
+    "xls": _read_excel_registers,
+    "xlsm": _read_excel_registers,
+    "csv": _read_csv_registers,
+    "json": _read_json_registers,
+    "xml": _read_ipxact_registers,
+    "ipxact": _read_ipxact_registers,
+}
+
+
+def load_register_model(source, fmt: Optional[str] = None) -> Dict[str, Any]:
+    """
+    Register model from a path or file object. The reader is picked from `fmt`
+    or the file extension; unknown formats fall back to Excel.
+    """
+    if fmt is None:
+        name = source if isinstance(source, str) else getattr(source, "name", "") or ""
+        fmt = os.path.splitext(name)[1]
+    reader = RAL_READERS.get(fmt.lower().lstrip("."), _read_excel_registers)
+    return reader(source)
+
+
+def generate_uvm_ral(source, fmt: Optional[str] = None):
+    """
+    RAL .sv text for a register map (path or uploaded file object) as a generator of chunks.
+    The map is read eagerly so input errors raise here, before any chunk is produced.
+    """
+    return render_uvm_ral(load_register_model(source, fmt))
+
+
+def iter_base64(chunks):
+    """Base64-encode a stream of str/bytes chunks incrementally (output is identical to one b64encode)."""
+    pending = b""
+    for chunk in chunks:
+        pending += chunk.encode("utf-8") if isinstance(chunk, str) else chunk
+        cut = len(pending) - len(pending) % 3
+        if cut:
+            yield base64.b64encode(pending[:cut]).decode("ascii")
+            pending = pending[cut:]
+    if pending:
+        yield base64.b64encode(pending).decode("ascii")
+
+
+def excel_to_uvm_ral(excel_file, output_file, fmt: Optional[str] = None):
+    try:
+        chunks = generate_uvm_ral(excel_file, fmt)
+
+        # one buffered write per register class
         with open(output_file, 'w') as f:
-            # Write the UVM RAL header
-            f.write("`ifndef REG_MODEL\n")
-            f.write("`define REG_MODEL\n\n")
-
-            current_reg = None
-            fields = []
-
-            for _, row in df.iterrows():
-                reg_name = row['register_name'].strip()
-                reg_offset = row['offset']
-                read_write = row['read_write']
-                fields_str = row['fields']
-                default_value = row['default_value']
-                reset_value = row['reset_value']
-                description = row['description']
-
-                # If we encounter a new register, write out the previous register and its fields
-                if reg_name:  # Register name found
-                    # If we're already processing a register, close it out
-                    if current_reg:
-                        # Write the previous register's field instances (before constructor)
-                        f.write(f"  //---------------------------------------\n")
-                        for field in fields:
-                            field_name, size, lsb, msb = parse_field(field.strip())
-                            if field_name and size and lsb is not None:
-                                f.write(f"    rand uvm_reg_field {field_name};\n")
-                        
-                        # Write the build_phase only once
-                        f.write(f"  //---------------------------------------\n")
-                        f.write("  function void build;\n")
-                        for field in fields:  # Indentation fixed here
-                            field_name, size, lsb, msb = parse_field(field.strip())
-                            if field_name and size and lsb is not None:
-                               f.write(f"    {field_name} = uvm_reg_field::type_id::create(\"{field_name}\");\n")
-                               f.write(f"    {field_name}.configure(.parent(this),\n")
-                               f.write(f"                           .size({size}),\n")
-                               f.write(f"                           .lsb_pos({lsb}),\n")
-                               f.write(f"                           .msb_pos({msb}),\n")
-                               f.write(f"                           .access(\"{read_write}\"),\n")
-                               f.write(f"                           .volatile(0),\n")
-                               f.write(f"                           .reset({default_value if pd.notna(default_value) else 0}),\n")
-                               f.write(f"                           .has_reset(1),\n")
-                               f.write(f"                           .is_rand(1),\n")
-                               f.write(f"                           .individually_accessible(0));\n")
-                        f.write("  endfunction\n")
-                        f.write("endclass\n\n")
-
-                    # Now process the new register
-                    f.write(f"class {reg_name} extends uvm_reg;\n")
-                    f.write(f"  `uvm_object_utils({reg_name})\n\n")
-                    f.write("  //---------------------------------------\n")
-
-                    # Initialize new fields list
-                    fields = []
-                    current_reg = reg_name
-
-                    # Write register constructor (only once)
-                    f.write(f"  // Constructor\n")
-                    f.write(f"  //---------------------------------------\n")
-                    f.write(f"  function new(string name = \"{reg_name}\");\n")
-                    f.write(f"    super.new(name, 32, UVM_NO_COVERAGE);\n")
-                    f.write(f"  endfunction\n\n")
-                # Add fields to the list
-                if fields_str:  # Process each field for the current register
-                    fields.append(fields_str.strip())
-
-            # After the last register, write it out
-            if current_reg:
-                # Write the last register's field instances and configuration
-                f.write(f"  //---------------------------------------\n")
-                for field in fields:
-                    field_name, size, lsb, msb = parse_field(field.strip())
-                    if field_name and size and lsb is not None:
-                        f.write(f"    rand uvm_reg_field {field_name};\n")
-                        f.write(f"    {field_name} = uvm_reg_field::type_id::create(\"{field_name}\");\n")
-                        f.write(f"    {field_name}.configure(.parent(this),\n")
-                        f.write(f"                           .size({size}),\n")
-                        f.write(f"                           .lsb_pos({lsb}),\n")
-                        f.write(f"                           .msb_pos({msb}),\n")
-                        f.write(f"                           .access(\"{read_write}\"),\n")
-                        f.write(f"                           .volatile(0),\n")
-                        f.write(f"                           .reset({default_value if pd.notna(default_value) else 0}),\n")
-                        f.write(f"                           .has_reset(1),\n")
-                        f.write(f"                           .is_rand(1),\n")
-                        f.write(f"                           .individually_accessible(0));\n")
-                f.write("  endfunction\n")
-                f.write("endclass\n\n")
-
-            # Generate the register block class
-            f.write("//-------------------------------------------------------------------------\n")
-            f.write("//\tRegister Block Definition\n")
-            f.write("//-------------------------------------------------------------------------\n")
-            f.write("class dma_reg_model extends uvm_reg_block;\n")
-            f.write("  `uvm_object_utils(dma_reg_model)\n\n")
-            f.write("  //---------------------------------------\n")
-            f.write("  // Register Instances\n")
-            f.write("  //---------------------------------------\n")
-
-            for reg_name in df['register_name'].dropna().unique():
-                f.write(f"  rand {reg_name} reg_{reg_name.lower()};\n")
-
-            f.write("\n  //---------------------------------------\n")
-            f.write("  // Constructor\n")
-            f.write("  //---------------------------------------\n")
-            f.write("  function new (string name = \"\");\n")
-            f.write("    super.new(name, build_coverage(UVM_NO_COVERAGE));\n")
-            f.write("  endfunction\n\n")
-            f.write("  //---------------------------------------\n")
-            f.write("  // Build Phase\n")
-            f.write("  //---------------------------------------\n")
-            f.write("  function void build();\n")
-
-            for reg_name in df['register_name'].dropna().unique():
-                f.write(f"    reg_{reg_name.lower()} = {reg_name}::type_id::create(\"reg_{reg_name.lower()}\");\n")
-                f.write(f"    reg_{reg_name.lower()}.build();\n")
-                f.write(f"    reg_{reg_name.lower()}.configure(this);\n")
-
-            f.write("    //---------------------------------------\n")
-            f.write("    // Memory Map Creation and Register Map\n")
-            f.write("    //---------------------------------------\n")
-            f.write("    default_map = create_map(\"my_map\", 0, 4, UVM_LITTLE_ENDIAN);\n")
-            for reg_name in df['register_name'].dropna().unique():
-                f.write(f"    default_map.add_reg(reg_{reg_name.lower()}, 'h0, \"RW\");\n")
-
-            f.write("    lock_model();\n")
-            f.write("  endfunction\n")
-            f.write("endclass\n\n")
-
-            f.write("`endif // REG_MODEL\n")
+            for chunk in chunks:
+                f.write(chunk)
 
         print(f"UVM RAL file generated: {output_file}")
 
@@ -217,6 +589,130 @@ def excel_to_uvm_ral(excel_file, output_file):
         print(f"Error: {e}")
 
 
+
+# On-disk cache of generated RAL models (env or Django setting)
+RAL_CACHE_DIR = (os.getenv("RAL_CACHE_DIR") or getattr(settings, "RAL_CACHE_DIR", None)
+                 or os.path.join(tempfile.gettempdir(), "uvm_ral_cache"))
+RAL_CACHE_MAX_BYTES = int(os.getenv("RAL_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+# bump whenever the generated text changes so stale entries stop matching
+RAL_GENERATOR_VERSION = 2
+
+
+class RalOutputCache:
+    """
+    Bounded on-disk cache of generated RAL output, content addressed by sha1(upload bytes + options).
+    Entries are plain files (<key>.sv, <key>.b64); LRU order is the file mtime, refreshed on every hit,
+    and the oldest files are evicted once the directory goes over max_bytes.
+    Files are written to a temp name and renamed into place, so concurrent workers never read partial output.
+    """
+
+    def __init__(self, root: str = RAL_CACHE_DIR, max_bytes: int = RAL_CACHE_MAX_BYTES):
+        self.root = root
+        self.max_bytes = max_bytes
+        os.makedirs(root, exist_ok=True)
+
+    @staticmethod
+    def key(data: bytes, **options) -> str:
+        h = hashlib.sha1(data)
+        h.update(json.dumps(dict(options, version=RAL_GENERATOR_VERSION), sort_keys=True).encode())
+        return h.hexdigest()
+
+    def _path(self, key: str, kind: str) -> str:
+        return os.path.join(self.root, f"{key}.{kind}")
+
+    def get(self, key: str, kind: str = "sv") -> Optional[bytes]:
+        path = self._path(key, kind)
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+            os.utime(path)
+        except OSError:
+            return None
+        return data
+
+    def store(self, key: str, chunks, kind: str = "sv"):
+        """Pass the byte chunks through, writing them to the cache; the entry only appears if the stream completes."""
+        path = self._path(key, kind)
+        tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        done = False
+        try:
+            with open(tmp, "wb") as f:
+                for chunk in chunks:
+                    f.write(chunk)
+                    yield chunk
+            os.replace(tmp, path)
+            done = True
+            self._evict()
+        finally:
+            if not done and os.path.exists(tmp):
+                os.remove(tmp)
+
+    def _evict(self) -> None:
+        entries = []
+        for entry in os.scandir(self.root):
+            if entry.is_file() and not entry.name.endswith(".tmp"):
+                st = entry.stat()
+                entries.append((st.st_mtime, st.st_size, entry.path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total -= size
+
+
+_RAL_CACHE = None
+
+
+def _ral_cache() -> RalOutputCache:
+    global _RAL_CACHE
+    if _RAL_CACHE is None:
+        _RAL_CACHE = RalOutputCache()
+    return _RAL_CACHE
+
+
+def _ral_upload(upload, fmt: Optional[str]) -> Tuple[bytes, str, str]:
+    data = upload.read()
+    fmt = (fmt or os.path.splitext(getattr(upload, "name", "") or "")[1]).lower().lstrip(".")
+    return data, fmt, _ral_cache().key(data, fmt=fmt)
+
+
+def cached_uvm_ral(upload, fmt: Optional[str] = None) -> Tuple[Any, bool]:
+    """
+    (byte chunks of the .sv, cache hit) for an uploaded register map.
+    On a miss the map is parsed eagerly (input errors raise here) and the chunks are
+    written to the cache as they are consumed.
+    """
+    data, fmt, key = _ral_upload(upload, fmt)
+    cache = _ral_cache()
+    cached = cache.get(key)
+    if cached is not None:
+        return iter([cached]), True
+    chunks = generate_uvm_ral(io.BytesIO(data), fmt)
+    return cache.store(key, (chunk.encode("utf-8") for chunk in chunks)), False
+
+
+def cached_uvm_ral_base64(upload, fmt: Optional[str] = None) -> Tuple[str, bool]:
+    """(base64 of the .sv, cache hit) for an uploaded register map; reuses a cached .sv when only that exists."""
+    data, fmt, key = _ral_upload(upload, fmt)
+    cache = _ral_cache()
+    cached = cache.get(key, "b64")
+    if cached is not None:
+        return cached.decode("ascii"), True
+    sv = cache.get(key)
+    if sv is not None:
+        chunks = iter([sv])
+    else:
+        chunks = cache.store(key, (chunk.encode("utf-8") for chunk in generate_uvm_ral(io.BytesIO(data), fmt)))
+    encoded = b"".join(cache.store(key, (c.encode("ascii") for c in iter_base64(chunks)), "b64"))
+    return encoded.decode("ascii"), sv is not None
+
+# Parse/RAL pool workers (see _parallel_pool) import this module for its parsers only
+_POOL_WORKER = multiprocessing.parent_process() is not None
+
 # Hide llama.cpp logs
 logging.getLogger("llama_cpp").setLevel(logging.CRITICAL)
 
@@ -227,7 +723,7 @@ db = client["Verif_Playground"]
 scripts_collection = db.get_collection("scripts")
 
 # ✅ Offline Embedding Model
-model = OfflineSentenceTransformerEmbeddings()
+model = None if _POOL_WORKER else OfflineSentenceTransformerEmbeddings()
 
 # Text extractors
 def extract_text_from_html(html):
@@ -362,14 +858,16 @@ def initialize_llm():
         return None
 
 # Load on module import
-try:
-    retriever = initialize_mongodb_vector_db()
-    llm = initialize_llm()
-    print("✅ Chatbot models loaded successfully!")
-except Exception as e:
-    print(f"❌ Error initializing chatbot components: {str(e)}")
-    retriever = None
-    llm = None
+retriever = llm = None
+if not _POOL_WORKER:
+    try:
+        retriever = initialize_mongodb_vector_db()
+        llm = initialize_llm()
+        print("✅ Chatbot models loaded successfully!")
+    except Exception as e:
+        print(f"❌ Error initializing chatbot components: {str(e)}")
+        retriever = None
+        llm = None
 
 
 # Chat function
@@ -693,22 +1191,2353 @@ def generate_waveform_from_excel(file_obj):
         return {"error": f"Unexpected error: {str(e)}"}
 
 
-# In-memory store for uploaded files and derived state
-_STORE: Dict[str, Dict[str, Any]] = {}
+# -----------------------------
+# Single-pass Verilog/SystemVerilog lexer
+# -----------------------------
+VERILOG_KEYWORDS = frozenset("""
+always always_comb always_ff always_latch and assert assign assume automatic begin bit buf bufif0 bufif1 byte
+case casex casez class cmos const cover deassign default defparam disable do edge else end endcase endclass
+endfunction endgenerate endinterface endmodule endpackage endprimitive endprogram endspecify endtable endtask enum
+event export extends final for force forever fork function generate genvar highz0 highz1 if ifnone import initial
+inout input int integer interface join join_any join_none localparam logic longint macromodule modport module
+nand negedge nmos nor not notif0 notif1 or output package packed parameter pmos posedge primitive program
+pull0 pull1 pulldown pullup rcmos real realtime reg release repeat return rnmos rpmos rtran rtranif0 rtranif1
+scalared shortint signed small specify specparam static string strong0 strong1 struct supply0 supply1 table
+task time tran tranif0 tranif1 tri tri0 tri1 triand trior trireg typedef union unique unsigned uwire vectored
+void wait wand weak0 weak1 while wire wor xnor xor
+""".split())
+
+# Gate primitives are keywords but still start an instance statement.
+VERILOG_GATES = frozenset("and nand or nor xor xnor buf not bufif0 bufif1 notif0 notif1".split())
+
+PORT_DIRECTIONS = ("input", "output", "inout")
+
+_VERILOG_TOKEN_RE = re.compile(r"""
+ (?P<comment>//[^\n]*|/\*.*?(?:\*/|\Z))
+|(?P<string>"(?:[^"\\\n]|\\.)*"?)
+|(?P<escid>\\\S+)
+|(?P<number>(?:\d[\d_]*\s*)?'[sS]?[bBoOdDhH]\s*[0-9a-fA-FxXzZ?_]+|\d[\d_]*(?:\.\d[\d_]*)?(?:[eE][+-]?\d+)?|'[01xXzZ])
+|(?P<directive>`[A-Za-z_]\w*)
+|(?P<sysid>\$[A-Za-z_][\w$]*)
+|(?P<ident>[A-Za-z_][\w$]*)
+|(?P<op>\S)
+""", re.DOTALL | re.VERBOSE)
+
+# Identifiers only: every other token kind is matched (in the same order as _VERILOG_TOKEN_RE)
+# so that findall() skips it, leaving "" in the result.
+_IDENT_SCAN_RE = re.compile(r"""
+ //[^\n]*|/\*.*?(?:\*/|\Z)
+|"(?:[^"\\\n]|\\.)*"?
+|\\\S+
+|(?:\d[\d_]*\s*)?'[sS]?[bBoOdDhH]\s*[0-9a-fA-FxXzZ?_]+|\d[\d_]*(?:\.\d[\d_]*)?(?:[eE][+-]?\d+)?|'[01xXzZ]
+|`[A-Za-z_]\w*
+|\$[A-Za-z_][\w$]*
+|([A-Za-z_][\w$]*)
+""", re.DOTALL | re.VERBOSE)
+
+
+def _balanced(opener: str, closer: str, depth: int) -> str:
+    """
+    Regex source for an opener...closer group nested up to depth levels. Comments, strings and
+    escaped identifiers are skipped the way the lexer reads them; every atom has exactly one way
+    to match, so a failed match costs linear time. Unterminated comments/strings never match.
+    """
+    o, c = re.escape(opener), re.escape(closer)
+    plain = r'[^%s%s"/\\]' % (o, c)
+    atom = (plain + r'+(?!' + plain + r')|/(?![/*])|\\\S+(?!\S)|"(?:[^"\\\n]|\\.)*"'
+            r'|//[^\n]*(?![^\n])|/\*(?:[^*]|\*(?!/))*\*/')
+    group = r'%s(?:%s)*%s' % (o, atom, c)
+    for _ in range(depth - 1):
+        group = r'%s(?:%s|%s)*%s' % (o, atom, group, c)
+    return group
+
+
+_WS = r'(?:\s+(?!\s)|//[^\n]*(?![^\n])|/\*(?:[^*]|\*(?!/))*\*/)*'
+_STATEMENT_HEAD_RE = re.compile(_WS + r'([A-Za-z_][\w$]*)(?![\w$])')
+_INSTANCE_NAME = r'(?:(?P<name>[A-Za-z_][\w$]*(?![\w$])|\\\S+(?!\S))' + _WS + r'(?:' + _balanced("[", "]", 2) + _WS + r')*)?'
+# one `cell [#(...)] name [range] (...)` instance, and each further `, name [range] (...)`
+_INSTANCE_RE = re.compile(r'(?P<cell>[A-Za-z_][\w$]*(?![\w$]))' + _WS + r'(?:\#' + _WS + _balanced("(", ")", 4) + _WS + r')?'
+                          + _INSTANCE_NAME + _balanced("(", ")", 4) + _WS, re.DOTALL)
+_INSTANCE_NEXT_RE = re.compile(r',' + _WS + _INSTANCE_NAME + _balanced("(", ")", 4) + _WS, re.DOTALL)
+# a declaration up to its `;` with at most one level of brackets and no comments/strings/escaped names
+_DECL_PLAIN = r'[^;"/\\()\[\]{}]'
+_SIMPLE_DECL_RE = re.compile(r'(?:' + _DECL_PLAIN + r'+(?!' + _DECL_PLAIN + r')|\(' + _DECL_PLAIN + r'*\)|\['
+                             + _DECL_PLAIN + r'*\]|\{' + _DECL_PLAIN + r'*\})*;')
+
+_MODULE_BOUNDARY_KEYWORDS = frozenset(["module", "macromodule", "endmodule"])
+_STATEMENT_OPENERS = frozenset([";", ")", ":", "begin", "end", "else", "generate", "endgenerate"])
+# body statements whose spans the structure scan records for VerilogParse.declarations()
+_ITEM_KEYWORDS = frozenset(["assign", "always", "initial", "module", "macromodule", "endmodule"])
+# no lookbehind: the lexer splits `0module` or `8'hfmodule` before the keyword, and a false hit
+# such as `reassign` only sends the statement down the token walk
+_ITEM_KEYWORD_RE = re.compile(r"(?:%s)(?![\w$])" % "|".join(sorted(_ITEM_KEYWORDS)))
+_MODULE_KEYWORD_RE = re.compile(r"module(?![\w$])")
+_DECLARATION_KINDS = frozenset(PORT_DIRECTIONS + ("parameter", "localparam", "wire", "reg", "logic", "tri",
+                                                  "uwire", "wand", "wor", "integer"))
+_OPEN_BRACKETS = {"(": ")", "[": "]", "{": "}"}
+
+
+def tokenize_verilog(code: str, pos: int = 0, endpos: Optional[int] = None) -> List[Tuple[str, str, int]]:
+    """
+    Split Verilog/SystemVerilog source into (kind, text, offset) tuples in one linear pass.
+    kind is one of comment, string, escid, number, directive, sysid, ident, op; whitespace is dropped.
+    pos/endpos restrict lexing to code[pos:endpos] while keeping absolute offsets.
+    """
+    code = code or ""
+    endpos = len(code) if endpos is None else endpos
+    return [(m.lastgroup, m.group(), m.start()) for m in _VERILOG_TOKEN_RE.finditer(code, pos, endpos)]
+
+
+def _match_close(toks: List[Tuple[str, str, int]], i: int) -> int:
+    """
+    Index of the bracket closing toks[i]. Brackets never span module boundaries, so an
+    unbalanced group ends just before the next module/endmodule keyword (or the last token).
+    """
+    closer = _OPEN_BRACKETS[toks[i][1]]
+    opener = toks[i][1]
+    depth = 0
+    n = len(toks)
+    while i < n:
+        kind, text, _ = toks[i]
+        if text == opener:
+            depth += 1
+        elif text == closer:
+            depth -= 1
+            if depth == 0:
+                return i
+        elif kind == "ident" and text in ("endmodule", "module", "macromodule"):
+            return i - 1
+        i += 1
+    return n - 1
+
+
+def _split_top_level(toks: List[Tuple[str, str, int]], sep: str = ",") -> List[List[Tuple[str, str, int]]]:
+    """Split a token slice on separators that are not nested in brackets."""
+    parts, cur, depth = [], [], 0
+    for tok in toks:
+        text = tok[1]
+        if tok[0] == "op":
+            if text in _OPEN_BRACKETS:
+                depth += 1
+            elif text in (")", "]", "}"):
+                depth = depth - 1 if depth > 0 else 0
+            elif text == sep and depth == 0:
+                if cur:
+                    parts.append(cur)
+                cur = []
+                continue
+        cur.append(tok)
+    if cur:
+        parts.append(cur)
+    return parts
+
+
+# comments and strings are matched only so that directives inside them are skipped
+_PP_SCAN_RE = re.compile(r"""//[^\n]*|/\*.*?(?:\*/|\Z)|"(?:[^"\\\n]|\\.)*"?|`([A-Za-z_]\w*)""", re.DOTALL)
+_PP_MACRO_HEAD_RE = re.compile(r"[ \t]*([A-Za-z_]\w*)(\([^)]*\))?")
+_PP_NAME_RE = re.compile(r"[ \t]*([A-Za-z_]\w*)")
+_PP_INCLUDE_RE = re.compile(r"[ \t]*[\"<]([^\">\n]+)[\">]")
+# compiler directives the parser can simply ignore
+PP_PASSTHROUGH = frozenset(["timescale", "default_nettype", "resetall", "celldefine", "endcelldefine",
+                            "unconnected_drive", "nounconnected_drive", "pragma", "line",
+                            "begin_keywords", "end_keywords", "protect", "endprotect"])
+
+
+class VerilogPreprocessor:
+    """
+    `define / `undef / `ifdef-`ifndef-`elsif-`else-`endif / `include expansion in front of VerilogParse.
+    Disabled regions and directive lines keep their newlines, so a file without includes keeps its
+    line numbers. Results are cached per (text hash, define set); an entry also records the hashes of
+    the includes it pulled in and is reused only while those are unchanged.
+    """
+
+    MAX_DEPTH = 32
+    CACHE_SIZE = 256
+
+    def __init__(self):
+        self._cache: "OrderedDict[Tuple[str, Tuple], Tuple[str, Dict[str, Any], List[Tuple[str, Optional[str]]]]]" = OrderedDict()
+
+    @staticmethod
+    def needs_expansion(code: str) -> bool:
+        """True when code uses any directive other than the pass-through ones (`timescale etc.)."""
+        if "`" not in code:
+            return False
+        return any(m.group(1) and m.group(1) not in PP_PASSTHROUGH for m in _PP_SCAN_RE.finditer(code))
+
+    def expand(self, code: str, defines: Optional[Dict[str, str]] = None, resolve=None) -> str:
+        """
+        Expanded text of code. defines maps name -> body (object-like macros);
+        resolve(name) returns (text, content hash) of an include file, or None.
+        """
+        macros = {name: (None, str(body)) for name, body in (defines or {}).items()}
+        text, _, _ = self._expand(code, macros, resolve, ())
+        return text
+
+    def _expand(self, code: str, macros: Dict[str, Any], resolve, stack: Tuple[str, ...]):
+        if not self.needs_expansion(code):
+            return code, macros, []
+        key = (hashlib.sha1(code.encode("utf-8", errors="ignore")).hexdigest(), tuple(sorted(macros.items(), key=repr)))
+        hit = self._cache.get(key)
+        if hit is not None and all(self._dep_hash(resolve, name) == digest for name, digest in hit[2]):
+            self._cache.move_to_end(key)
+            return hit[0], dict(hit[1]), hit[2]
+        text, macros, deps = self._run(code, dict(macros), resolve, stack)
+        self._cache[key] = (text, dict(macros), deps)
+        while len(self._cache) > self.CACHE_SIZE:
+            self._cache.popitem(last=False)
+        return text, macros, deps
+
+    @staticmethod
+    def _dep_hash(resolve, name: str) -> Optional[str]:
+        found = resolve(name) if resolve else None
+        return found[1] if found else None
+
+    def _run(self, code: str, macros: Dict[str, Any], resolve, stack: Tuple[str, ...]):
+        out: List[str] = []
+        deps: List[Tuple[str, Optional[str]]] = []
+        conds: List[List[bool]] = []  # [parent_active, branch_taken]
+        active = True
+        pos = i = 0
+        n = len(code)
+
+        def emit(upto: int) -> None:
+            chunk = code[pos:upto]
+            out.append(chunk if active else "\n" * chunk.count("\n"))
+
+        while True:
+            m = _PP_SCAN_RE.search(code, i)
+            if m is None:
+                break
+            name = m.group(1)
+            i = m.end()
+            if not name or name in PP_PASSTHROUGH:
+                continue
+            if name in ("ifdef", "ifndef", "elsif"):
+                arg = _PP_NAME_RE.match(code, i)
+                emit(m.start())
+                end = arg.end() if arg else i
+                defined = bool(arg) and arg.group(1) in macros
+                if name == "elsif":
+                    if conds:
+                        top = conds[-1]
+                        active = top[0] and not top[1] and defined
+                        top[1] = top[1] or defined
+                else:
+                    cond = defined if name == "ifdef" else not defined
+                    conds.append([active, cond])
+                    active = active and cond
+                pos = i = end
+            elif name in ("else", "endif"):
+                emit(m.start())
+                if conds:
+                    top = conds[-1]
+                    if name == "else":
+                        active = top[0] and not top[1]
+                        top[1] = True
+                    else:
+                        active = conds.pop()[0]
+                pos = i
+            elif not active:
+                continue
+            elif name == "define":
+                end = code.find("\n", i)
+                while end != -1 and code[i:end].rstrip().endswith("\\"):
+                    end = code.find("\n", end + 1)
+                end = n if end == -1 else end
+                head = _PP_MACRO_HEAD_RE.match(code, i, end)
+                if head:
+                    params = None
+                    if head.group(2):
+                        # a tuple, so the macro table stays hashable as part of the cache key
+                        params = tuple(p.split("=")[0].strip() for p in head.group(2)[1:-1].split(",") if p.strip())
+                    body = code[head.end():end].replace("\\\n", " ")
+                    body = re.sub(r"//[^\n]*$", "", body).strip()
+                    macros[head.group(1)] = (params, body)
+                emit(m.start())
+                out.append("\n" * code.count("\n", m.start(), end))
+                pos = i = end
+            elif name == "undef":
+                arg = _PP_NAME_RE.match(code, i)
+                if arg:
+                    macros.pop(arg.group(1), None)
+                emit(m.start())
+                pos = i = arg.end() if arg else i
+            elif name == "include":
+                arg = _PP_INCLUDE_RE.match(code, i)
+                emit(m.start())
+                if arg:
+                    target = arg.group(1)
+                    found = resolve(target) if resolve else None
+                    deps.append((target, found[1] if found else None))
+                    if found and target not in stack and len(stack) < self.MAX_DEPTH:
+                        text, macros, sub = self._expand(found[0], macros, resolve, stack + (target,))
+                        deps.extend(sub)
+                        out.append(text)
+                    i = arg.end()
+                pos = i
+            elif name in macros and f"`{name}" not in stack and len(stack) < self.MAX_DEPTH:
+                params, body = macros[name]
+                end = i
+                if params is not None:
+                    args = self._macro_args(code, i)
+                    if args is None:
+                        continue
+                    values, end = args
+                    subst = dict(zip(params, (v.strip() for v in values)))
+                    if subst:
+                        body = re.sub(r"(?<![\w$`])(%s)(?![\w$])" % "|".join(map(re.escape, subst)),
+                                      lambda mm: subst[mm.group(1)], body)
+                    body = body.replace("``", "")
+                text, _, sub = self._run(body, macros, resolve, stack + (f"`{name}",))
+                deps.extend(sub)
+                emit(m.start())
+                # keep the newlines of multi-line macro arguments so later line numbers do not move
+                out.append(text + "\n" * code.count("\n", m.start(), end))
+                pos = i = end
+        emit(n)
+        return "".join(out), macros, deps
+
+    @staticmethod
+    def _macro_args(code: str, i: int) -> Optional[Tuple[List[str], int]]:
+        """Arguments of a function-like macro call starting at code[i] (whitespace then '(')."""
+        n = len(code)
+        while i < n and code[i] in " \t\r\n":
+            i += 1
+        if i >= n or code[i] != "(":
+            return None
+        args, depth, start, k = [], 0, i + 1, i
+        while k < n:
+            c = code[k]
+            if c == '"':
+                end = code.find('"', k + 1)
+                k = n if end == -1 else end
+            elif c in "([{":
+                depth += 1
+            elif c in ")]}":
+                depth -= 1
+                if depth == 0:
+                    args.append(code[start:k])
+                    return args, k + 1
+            elif c == "," and depth == 1:
+                args.append(code[start:k])
+                start = k + 1
+            k += 1
+        return None
+
+
+_HIGHLIGHT_CLASSES = {"comment": "comment", "string": "str", "number": "num"}
+
+
+def _line_runs(line: str, in_comment: bool) -> Tuple[Tuple[Tuple[int, int, str], ...], bool]:
+    """
+    Highlight runs (column, length, class) of one line, given whether it starts inside a block comment.
+    Returns the runs and whether the line ends inside one.
+    """
+    runs = []
+    start = 0
+    if in_comment:
+        close = line.find("*/")
+        if close == -1:
+            return (((0, len(line), "comment"),) if line else ()), True
+        start = close + 2
+        runs.append((0, start, "comment"))
+    in_comment = False
+    for kind, text, pos in tokenize_verilog(line, start):
+        cls = _HIGHLIGHT_CLASSES.get(kind)
+        if cls is None and kind == "ident" and text in VERILOG_KEYWORDS:
+            cls = "kw"
+        if cls is None:
+            continue
+        runs.append((pos, len(text), cls))
+        if kind == "comment" and text.startswith("/*") and not (len(text) >= 4 and text.endswith("*/")):
+            in_comment = True
+    return tuple(runs), in_comment
+
+
+class MultiPatternMatcher:
+    """
+    Aho-Corasick automaton: every occurrence of any of the patterns in one left-to-right pass
+    over the text, independent of how many patterns there are.
+    """
+
+    def __init__(self, patterns: List[str]):
+        self.goto: List[Dict[str, int]] = [{}]
+        self.fail: List[int] = [0]
+        self.out: List[List[str]] = [[]]
+        for pat in patterns:
+            state = 0
+            for ch in pat:
+                nxt = self.goto[state].get(ch)
+                if nxt is None:
+                    nxt = len(self.goto)
+                    self.goto[state][ch] = nxt
+                    self.goto.append({})
+                    self.fail.append(0)
+                    self.out.append([])
+                state = nxt
+            self.out[state].append(pat)
+        queue = list(self.goto[0].values())
+        for state in queue:
+            for ch, nxt in self.goto[state].items():
+                queue.append(nxt)
+                f = self.fail[state]
+                while f and ch not in self.goto[f]:
+                    f = self.fail[f]
+                self.fail[nxt] = self.goto[f].get(ch, 0) if self.goto[f].get(ch, 0) != nxt else 0
+                self.out[nxt] = self.out[nxt] + self.out[self.fail[nxt]]
+
+    def find(self, text: str) -> List[Tuple[int, str]]:
+        """(end offset, pattern) for every match in text."""
+        hits = []
+        state = 0
+        goto, fail, out = self.goto, self.fail, self.out
+        for i, ch in enumerate(text):
+            while state and ch not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(ch, 0)
+            if out[state]:
+                hits.extend((i + 1, pat) for pat in out[state])
+        return hits
+
+
+# Bus interface signatures: signal name segments (matched between '_' boundaries of an identifier,
+# so s_axi_awvalid / PADDR / wbs_cyc_i all hit) -> canonical signal. "required" must all be present;
+# one "sufficient" signal qualifies a protocol whatever its core score.
+PROTOCOL_SIGNATURES: Dict[str, Dict[str, Any]] = {
+    "apb": {"core": ["paddr", "psel", "penable", "pwrite", "pwdata", "prdata", "pready"],
+            "optional": ["pslverr", "pprot", "pstrb"], "required": [],
+            # as before the multi-protocol detector: any one of these marks the module as APB
+            "sufficient": ["paddr", "psel", "pwrite", "pwdata", "prdata"]},
+    "ahb": {"core": ["haddr", "htrans", "hwrite", "hsize", "hwdata", "hrdata", "hready", "hresp"],
+            "optional": ["hburst", "hsel", "hprot", "hmastlock", "hreadyout"], "required": ["htrans"]},
+    "axi4": {"core": ["awaddr", "awvalid", "awready", "wdata", "wvalid", "wready", "bresp", "bvalid", "bready",
+                      "araddr", "arvalid", "arready", "rdata", "rresp", "rvalid", "rready"],
+             "optional": ["awlen", "awsize", "awburst", "awid", "wstrb", "wlast", "bid", "arlen", "arsize",
+                          "arburst", "arid", "rid", "rlast", "awprot", "arprot"],
+             "required": []},
+    "axi_stream": {"core": ["tvalid", "tready", "tdata"], "optional": ["tlast", "tkeep", "tstrb", "tuser", "tid", "tdest"],
+                   "required": ["tvalid", "tdata"]},
+    "wishbone": {"core": ["cyc", "stb", "we", "adr", "ack", "dat"], "optional": ["sel", "stall", "err", "rty", "cti", "bte"],
+                 "required": ["cyc", "stb"]},
+}
+# any of these makes an AXI interface full AXI4 rather than AXI4-Lite
+_AXI4_BURST_SIGNALS = frozenset(["awlen", "arlen", "awburst", "arburst", "wlast", "rlast", "awid", "arid"])
+PROTOCOL_MIN_SCORE = 0.6
+
+
+def _protocol_matcher() -> MultiPatternMatcher:
+    global _PROTOCOL_MATCHER
+    if _PROTOCOL_MATCHER is None:
+        names = {sig for spec in PROTOCOL_SIGNATURES.values() for sig in spec["core"] + spec["optional"]}
+        _PROTOCOL_MATCHER = MultiPatternMatcher([f"_{s}_" for s in sorted(names)])
+    return _PROTOCOL_MATCHER
+
+
+_PROTOCOL_MATCHER: Optional[MultiPatternMatcher] = None
+
+
+class ConstExprError(ValueError):
+    """Expression is not an integer constant (unknown name, x/z digits, unsupported syntax, too wide)."""
+
+
+# Widest value the evaluator will produce; parameters are 32-bit integers in practice, and the
+# bound keeps hostile input (2**4000**4000, P2 = P1 * P1 chains) from exhausting memory.
+CONST_MAX_BITS = 4096
+
+
+_CONST_MULTI_OPS = ("===", "!==", "<<<", ">>>", "**", "<<", ">>", "<=", ">=", "==", "!=", "&&", "||")
+_CONST_BINARY_PREC = {"||": 1, "&&": 2, "|": 3, "^": 4, "&": 5, "==": 6, "!=": 6, "===": 6, "!==": 6,
+                      "<": 7, "<=": 7, ">": 7, ">=": 7, "<<": 8, ">>": 8, "<<<": 8, ">>>": 8,
+                      "+": 9, "-": 9, "*": 10, "/": 10, "%": 10, "**": 11}
+
+
+def _const_tokens(text: str) -> List[Tuple[str, str]]:
+    """(kind, text) tokens of an expression, with adjacent operator characters joined into <<, ==, ** ..."""
+    out = []
+    run, run_end = "", -1
+    for kind, tok, pos in tokenize_verilog(text):
+        if kind == "comment":
+            continue
+        if kind == "op" and pos == run_end:
+            run += tok
+            run_end = pos + 1
+            continue
+        out.extend(_split_op_run(run))
+        run, run_end = ("", -1)
+        if kind == "op":
+            run, run_end = tok, pos + 1
+        else:
+            out.append((kind, tok))
+    out.extend(_split_op_run(run))
+    return out
+
+
+def _split_op_run(run: str) -> List[Tuple[str, str]]:
+    ops = []
+    i = 0
+    while i < len(run):
+        op = next((o for o in _CONST_MULTI_OPS if run.startswith(o, i)), run[i])
+        ops.append(("op", op))
+        i += len(op)
+    return ops
+
+
+def _const_number(text: str) -> int:
+    text = text.replace("_", "").replace(" ", "")
+    if "'" not in text:
+        if not text.isdigit():
+            raise ConstExprError(f"not an integer: {text}")
+        digits, base = text, 10
+    else:
+        digits = text.split("'", 1)[1].lstrip("sS")
+        if not digits or digits[0].lower() not in "bodh":
+            raise ConstExprError(f"unsized fill literal: {text}")
+        digits, base = digits[1:], {"b": 2, "o": 8, "d": 10, "h": 16}[digits[0].lower()]
+    # 4 bits per digit bounds every base; checked before int() so huge literals are never converted
+    if len(digits) * 4 > CONST_MAX_BITS + 4:
+        raise ConstExprError(f"literal wider than {CONST_MAX_BITS} bits")
+    try:
+        value = int(digits, base)
+    except ValueError:
+        raise ConstExprError(f"x/z digits in {text}")
+    return _const_bounded(value)
+
+
+def _const_bounded(value: int) -> int:
+    if value.bit_length() > CONST_MAX_BITS:
+        raise ConstExprError(f"value wider than {CONST_MAX_BITS} bits")
+    return value
+
+
+class _ConstExprParser:
+    """Precedence-climbing evaluator over _const_tokens() output."""
+
+    def __init__(self, tokens: List[Tuple[str, str]], values: Dict[str, int]):
+        self.toks = tokens
+        self.values = values
+        self.i = 0
+
+    def parse(self) -> int:
+        value = self.ternary()
+        if self.i != len(self.toks):
+            raise ConstExprError(f"unexpected '{self.toks[self.i][1]}'")
+        return value
+
+    def peek(self) -> Optional[str]:
+        return self.toks[self.i][1] if self.i < len(self.toks) else None
+
+    def expect(self, text: str) -> None:
+        if self.peek() != text:
+            raise ConstExprError(f"expected '{text}'")
+        self.i += 1
+
+    def ternary(self) -> int:
+        cond = self.binary(1)
+        if self.peek() != "?":
+            return cond
+        self.i += 1
+        a = self.ternary()
+        self.expect(":")
+        b = self.ternary()
+        return a if cond else b
+
+    def binary(self, min_prec: int) -> int:
+        left = self.unary()
+        while True:
+            op = self.peek()
+            prec = _CONST_BINARY_PREC.get(op)
+            if prec is None or prec < min_prec:
+                return left
+            self.i += 1
+            # ** is right-associative, everything else left
+            right = self.binary(prec if op == "**" else prec + 1)
+            left = self.apply(op, left, right)
+
+    @staticmethod
+    def apply(op: str, a: int, b: int) -> int:
+        if op in ("/", "%") and b == 0:
+            raise ConstExprError("division by zero")
+        if op in ("<<", ">>", "<<<", ">>>", "**") and (b < 0 or b > CONST_MAX_BITS):
+            raise ConstExprError(f"operand out of range for {op}")
+        # bound the result width before computing it; the operands are already bounded
+        if op in ("<<", "<<<") and a.bit_length() + b > CONST_MAX_BITS:
+            raise ConstExprError(f"value wider than {CONST_MAX_BITS} bits")
+        if op == "*" and a.bit_length() + b.bit_length() > CONST_MAX_BITS + 1:
+            raise ConstExprError(f"value wider than {CONST_MAX_BITS} bits")
+        if op == "**" and abs(a) > 1 and (abs(a).bit_length() - 1) * b > CONST_MAX_BITS:
+            raise ConstExprError(f"value wider than {CONST_MAX_BITS} bits")
+        return _const_bounded({
+            "||": lambda: int(bool(a) or bool(b)), "&&": lambda: int(bool(a) and bool(b)),
+            "|": lambda: a | b, "^": lambda: a ^ b, "&": lambda: a & b,
+            "==": lambda: int(a == b), "!=": lambda: int(a != b), "===": lambda: int(a == b), "!==": lambda: int(a != b),
+            "<": lambda: int(a < b), "<=": lambda: int(a <= b), ">": lambda: int(a > b), ">=": lambda: int(a >= b),
+            "<<": lambda: a << b, ">>": lambda: a >> b, "<<<": lambda: a << b, ">>>": lambda: a >> b,
+            "+": lambda: a + b, "-": lambda: a - b, "*": lambda: a * b,
+            # Verilog integer division truncates toward zero
+            "/": lambda: int(a / b) if (a < 0) != (b < 0) else a // b,
+            "%": lambda: a - b * (int(a / b) if (a < 0) != (b < 0) else a // b),
+            "**": lambda: a ** b,
+        }[op]())
+
+    def unary(self) -> int:
+        tok = self.peek()
+        if tok in ("-", "+", "~", "!"):
+            self.i += 1
+            v = self.unary()
+            return {"-": -v, "+": v, "~": ~v, "!": int(not v)}[tok]
+        return self.primary()
+
+    def primary(self) -> int:
+        if self.i >= len(self.toks):
+            raise ConstExprError("unexpected end of expression")
+        kind, tok = self.toks[self.i]
+        self.i += 1
+        if tok == "(":
+            v = self.ternary()
+            self.expect(")")
+            return v
+        if kind == "number":
+            return _const_number(tok)
+        if kind == "sysid" and tok == "$clog2":
+            self.expect("(")
+            v = self.ternary()
+            self.expect(")")
+            return (v - 1).bit_length() if v > 1 else 0
+        if kind in ("ident", "escid") and tok in self.values:
+            return self.values[tok]
+        raise ConstExprError(f"not a constant: {tok}")
+
+
+class ConstEnv:
+    """
+    Integer values of one module's parameters / localparams, with memoized evaluation:
+    every port range or width expression in the module is evaluated at most once.
+    """
+
+    def __init__(self, values: Optional[Dict[str, int]] = None):
+        self.values: Dict[str, int] = dict(values or {})
+        self._memo: Dict[str, Optional[int]] = {}
+
+    def eval(self, text: str) -> Optional[int]:
+        """Value of a constant expression, or None when it does not reduce to an integer."""
+        if text not in self._memo:
+            try:
+                self._memo[text] = _ConstExprParser(_const_tokens(text), self.values).parse()
+            except (ConstExprError, RecursionError, MemoryError):
+                self._memo[text] = None
+        return self._memo[text]
+
+    def define(self, name: str, text: str) -> Optional[int]:
+        value = self.eval(text)
+        if value is not None:
+            self.values[name] = value
+            # a new name can only turn unresolved expressions into resolved ones
+            self._memo = {k: v for k, v in self._memo.items() if v is not None}
+        return value
+
+    def width(self, rng: str) -> int:
+        """Bits covered by a packed range such as [DATA_W-1:0] (or [3:0][7:0]); 1 if it cannot be resolved."""
+        total = 1
+        for msb, lsb in re.findall(r"\[([^\[\]:]+):([^\[\]]+)\]", rng or ""):
+            hi, lo = self.eval(msb), self.eval(lsb)
+            if hi is None or lo is None:
+                return 1
+            total *= abs(hi - lo) + 1
+        return total
+
+
+class ModuleRecord:
+    """
+    One module of a VerilogParse: offsets / line numbers into the parsed buffer plus its header/body spans.
+    Slots instead of a dict since big netlists have tens of thousands of these; item access
+    (rec["name"], "summary" in rec, rec.get(...)) is kept so analysis code reads like plain records.
+    Neither the module text nor its tokens are stored: slice them with VerilogParse.module_text()
+    and re-lex with VerilogParse.module_tokens() / span_tokens() when needed.
+    """
+
+    __slots__ = ("name", "start", "end", "line", "end_line", "params_span", "ports_span",
+                 "body_span", "decls", "instances", "always", "assigns", "posedge_always", "has_case",
+                 "idents", "summary", "param_env", "file_key")
+
+    def __init__(self, **fields):
+        for name in self.__slots__:
+            setattr(self, name, fields.get(name))
+
+    def __getitem__(self, name: str) -> Any:
+        try:
+            return getattr(self, name)
+        except AttributeError:
+            raise KeyError(name)
+
+    def __setitem__(self, name: str, value: Any) -> None:
+        setattr(self, name, value)
+
+    def __contains__(self, name: str) -> bool:
+        return getattr(self, name, None) is not None
+
+    def get(self, name: str, default: Any = None) -> Any:
+        value = getattr(self, name, None)
+        return default if value is None else value
+
+    def copy(self) -> "ModuleRecord":
+        return ModuleRecord(**{name: getattr(self, name) for name in self.__slots__})
+
+    def __repr__(self) -> str:
+        return f"ModuleRecord({self.name!r}, {self.start}:{self.end})"
+
+
+def _tok_text(tok: Optional[Tuple[str, str, int]]) -> Optional[str]:
+    return tok[1] if tok is not None else None
+
+
+class _TokenCursor:
+    """
+    Forward reader over the comment-free tokens of code[pos:end] for the structure scan.
+    Tokens are lexed one at a time and dropped once consumed, so scanning a file never holds
+    more than a few lookahead tokens. open_comment is set when a block comment runs into the end.
+    """
+
+    __slots__ = ("code", "pos", "end", "ahead", "last", "open_comment")
+
+    def __init__(self, code: str, pos: int, end: int):
+        self.code = code
+        self.pos = pos
+        self.end = end
+        self.ahead: List[Tuple[str, str, int]] = []
+        self.last = pos
+        self.open_comment = False
+
+    def _lex(self) -> Optional[Tuple[str, str, int]]:
+        search = _VERILOG_TOKEN_RE.search
+        while True:
+            m = search(self.code, self.pos, self.end)
+            if m is None:
+                self.pos = self.end
+                return None
+            self.pos = m.end()
+            kind = m.lastgroup
+            if kind != "comment":
+                return kind, m.group(), m.start()
+            text = m.group()
+            if text.startswith("/*") and (len(text) < 4 or not text.endswith("*/")):
+                self.open_comment = True
+
+    def peek(self, k: int = 0) -> Optional[Tuple[str, str, int]]:
+        ahead = self.ahead
+        while len(ahead) <= k:
+            tok = self._lex()
+            if tok is None:
+                return None
+            ahead.append(tok)
+        return ahead[k]
+
+    def next(self) -> Optional[Tuple[str, str, int]]:
+        tok = self.ahead.pop(0) if self.ahead else self._lex()
+        if tok is not None:
+            self.last = tok[2]
+        return tok
+
+    def seek(self, pos: int) -> bool:
+        """Jump forward to pos (a token boundary found by a whole-statement regex); False if lookahead is already past it."""
+        if self.ahead and self.ahead[-1][2] >= pos:
+            return False
+        self.pos = self.last = pos
+        self.ahead = []
+        return True
+
+    def push_back(self, tok: Tuple[str, str, int]) -> None:
+        self.ahead.insert(0, tok)
+
+    def mark(self) -> Tuple[int, List[Tuple[str, str, int]], int]:
+        return self.pos, list(self.ahead), self.last
+
+    def reset(self, state: Tuple[int, List[Tuple[str, str, int]], int]) -> None:
+        self.pos, ahead, self.last = state
+        self.ahead = list(ahead)
+
+    def statement_end(self) -> int:
+        """
+        Consume through the `;` that ends the current statement (outside brackets) and return its
+        offset. A missing `;` ends the statement before the next module item keyword
+        (assign / always / initial / module / endmodule), which is left unconsumed.
+        """
+        depth = 0
+        while True:
+            tok = self.peek()
+            if tok is None:
+                return self.pos
+            if tok[0] == "ident" and tok[1] in _ITEM_KEYWORDS:
+                return tok[2]
+            self.next()
+            text = tok[1]
+            if text == ";" and depth == 0:
+                return tok[2]
+            if text in _OPEN_BRACKETS:
+                depth += 1
+            elif text in (")", "]", "}"):
+                depth = depth - 1 if depth > 0 else 0
+
+    def close(self, opener: str) -> int:
+        """
+        With `opener` just consumed, consume through its closing bracket and return that token's offset.
+        Like _match_close, an unbalanced group stops before the next module/endmodule keyword (or at
+        the end); the offset of the last consumed token is returned then.
+        """
+        closer = _OPEN_BRACKETS[opener]
+        depth = 1
+        while True:
+            tok = self.peek()
+            if tok is None or (tok[0] == "ident" and tok[1] in ("endmodule", "module", "macromodule")):
+                return self.last
+            self.next()
+            if tok[1] == opener:
+                depth += 1
+            elif tok[1] == closer:
+                depth -= 1
+                if depth == 0:
+                    return tok[2]
+
+
+class VerilogParse:
+    """
+    Module / port / instance spans for one version of a source text.
+    Every VerilogBackend analysis reads from this instead of re-scanning the source.
+
+    Module records hold character spans relative to the module start (the #(...) parameter list,
+    the port list and the body) and instance / always / assign offsets, also relative to the
+    module start, so a record stays valid when an edit elsewhere shifts it. Tokens are never
+    kept: the scan lexes one token at a time and span_tokens() re-lexes a span on demand.
+    """
+
+    def __init__(self, code: str, modules: Optional[List[ModuleRecord]] = None):
+        self.code = code or ""
+        self.line_count = self.code.count("\n") + (0 if self.code.endswith("\n") or not self.code else 1)
+        self._aggregates: Optional[Dict[str, Any]] = None
+        self._override_envs: Dict[Tuple[int, Tuple[Tuple[str, int], ...]], ConstEnv] = {}
+        if modules is None:
+            modules, _ = self._scan_range(0, len(self.code), 1)
+        self.modules: List[ModuleRecord] = modules
+
+    # -----------------------------
+    # Structure scan
+    # -----------------------------
+    def _scan_range(self, begin: int, end: int, line: int) -> Tuple[List[ModuleRecord], bool]:
+        """
+        Lex code[begin:end] and collect the modules inside it; line is the line number at begin.
+        The flag is False when the range ends inside a block comment, i.e. the edit leaks past it.
+        """
+        cur = _TokenCursor(self.code, begin, end)
+        modules = []
+        line_off = begin
+        while True:
+            tok = cur.next()
+            if tok is None:
+                break
+            if tok[0] == "ident" and tok[1] in ("module", "macromodule"):
+                mod = self._scan_module(cur, tok[2])
+                if mod:
+                    line += self.code.count("\n", line_off, mod["start"])
+                    mod["line"] = line
+                    line += self.code.count("\n", mod["start"], mod["end"])
+                    mod["end_line"] = line
+                    line_off = mod["end"]
+                    modules.append(mod)
+        return modules, not cur.open_comment
+
+    def _scan_module(self, cur: "_TokenCursor", start: int) -> Optional[ModuleRecord]:
+        """Module whose keyword starts at `start` (already consumed); None if it never reaches endmodule."""
+        if _tok_text(cur.peek()) in ("automatic", "static"):
+            cur.next()
+        name = "unknown"
+        tok = cur.peek()
+        if tok is not None and tok[0] in ("ident", "escid"):
+            name = tok[1]
+            cur.next()
+        params_span = ports_span = None
+        if _tok_text(cur.peek()) == "#" and _tok_text(cur.peek(1)) == "(":
+            cur.next()
+            opener = cur.next()
+            params_span = (opener[2] + 1 - start, cur.close("(") - start)
+        if _tok_text(cur.peek()) == "(":
+            opener = cur.next()
+            ports_span = (opener[2] + 1 - start, cur.close("(") - start)
+        tok = cur.next()
+        # a malformed header ends at the next module keyword, so a region rescan and a full scan agree
+        while tok is not None and tok[1] != ";" and not (tok[0] == "ident" and tok[1] in _MODULE_BOUNDARY_KEYWORDS):
+            tok = cur.next()
+        if tok is None:
+            return None
+        if tok[1] != ";":
+            # `endmodule` closes a module with an unterminated header (empty body); `module` starts over
+            cur.push_back(tok)
+            if tok[1] != "endmodule":
+                return None
+        body_start = tok[2] + 1 if tok[1] == ";" else tok[2]
+
+        instances: List[Tuple[str, str, int]] = []
+        always: List[int] = []
+        assigns: List[int] = []
+        decls: List[Tuple[str, int, int]] = []
+        posedge_always = has_case = False
+        depth = 0
+        stmt_start = True
+        while True:
+            if stmt_start and depth == 0 and not cur.ahead:
+                self._plain_statements(cur, start, decls, instances)
+            tok = cur.next()
+            if tok is None:
+                return None
+            kind, text, pos = tok
+            if kind == "ident":
+                if text == "endmodule":
+                    return ModuleRecord(name=name, start=start, end=pos + len(text),
+                                        params_span=params_span, ports_span=ports_span,
+                                        body_span=(body_start - start, pos - start), decls=decls, instances=instances,
+                                        always=always, assigns=assigns,
+                                        posedge_always=posedge_always, has_case=has_case)
+                if text in ("module", "macromodule"):
+                    # unterminated module; let the caller start over here
+                    cur.push_back(tok)
+                    return None
+                if depth == 0 and stmt_start and text in _DECLARATION_KINDS:
+                    stop = self._plain_declaration(self.code, pos + len(text), cur.end)
+                    if stop >= 0 and cur.seek(stop):
+                        decls.append((text, pos + len(text) - start, stop - 1 - start))
+                    else:
+                        decls.append((text, pos + len(text) - start, cur.statement_end() - start))
+                    continue
+                if depth == 0 and stmt_start and (text not in VERILOG_KEYWORDS or text in VERILOG_GATES):
+                    if self._match_instance(cur, tok, start, instances):
+                        stmt_start = True
+                        continue
+                if text == "always" and _tok_text(cur.peek()) == "@":
+                    always.append(pos - start)
+                    if _tok_text(cur.peek(1)) == "(" and not posedge_always:
+                        state = cur.mark()
+                        cur.next()
+                        opener = cur.next()
+                        close = cur.close("(")
+                        posedge_always = any(t[1] == "posedge" for t in tokenize_verilog(self.code, opener[2] + 1, close))
+                        cur.reset(state)
+                elif text == "assign":
+                    assigns.append(pos - start)
+                elif text == "case":
+                    has_case = True
+                elif text in ("begin", "end") and _tok_text(cur.peek()) == ":" and cur.peek(1) is not None \
+                        and cur.peek(1)[0] in ("ident", "escid"):
+                    # `begin : g_name` / `end : g_name`: the label belongs to the opener
+                    cur.next()
+                    cur.next()
+                stmt_start = text in _STATEMENT_OPENERS
+            elif kind == "escid" and depth == 0 and stmt_start:
+                # escaped cell name, e.g. `\cell$x u0 (...)` in synthesized netlists
+                stmt_start = self._match_instance(cur, tok, start, instances)
+            elif kind == "op":
+                if text in _OPEN_BRACKETS:
+                    depth += 1
+                elif text in (")", "]", "}"):
+                    depth = depth - 1 if depth > 0 else 0
+                stmt_start = depth == 0 and text in _STATEMENT_OPENERS
+            else:
+                stmt_start = False
+
+    @staticmethod
+    def _plain_declaration(code: str, begin: int, end: int) -> int:
+        """
+        Offset just past the `;` of a declaration whose text after the keyword starts at begin,
+        when a regex can find it (no comments, strings or nested brackets); -1 leaves it to statement_end.
+        """
+        m = _SIMPLE_DECL_RE.match(code, begin, end)
+        if m is None or _ITEM_KEYWORD_RE.search(code, begin, m.end()):
+            return -1
+        return m.end()
+
+    @staticmethod
+    def _plain_instance(code: str, pos: int, end: int, names: List[str]) -> int:
+        """
+        Regex form of _match_instance for `cell [#(...)] name [range] (...) {, name (...)} ;` at pos:
+        fills names and returns the offset after the statement, or -1 when anything unusual (deeper
+        nesting, a keyword name, module keywords inside) needs the token walk.
+        """
+        m = _INSTANCE_RE.match(code, pos, end)
+        if m is None:
+            return -1
+        gate = m.group("cell") in VERILOG_GATES
+        while True:
+            name = m.group("name")
+            if name is None:
+                if not gate:
+                    return -1
+                name = ""
+            elif name in VERILOG_KEYWORDS:
+                return -1
+            names.append(name)
+            if not code.startswith(",", m.end()):
+                break
+            m = _INSTANCE_NEXT_RE.match(code, m.end(), end)
+            if m is None:
+                return -1
+        stop = m.end()
+        if code.find("module", pos, stop) >= 0 and _MODULE_KEYWORD_RE.search(code, pos, stop):
+            return -1
+        if code.startswith(";", stop) and stop < end:
+            # the terminating `;` only restarts a statement, which a match does anyway
+            stop += 1
+        return stop
+
+    def _plain_statements(self, cur: "_TokenCursor", base: int, decls: List[Tuple[str, int, int]], instances: List[Tuple[str, str, int]]) -> None:
+        """
+        Consume the run of plain declarations and instances at a statement start (no lookahead buffered).
+        Netlist bodies are almost entirely such statements, so they never go through the token cursor.
+        """
+        code, end, pos = self.code, cur.end, cur.pos
+        head = _STATEMENT_HEAD_RE.match
+        names: List[str] = []
+        while True:
+            m = head(code, pos, end)
+            if m is None:
+                break
+            text, at = m.group(1), m.start(1)
+            if text in _DECLARATION_KINDS:
+                stop = self._plain_declaration(code, at + len(text), end)
+                if stop < 0:
+                    break
+                decls.append((text, at + len(text) - base, stop - 1 - base))
+            elif text not in VERILOG_KEYWORDS or text in VERILOG_GATES:
+                stop = self._plain_instance(code, at, end, names)
+                if stop < 0:
+                    break
+                cell, rel = sys.intern(text), at - base
+                instances.extend((cell, name, rel) for name in names)
+            else:
+                break
+            names.clear()
+            pos = stop
+        cur.seek(pos)
+
+    @staticmethod
+    def _match_instance(cur: "_TokenCursor", tok: Tuple[str, str, int], base: int, out: List[Tuple[str, str, int]]) -> bool:
+        """
+        Try to read `type [#(...)] name [range] (...) {, name (...)} ;` starting at tok (consumed);
+        on failure the cursor is rewound to just after tok.
+        """
+        state = cur.mark()
+        # cell names repeat across thousands of instances in a netlist
+        cell, pos = sys.intern(tok[1]), tok[2] - base
+        if _tok_text(cur.peek()) == "#" and _tok_text(cur.peek(1)) == "(":
+            cur.next()
+            cur.next()
+            cur.close("(")
+        found = False
+        while True:
+            nxt = cur.peek()
+            if nxt is None:
+                break
+            name = ""
+            if nxt[0] in ("ident", "escid") and nxt[1] not in VERILOG_KEYWORDS:
+                name = nxt[1]
+                cur.next()
+                while _tok_text(cur.peek()) == "[":
+                    cur.next()
+                    cur.close("[")
+            elif not (cell in VERILOG_GATES and nxt[1] == "("):
+                break
+            if _tok_text(cur.peek()) != "(":
+                break
+            cur.next()
+            cur.close("(")
+            out.append((cell, name, pos))
+            found = True
+            if _tok_text(cur.peek()) == ",":
+                cur.next()
+                continue
+            break
+        if not found:
+            cur.reset(state)
+        return found
+
+    # -----------------------------
+    # Incremental update
+    # -----------------------------
+    def updated(self, new_code: str) -> "VerilogParse":
+        """
+        Parse new_code reusing every module the edit does not touch.
+        The changed region is the span between the common prefix and suffix of old and new text;
+        only the modules overlapping it (plus the gaps around them) are re-lexed, modules after it
+        are shifted. Cost follows the size of the edit, not the size of the file.
+        """
+        old = self.code
+        if new_code == old:
+            return self
+        prefix = _common_prefix_len(old, new_code)
+        limit = min(len(old), len(new_code)) - prefix
+        suffix = _common_suffix_len(old, new_code, limit)
+        old_end = len(old) - suffix
+        delta = len(new_code) - len(old)
+
+        before = [m for m in self.modules if m["end"] < prefix]
+        after = [m for m in self.modules if m["start"] > old_end]
+        region_start = before[-1]["end"] if before else 0
+        region_end = after[0]["start"] + delta if after else len(new_code)
+        region_line = before[-1]["end_line"] if before else 1
+
+        parse = VerilogParse(new_code, modules=[])
+        touched, clean = parse._scan_range(region_start, region_end, region_line)
+        if not clean:
+            return VerilogParse(new_code)
+        line_delta = new_code.count("\n", prefix, len(new_code) - suffix) - old.count("\n", prefix, old_end)
+        shifted = []
+        for m in after:
+            m = m.copy()
+            m["start"] += delta
+            m["end"] += delta
+            m["line"] += line_delta
+            m["end_line"] += line_delta
+            shifted.append(m)
+        parse.modules = before + touched + shifted
+        return parse
+
+    @classmethod
+    def parallel(cls, code: str, workers: Optional[int] = None) -> "VerilogParse":
+        """
+        Same result as VerilogParse(code), computed over module-aligned shards in the shared process
+        pool (_parallel_pool); small inputs take the serial path. Shards are cut at lines that
+        start with `module`; if a cut lands inside a block comment the shard before it comes back
+        unclean and the whole text is re-parsed serially.
+        """
+        code = code or ""
+        workers = workers or os.cpu_count() or 1
+        if workers < 2 or len(code) < PARALLEL_PARSE_MIN_BYTES:
+            return cls(code)
+        cuts = [0]
+        step = len(code) // workers
+        for k in range(1, workers):
+            m = _MODULE_LINE_RE.search(code, max(cuts[-1] + 1, k * step))
+            if m is None:
+                break
+            if m.start() > cuts[-1]:
+                cuts.append(m.start())
+        if len(cuts) < 2:
+            return cls(code)
+        bounds = list(zip(cuts, cuts[1:] + [len(code)]))
+        results = _parallel_map(_scan_shard, [code[b:e] for b, e in bounds])
+        if results is None or not all(clean for _, clean in results[:-1]):
+            return cls(code)
+        modules = []
+        line = 0
+        for (base, end), (mods, _) in zip(bounds, results):
+            for m in mods:
+                m["start"] += base
+                m["end"] += base
+                m["line"] += line
+                m["end_line"] += line
+                modules.append(m)
+            line += code.count("\n", base, end)
+        return cls(code, modules=modules)
+
+    @classmethod
+    def combine(cls, parts: List[Tuple[str, "VerilogParse"]]) -> "VerilogParse":
+        """
+        One parse over several files joined with newlines (a project workspace).
+        Module records are shifted copies of each file's records, tagged with their file_key.
+        """
+        modules = []
+        base = lines = 0
+        for file_key, part in parts:
+            for m in part.modules:
+                m = m.copy()
+                m["start"] += base
+                m["end"] += base
+                m["line"] += lines
+                m["end_line"] += lines
+                m["file_key"] = file_key
+                modules.append(m)
+            base += len(part.code) + 1
+            lines += part.code.count("\n") + 1
+        return cls("\n".join(part.code for _, part in parts), modules=modules)
+
+    # -----------------------------
+    # Accessors
+    # -----------------------------
+    def _aggregate(self) -> Dict[str, Any]:
+        if self._aggregates is None:
+            always, assigns = [], []
+            for m in self.modules:
+                always.extend(m["start"] + o for o in m["always"])
+                assigns.extend(m["start"] + o for o in m["assigns"])
+            self._aggregates = {"always": always, "assigns": assigns,
+                                "posedge_always": any(m["posedge_always"] for m in self.modules),
+                                "has_case": any(m["has_case"] for m in self.modules)}
+        return self._aggregates
+
+    @property
+    def always_offsets(self) -> List[int]:
+        return self._aggregate()["always"]
+
+    @property
+    def assign_offsets(self) -> List[int]:
+        return self._aggregate()["assigns"]
+
+    @property
+    def identifiers(self) -> set:
+        """Lower-cased identifiers of the whole file; built per call from the per-module sets."""
+        return set().union(*(self.module_identifiers(m) for m in self.modules))
+
+    @property
+    def has_posedge_always(self) -> bool:
+        return self._aggregate()["posedge_always"]
+
+    @property
+    def has_case(self) -> bool:
+        return self._aggregate()["has_case"]
+
+    def module_identifiers(self, mod: ModuleRecord) -> frozenset:
+        """Lower-cased identifiers used in one module (computed once per record)."""
+        if "idents" not in mod:
+            found = set(_IDENT_SCAN_RE.findall(self.code, mod["start"], mod["end"]))
+            found.discard("")
+            mod["idents"] = frozenset(map(str.lower, found))
+        return mod["idents"]
+
+    def parameter_exprs(self, mod: ModuleRecord) -> List[Tuple[str, str, str]]:
+        """(parameter | localparam, name, expression text) of one module: header #(...) list first, then the body."""
+        pending = []
+        kind = "parameter"
+        for piece in _split_top_level(self.span_tokens(mod, "params_span")):
+            # header entries keep the keyword of the previous entry until another one appears
+            words = {t[1] for t in piece}
+            kind = "localparam" if "localparam" in words else "parameter" if "parameter" in words else kind
+            pending.append((kind, piece))
+        for kind, decl in self.declarations(mod, ("parameter", "localparam")):
+            pending.extend((kind, piece) for piece in _split_top_level(decl))
+        out = []
+        for kind, piece in pending:
+            texts = [t[1] for t in piece]
+            if "=" not in texts:
+                continue
+            eq = texts.index("=")
+            names = [t[1] for t in piece[:eq] if t[0] == "ident" and t[1] not in VERILOG_KEYWORDS]
+            if names:
+                out.append((kind, names[-1], " ".join(texts[eq + 1:])))
+        return out
+
+    def param_env(self, mod: ModuleRecord, overrides: Optional[Dict[str, int]] = None) -> ConstEnv:
+        """
+        Parameter environment of one module, memoized on the record. overrides (an instance's #(...)
+        values) replace parameter defaults, never localparams; each distinct set gets its own memo.
+        """
+        if not overrides:
+            if "param_env" not in mod:
+                mod["param_env"] = self._build_param_env(mod, {})
+            return mod["param_env"]
+        key = (mod["start"], tuple(sorted(overrides.items())))
+        if key not in self._override_envs:
+            self._override_envs[key] = self._build_param_env(mod, overrides)
+        return self._override_envs[key]
+
+    def _build_param_env(self, mod: ModuleRecord, overrides: Dict[str, int]) -> ConstEnv:
+        env = ConstEnv()
+        exprs = []
+        for kind, name, expr in self.parameter_exprs(mod):
+            if kind == "parameter" and name in overrides:
+                env.values[name] = overrides[name]
+            else:
+                exprs.append((name, expr))
+        # forward references: keep resolving until a pass adds nothing
+        while exprs:
+            left = [(n, e) for n, e in exprs if env.define(n, e) is None]
+            if len(left) == len(exprs):
+                break
+            exprs = left
+        return env
+
+    def instance_overrides(self, mod: ModuleRecord, inst: Tuple[str, str, int]) -> List[Tuple[Optional[str], str]]:
+        """(parameter name, or None when positional; expression text) of one instance's #(...) list."""
+        cur = _TokenCursor(self.code, mod["start"] + inst[2], mod["end"])
+        cur.next()
+        if _tok_text(cur.peek()) != "#" or _tok_text(cur.peek(1)) != "(":
+            return []
+        cur.next()
+        opener = cur.next()
+        toks = [t for t in tokenize_verilog(self.code, opener[2] + 1, cur.close("(")) if t[0] != "comment"]
+        out = []
+        for piece in _split_top_level(toks):
+            if len(piece) >= 4 and piece[0][1] == "." and piece[2][1] == "(" and piece[-1][1] == ")":
+                out.append((piece[1][1], " ".join(t[1] for t in piece[3:-1])))
+            else:
+                out.append((None, " ".join(t[1] for t in piece)))
+        return out
+
+    def instance_env(self, parent: ModuleRecord, inst: Tuple[str, str, int], child: ModuleRecord,
+                     outer: Optional[ConstEnv] = None) -> ConstEnv:
+        """
+        Parameter environment of child as instantiated by inst (one of parent's instances): the
+        #(...) overrides are evaluated in outer, parent's own environment by default, so walking a
+        hierarchy top-down with each level's result as the next outer resolves widths per instance.
+        """
+        outer = outer or self.param_env(parent)
+        order = [name for kind, name, _ in self.parameter_exprs(child) if kind == "parameter"]
+        overrides = {}
+        for k, (name, expr) in enumerate(self.instance_overrides(parent, inst)):
+            name = name if name is not None else (order[k] if k < len(order) else None)
+            value = outer.eval(expr) if name else None
+            if value is not None:
+                overrides[name] = value
+        return self.param_env(child, overrides)
+
+    def module_text(self, mod: ModuleRecord, limit: Optional[int] = None) -> str:
+        """Source of one module, sliced from the parsed buffer on demand."""
+        end = mod["end"] if limit is None else min(mod["end"], mod["start"] + limit)
+        return self.code[mod["start"]:end]
+
+    def module_tokens(self, mod: ModuleRecord) -> List[Tuple[str, str, int]]:
+        """Comment-free tokens from `module` to `endmodule`, lexed on demand (offsets into self.code)."""
+        return [t for t in tokenize_verilog(self.code, mod["start"], mod["end"]) if t[0] != "comment"]
+
+    def span_tokens(self, mod: ModuleRecord, span_name: str) -> List[Tuple[str, str, int]]:
+        """Comment-free tokens of one of the record's spans (params_span, ports_span, body_span)."""
+        span = mod.get(span_name)
+        if not span:
+            return []
+        begin = mod["start"] + span[0]
+        return [t for t in tokenize_verilog(self.code, begin, max(begin, mod["start"] + span[1])) if t[0] != "comment"]
+
+    def declarations(self, mod: ModuleRecord, kinds: Tuple[str, ...]) -> List[Tuple[str, List[Tuple[str, str, int]]]]:
+        """
+        Body statements of mod that start with one of kinds (e.g. wire/reg or input/output),
+        as (kind, tokens up to the terminating ';') pairs. Only the recorded statement spans are
+        lexed, not the whole body; kinds must be among _DECLARATION_KINDS.
+        """
+        base = mod["start"]
+        return [(kind, [t for t in tokenize_verilog(self.code, base + begin, base + end) if t[0] != "comment"])
+                for kind, begin, end in mod["decls"] if kind in kinds]
+
+    @staticmethod
+    def declared_names(decl: List[Tuple[str, str, int]]) -> List[str]:
+        """Names declared by the tokens of one declaration (`[type] [range] a, b [3:0], c = 1`)."""
+        names = []
+        for piece in _split_top_level(decl):
+            name = None
+            depth = 0
+            for kind, text, _ in piece:
+                if text in _OPEN_BRACKETS:
+                    depth += 1
+                elif text in (")", "]", "}"):
+                    depth = depth - 1 if depth > 0 else 0
+                elif text == "=" and depth == 0:
+                    break
+                elif depth == 0 and kind in ("ident", "escid") and text not in VERILOG_KEYWORDS:
+                    name = text
+            if name:
+                names.append(name)
+        return names
+
+
+_MODULE_LINE_RE = re.compile(r"^[ \t]*(?:module|macromodule)\b", re.MULTILINE)
+
+
+def _scan_shard(shard: str) -> Tuple[List[ModuleRecord], bool]:
+    """Process-pool worker for VerilogParse.parallel: modules of one shard, relative to its start."""
+    return VerilogParse(shard, modules=[])._scan_range(0, len(shard), 1)
+
+
+def _common_prefix_len(a: str, b: str) -> int:
+    """Length of the common prefix of a and b, compared block-wise in C."""
+    n = min(len(a), len(b))
+    lo, step = 0, 4096
+    while lo < n and a[lo:lo + step] == b[lo:lo + step]:
+        lo += step
+    hi = min(lo + step, n)
+    while lo < hi and a[lo] == b[lo]:
+        lo += 1
+    return min(lo, n)
+
+
+def _common_suffix_len(a: str, b: str, limit: int) -> int:
+    """Length of the common suffix of a and b, capped at limit characters."""
+    la, lb = len(a), len(b)
+    k, step = 0, 4096
+    while k < limit:
+        s = min(step, limit - k)
+        if a[la - k - s:la - k] != b[lb - k - s:lb - k]:
+            break
+        k += s
+    while k < limit and a[la - k - 1] == b[lb - k - 1]:
+        k += 1
+    return k
+
+
+class HierarchyIndex:
+    """
+    Design hierarchy built once from module records: module -> instantiated module adjacency,
+    leaf cell usage, per-module instance counts, in-degree based top detection and cycles.
+    """
+
+    def __init__(self, modules: List[ModuleRecord]):
+        self.modules: Dict[str, ModuleRecord] = {}
+        for m in modules:
+            self.modules.setdefault(m["name"], m)
+        self.children: Dict[str, Dict[str, int]] = {}
+        self.cells: Dict[str, Dict[str, int]] = {}
+        self.parents: Dict[str, List[str]] = {name: [] for name in self.modules}
+        self.instance_counts: Dict[str, int] = {}
+        for name, m in self.modules.items():
+            kids: Dict[str, int] = {}
+            cells: Dict[str, int] = {}
+            for cell, _, _ in m["instances"]:
+                target = kids if cell in self.modules else cells
+                target[cell] = target.get(cell, 0) + 1
+            self.children[name] = kids
+            self.cells[name] = cells
+            self.instance_counts[name] = len(m["instances"])
+            for kid in kids:
+                self.parents[kid].append(name)
+        self.in_degree = {name: len(p) for name, p in self.parents.items()}
+        self.cycles = self._find_cycles()
+        self.tops = [name for name in self.modules if self.in_degree[name] == 0]
+        self.top = self._pick_top()
+
+    def _find_cycles(self) -> List[List[str]]:
+        """Instantiation cycles (each reported once, as the module path that closes it)."""
+        WHITE, GREY, BLACK = 0, 1, 2
+        color = {name: WHITE for name in self.modules}
+        cycles = []
+        for root in self.modules:
+            if color[root] != WHITE:
+                continue
+            path = [root]
+            stack = [iter(self.children[root])]
+            color[root] = GREY
+            while stack:
+                kid = next(stack[-1], None)
+                if kid is None:
+                    color[path.pop()] = BLACK
+                    stack.pop()
+                elif color[kid] == GREY:
+                    cycles.append(path[path.index(kid):] + [kid])
+                elif color[kid] == WHITE:
+                    color[kid] = GREY
+                    path.append(kid)
+                    stack.append(iter(self.children[kid]))
+        return cycles
+
+    def descendants(self, name: str) -> set:
+        seen, stack = set(), [name]
+        while stack:
+            for kid in self.children.get(stack.pop(), {}):
+                if kid not in seen:
+                    seen.add(kid)
+                    stack.append(kid)
+        return seen
+
+    def _pick_top(self) -> Optional[str]:
+        # roots first; among several, the one covering the most of the design wins
+        candidates = self.tops or list(self.modules)
+        if not candidates:
+            return None
+        return max(candidates, key=lambda n: (len(self.descendants(n)), self.instance_counts[n]))
+
+    def as_dict(self) -> Dict[str, Any]:
+        return {
+            "top": self.top,
+            "tops": self.tops,
+            "modules": list(self.modules),
+            "children": {name: [{"module": k, "count": c} for k, c in kids.items()] for name, kids in self.children.items()},
+            "parents": self.parents,
+            "instance_counts": self.instance_counts,
+            "cycles": self.cycles,
+        }
+
+
+class SegmentedText:
+    """
+    Append-friendly text buffer for stored file content.
+    Appends add a segment (amortized O(1)); slicing by offset bisects the segment end
+    offsets (O(log n)) and only joins the segments it covers. text() materializes the
+    full string on demand and collapses the segments so repeated reads are free.
+    A line-start offset index is built on first line access and extended on append.
+    """
+    COMMENT_CHECKPOINT_LINES = 256
+
+    def __init__(self, text: str = ""):
+        self._segments: List[str] = [text] if text else []
+        self._ends: List[int] = [len(text)] if text else []
+        self._line_starts: Optional[array] = None
+        self._trigrams: Optional["TrigramIndex"] = None
+        # whether line k * COMMENT_CHECKPOINT_LINES + 1 starts inside a block comment, filled in by highlighting
+        self.comment_checkpoints: List[bool] = [False]
+
+    def __len__(self) -> int:
+        return self._ends[-1] if self._ends else 0
+
+    def __str__(self) -> str:
+        return self.text()
+
+    def append(self, chunk: str) -> None:
+        if chunk:
+            base = len(self)
+            self._segments.append(chunk)
+            self._ends.append(base + len(chunk))
+            if self._line_starts is not None:
+                self._line_starts.extend(base + m.end() for m in _NEWLINE_RE.finditer(chunk))
+
+    def text(self) -> str:
+        if len(self._segments) > 1:
+            joined = "".join(self._segments)
+            self._segments = [joined]
+            self._ends = [len(joined)]
+        return self._segments[0] if self._segments else ""
+
+    def slice(self, start: int, end: int) -> str:
+        """Return text[start:end] without materializing the whole buffer."""
+        total = len(self)
+        start, end = max(0, min(start, total)), max(0, min(end, total))
+        if start >= end:
+            return ""
+        idx = bisect.bisect_right(self._ends, start)
+        parts = []
+        while idx < len(self._segments) and start < end:
+            seg_start = self._ends[idx] - len(self._segments[idx])
+            seg = self._segments[idx]
+            parts.append(seg[start - seg_start:min(end, self._ends[idx]) - seg_start])
+            start = self._ends[idx]
+            idx += 1
+        return "".join(parts)
+
+    # -----------------------------
+    # Line index
+    # -----------------------------
+    def line_starts(self) -> array:
+        """Offsets at which each line starts (built once per content version)."""
+        if self._line_starts is None:
+            starts = array("q", [0])
+            for seg_end, seg in zip(self._ends, self._segments):
+                base = seg_end - len(seg)
+                starts.extend(base + m.end() for m in _NEWLINE_RE.finditer(seg))
+            self._line_starts = starts
+        return self._line_starts
+
+    def line_count(self) -> int:
+        """Number of lines, counted the way str.splitlines() does for \\n endings."""
+        starts = self.line_starts()
+        return len(starts) - 1 if starts[-1] == len(self) else len(starts)
+
+    def line_of(self, offset: int) -> int:
+        """1-based line number containing offset."""
+        return bisect.bisect_right(self.line_starts(), offset)
+
+    def line_bounds(self, line: int) -> Tuple[int, int]:
+        """(start, end) offsets of a 1-based line, end excluding the newline."""
+        starts = self.line_starts()
+        start = starts[line - 1]
+        end = starts[line] - 1 if line < len(starts) else len(self)
+        return start, end
+
+    def lines(self, first: int, last: int) -> List[str]:
+        """Lines first..last (1-based, inclusive) in O(last - first) after the index exists."""
+        count = self.line_count()
+        first, last = max(1, first), min(last, count)
+        if first > last:
+            return []
+        start = self.line_bounds(first)[0]
+        end = self.line_bounds(last)[1]
+        return [ln[:-1] if ln.endswith("\r") else ln for ln in self.slice(start, end).split("\n")]
+
+    def trigram_index(self) -> "TrigramIndex":
+        """Search index over this buffer, brought up to date with any appended text."""
+        if self._trigrams is None:
+            self._trigrams = TrigramIndex()
+        self._trigrams.sync(self)
+        return self._trigrams
+
+
+_NEWLINE_RE = re.compile(r"\n")
+
+
+class TrigramIndex:
+    """
+    Block-level trigram index over a SegmentedText.
+    Lines are grouped into blocks of at most BLOCK_LINES; every trigram maps to an int bitmask of the
+    blocks that contain it, so a literal narrows a search to the blocks whose masks all agree.
+    Bits are block ids, not positions: `order` lists the ids top to bottom and `sizes` their line
+    counts. Appends re-index the last block onwards (sync); an edit re-indexes only the blocks
+    overlapping the changed lines (rebase), so the rest of the index carries over.
+    """
+    BLOCK_LINES = 64
+
+    def __init__(self):
+        self.masks: Dict[str, int] = {}
+        self.order: List[int] = []
+        self.sizes: Dict[int, int] = {}
+        self.free: List[int] = []
+        self.next_id = 0
+        self.indexed_len = 0
+        self.indexed_lines = 0
+
+    def sync(self, buf: SegmentedText) -> None:
+        """Index text appended since the last sync; appends only add trigrams, so the last block is just OR-ed again."""
+        if len(buf) == self.indexed_len:
+            return
+        first = 1
+        ids: List[int] = []
+        if self.order:
+            # the last line may have grown
+            ids.append(self.order.pop())
+            first = self.indexed_lines - self.sizes[ids[0]] + 1
+        self.order.extend(self._add_blocks(buf, buf.text(), first, buf.line_count(), ids))
+        self.indexed_len = len(buf)
+        self.indexed_lines = buf.line_count()
+
+    def rebase(self, old: SegmentedText, new: SegmentedText) -> None:
+        """Carry this index of old over to new, an edited copy: blocks overlapping the changed lines are re-indexed."""
+        a, b = old.text(), new.text()
+        old_count, new_count = old.line_count(), new.line_count()
+        if (self.indexed_len != len(a) or not old_count or not new_count
+                or len(self.order) > 2 * (new_count // self.BLOCK_LINES) + 8):
+            # stale, empty, or fragmented into small blocks by many edits: start over
+            self.__init__()
+            self.sync(new)
+            return
+        if a == b:
+            return
+        prefix = _common_prefix_len(a, b)
+        suffix = _common_suffix_len(a, b, min(len(a), len(b)) - prefix)
+        # lines before `first` lie wholly in the common prefix, lines after `last` wholly in the suffix
+        first = min(old.line_of(prefix), old_count)
+        last = min(old.line_of(len(a) - suffix), old_count)
+        line, k0, k1, block_first, block_last = 1, -1, -1, 0, 0
+        for k, block_id in enumerate(self.order):
+            size = self.sizes[block_id]
+            if line + size - 1 >= first and line <= last:
+                if k0 < 0:
+                    k0, block_first = k, line
+                k1, block_last = k, line + size - 1
+            line += size
+        ids = self.order[k0:k1 + 1]
+        start = block_first
+        for block_id in ids:
+            size = self.sizes.pop(block_id)
+            self._clear_block(old, a, start, start + size - 1, block_id)
+            start += size
+        used = self._add_blocks(new, b, block_first, block_last + new_count - old_count, ids)
+        self.free.extend(ids)
+        self.order[k0:k1 + 1] = used
+        self.indexed_len = len(b)
+        self.indexed_lines = new_count
+
+    @staticmethod
+    def _trigrams(text: str) -> set:
+        return {text[i:i + 3] for i in range(len(text) - 2)}
+
+    def _add_blocks(self, buf: SegmentedText, text: str, first: int, last: int, ids: List[int]) -> List[int]:
+        """Index lines first..last of buf as blocks of up to BLOCK_LINES; ids (consumed) are reused before free or new ones."""
+        used = []
+        masks = self.masks
+        while first <= last:
+            end_line = min(first + self.BLOCK_LINES - 1, last)
+            if ids:
+                block_id = ids.pop(0)
+            elif self.free:
+                block_id = self.free.pop()
+            else:
+                block_id = self.next_id
+                self.next_id += 1
+            bit = 1 << block_id
+            for tri in self._trigrams(text[buf.line_bounds(first)[0]:buf.line_bounds(end_line)[1]]):
+                masks[tri] = masks.get(tri, 0) | bit
+            self.sizes[block_id] = end_line - first + 1
+            used.append(block_id)
+            first = end_line + 1
+        return used
+
+    def _clear_block(self, buf: SegmentedText, text: str, first: int, last: int, block_id: int) -> None:
+        keep = ~(1 << block_id)
+        masks = self.masks
+        for tri in self._trigrams(text[buf.line_bounds(first)[0]:buf.line_bounds(last)[1]]):
+            mask = masks.get(tri, 0) & keep
+            if mask:
+                masks[tri] = mask
+            else:
+                masks.pop(tri, None)
+
+    def candidate_lines(self, literal: Optional[str]) -> List[Tuple[int, int]]:
+        """1-based inclusive line ranges that may contain literal (everything if it is too short)."""
+        count = self.indexed_lines
+        if not count:
+            return []
+        if not literal or len(literal) < 3:
+            return [(1, count)]
+        mask = -1
+        for i in range(len(literal) - 2):
+            mask &= self.masks.get(literal[i:i + 3], 0)
+            if not mask:
+                return []
+        ranges: List[Tuple[int, int]] = []
+        first = 1
+        for block_id in self.order:
+            last = first + self.sizes[block_id] - 1
+            if mask >> block_id & 1:
+                if ranges and ranges[-1][1] == first - 1:
+                    ranges[-1] = (ranges[-1][0], last)
+                else:
+                    ranges.append((first, last))
+            first = last + 1
+        return ranges
+
+
+def _required_literal(pattern: "re.Pattern") -> Optional[str]:
+    """
+    Longest literal run every match of pattern must contain (None when there is no usable one),
+    taken from the top-level sequence of the parsed regex.
+    """
+    if pattern.flags & re.IGNORECASE:
+        return None
+    try:
+        parsed = sre_parse.parse(pattern.pattern, pattern.flags)
+    except Exception:
+        return None
+    best, cur = "", []
+    for op, arg in list(parsed) + [(None, None)]:
+        if op == sre_parse.LITERAL:
+            cur.append(chr(arg))
+            continue
+        run = "".join(cur)
+        if len(run) > len(best):
+            best = run
+        cur = []
+    return best if len(best) >= 3 and "\n" not in best else None
+
+
+VERILOG_SOURCE_EXTENSIONS = (".v", ".sv")
+VERILOG_HEADER_EXTENSIONS = (".vh", ".svh")
+
+# below this much source text a process pool costs more than it saves
+PARALLEL_PARSE_MIN_BYTES = 2_000_000
+
+
+_PARALLEL_POOL: Optional[ProcessPoolExecutor] = None
+_PARALLEL_POOL_LOCK = threading.Lock()
+
+
+def _parallel_pool() -> ProcessPoolExecutor:
+    """
+    The process pool behind parallel parses and workbook reads, started on first use and kept for
+    the life of the server process. Workers come from a forkserver (spawn where there is none), never
+    from a fork of this multi-threaded process, and they skip loading the chat models (_POOL_WORKER).
+    """
+    global _PARALLEL_POOL
+    with _PARALLEL_POOL_LOCK:
+        if _PARALLEL_POOL is None:
+            method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+            _PARALLEL_POOL = ProcessPoolExecutor(max_workers=max(2, os.cpu_count() or 1),
+                                                 mp_context=multiprocessing.get_context(method))
+        return _PARALLEL_POOL
+
+
+def _parallel_map(fn, *iterables) -> Optional[list]:
+    """list(pool.map(fn, ...)) on the shared pool; None if a worker died, in which case the pool is replaced on next use."""
+    global _PARALLEL_POOL
+    pool = _parallel_pool()
+    try:
+        return list(pool.map(fn, *iterables))
+    except BrokenProcessPool:
+        print("❌ Parse pool worker died; falling back to a serial parse")
+        with _PARALLEL_POOL_LOCK:
+            if _PARALLEL_POOL is pool:
+                _PARALLEL_POOL = None
+        pool.shutdown(wait=False)
+        return None
+
+
+def _parse_modules(code: str) -> List[ModuleRecord]:
+    """Process-pool worker for parse_sources: the module records only, so the source text is not sent back."""
+    return VerilogParse(code).modules
+
+
+def parse_sources(codes: List[str], workers: Optional[int] = None) -> List[VerilogParse]:
+    """Parse several sources, across the shared process pool when there is enough text to pay for it."""
+    workers = workers or os.cpu_count() or 1
+    results = None
+    if workers >= 2 and len(codes) >= 2 and sum(len(c) for c in codes) >= PARALLEL_PARSE_MIN_BYTES:
+        results = _parallel_map(_parse_modules, codes)
+    if results is None:
+        return [VerilogParse(c) for c in codes]
+    return [VerilogParse(c, modules=mods) for c, mods in zip(codes, results)]
+
+
+def _archive_members(filename: str, data: bytes) -> List[Tuple[str, bytes]]:
+    """(path, bytes) of the Verilog sources/headers inside a .zip or .tar(.gz) upload."""
+    wanted = VERILOG_SOURCE_EXTENSIONS + VERILOG_HEADER_EXTENSIONS
+    out = []
+    low = filename.lower()
+    if low.endswith(".zip"):
+        with zipfile.ZipFile(io.BytesIO(data)) as zf:
+            for info in zf.infolist():
+                if not info.is_dir() and info.filename.lower().endswith(wanted):
+                    out.append((info.filename, zf.read(info)))
+    elif low.endswith((".tar", ".tar.gz", ".tgz")):
+        with tarfile.open(fileobj=io.BytesIO(data)) as tf:
+            for member in tf.getmembers():
+                if member.isfile() and member.name.lower().endswith(wanted):
+                    out.append((member.name, tf.extractfile(member).read()))
+    return out
+
+
+def _safe_relpath(path: str) -> str:
+    parts = [p for p in path.replace("\\", "/").split("/") if p not in ("", ".", "..")]
+    return "/".join(parts) or "unnamed.v"
+
+
+# Memory budget for the file store (source text plus cached artifacts)
+STORE_MAX_BYTES = int(os.getenv("VERILOG_STORE_MAX_BYTES", str(256 * 1024 * 1024)))
+# Measured CPython costs (bytes) of the pieces cached per stored file, used by _approx_bytes
+MODULE_RECORD_BYTES = 600      # ModuleRecord with its span tuples and empty lists
+INSTANCE_BYTES = 170           # (cell, name, offset) tuple with its own name string
+DECLARATION_BYTES = 140        # (kind, begin, end) tuple
+OFFSET_BYTES = 36              # int in an always/assign offset list
+IDENT_BYTES = 110              # lower-cased identifier in a module's idents set
+DICT_ENTRY_BYTES = 70          # hash table slot plus its share of the table
+# containers longer than this are estimated from about _SIZE_SAMPLE evenly spaced entries
+_SIZE_SAMPLE = 16
+
+
+def _parse_bytes(parse: "VerilogParse") -> int:
+    """Module records of a parse, from their counts (O(modules), not O(tokens))."""
+    size = len(parse.code)
+    for m in parse.modules:
+        size += (MODULE_RECORD_BYTES + INSTANCE_BYTES * len(m["instances"]) + DECLARATION_BYTES * len(m["decls"])
+                 + OFFSET_BYTES * (len(m["always"]) + len(m["assigns"])))
+        if "idents" in m:
+            size += IDENT_BYTES * len(m["idents"])
+        if "summary" in m:
+            size += _approx_bytes(m["summary"], 2)
+    return size
+
+
+def _approx_bytes(value: Any, depth: int = 4, _seen: Optional[set] = None) -> int:
+    """
+    Size estimate for store accounting: close to what tracemalloc reports, but cheap enough to run
+    on every store access. Dict keys count as well as values, long containers are sampled, and a
+    string object shared between entries (highlight classes, interned cell names) counts once.
+    """
+    if _seen is None:
+        _seen = set()
+    if isinstance(value, (str, bytes)):
+        if id(value) in _seen:
+            return 0
+        _seen.add(id(value))
+        return 49 + len(value)
+    if isinstance(value, (int, float)):
+        # small ints are shared singletons
+        return 0 if isinstance(value, int) and -5 <= value <= 256 else 28
+    if isinstance(value, SegmentedText):
+        size = len(value) + 8 * (len(value._segments) + len(value.comment_checkpoints))
+        if value._line_starts is not None:
+            size += value._line_starts.itemsize * len(value._line_starts)
+        trigrams = value._trigrams
+        if trigrams is not None:
+            size += len(trigrams.masks) * (DICT_ENTRY_BYTES + 80 + trigrams.next_id // 8)
+        return size
+    if isinstance(value, VerilogParse):
+        return _parse_bytes(value)
+    if isinstance(value, HierarchyIndex):
+        return 512 * len(value.modules)
+    if value is None or isinstance(value, bool) or (isinstance(value, tuple) and not value):
+        return 0
+    if depth <= 0:
+        return 64
+    if isinstance(value, dict):
+        n = len(value)
+        sample = list(itertools.islice(value, 0, None, max(1, n // _SIZE_SAMPLE)))
+        per = sum(DICT_ENTRY_BYTES + _approx_bytes(k, depth - 1, _seen) + _approx_bytes(value[k], depth - 1, _seen)
+                  for k in sample)
+        return 64 + (per * n // len(sample) if sample else 0)
+    if isinstance(value, (list, tuple)):
+        n = len(value)
+        sample = value[::max(1, n // _SIZE_SAMPLE)]
+        per = sum(8 + _approx_bytes(v, depth - 1, _seen) for v in sample)
+        return (40 if isinstance(value, tuple) else 56) + (per * n // len(sample) if sample else 0)
+    return 64
+
+
+class BoundedStore(MutableMapping):
+    """
+    File store with a memory budget.
+    Entries are kept in LRU order and accounted by _approx_bytes(); once the total goes over
+    max_bytes the coldest entries spill their text to spill_dir (derived caches are dropped)
+    and are reloaded transparently the next time they are looked up.
+    items()/values() do not reload: spilled entries show up as their metadata only.
+    """
+
+    META_KEYS = ("filename", "saved_at", "session", "project")
+
+    def __init__(self, max_bytes: int = STORE_MAX_BYTES, spill_dir: Optional[str] = None):
+        self.max_bytes = max_bytes
+        self.spill_dir = spill_dir
+        self.total_bytes = 0
+        self._hot: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+        self._sizes: Dict[str, int] = {}
+        self._cold: Dict[str, Dict[str, Any]] = {}
+
+    def __len__(self) -> int:
+        return len(self._hot) + len(self._cold)
+
+    def __iter__(self):
+        return iter(list(self._hot) + list(self._cold))
+
+    def __contains__(self, key) -> bool:
+        return key in self._hot or key in self._cold
+
+    def __getitem__(self, key: str) -> Dict[str, Any]:
+        if key in self._hot:
+            self._hot.move_to_end(key)
+        elif key in self._cold:
+            self._reload(key)
+        else:
+            raise KeyError(key)
+        self._account(key)
+        self._enforce(keep=key)
+        return self._hot[key]
+
+    def __setitem__(self, key: str, item: Dict[str, Any]) -> None:
+        if key in self._cold:
+            self._drop_spill(self._cold.pop(key))
+        self._hot[key] = item
+        self._hot.move_to_end(key)
+        self._account(key)
+        self._enforce(keep=key)
+
+    def __delitem__(self, key: str) -> None:
+        if key in self._hot:
+            del self._hot[key]
+            self.total_bytes -= self._sizes.pop(key, 0)
+        elif key in self._cold:
+            self._drop_spill(self._cold.pop(key))
+        else:
+            raise KeyError(key)
+
+    def items(self):
+        return list(self._hot.items()) + list(self._cold.items())
+
+    def values(self):
+        return [v for _, v in self.items()]
+
+    def clear(self) -> None:
+        for meta in self._cold.values():
+            self._drop_spill(meta)
+        self._hot.clear()
+        self._cold.clear()
+        self._sizes.clear()
+        self.total_bytes = 0
+
+    def stats(self) -> Dict[str, Any]:
+        return {"entries_in_memory": len(self._hot), "entries_spilled": len(self._cold),
+                "bytes": self.total_bytes, "max_bytes": self.max_bytes}
+
+    # accounting / spill
+    def _account(self, key: str) -> None:
+        size = _approx_bytes(self._hot[key])
+        self.total_bytes += size - self._sizes.get(key, 0)
+        self._sizes[key] = size
+
+    def _enforce(self, keep: Optional[str] = None) -> None:
+        for key in list(self._hot):
+            if self.total_bytes <= self.max_bytes:
+                break
+            if key != keep:
+                self._spill(key)
+
+    def _spill_path(self, key: str) -> str:
+        folder = self.spill_dir or os.path.join(tempfile.gettempdir(), "verilog_store")
+        folder = os.path.join(folder, "spill")
+        os.makedirs(folder, exist_ok=True)
+        # keys come from clients (editor updates), so never use them as paths directly
+        return os.path.join(folder, hashlib.sha1(key.encode("utf-8", errors="ignore")).hexdigest())
+
+    def _spill(self, key: str) -> None:
+        item = self._hot.pop(key)
+        self.total_bytes -= self._sizes.pop(key, 0)
+        path = self._spill_path(key)
+        with open(path, "w", encoding="utf-8", errors="ignore") as f:
+            f.write(str(item["content"]))
+        # only the plain metadata stays in memory; derived state (caches, the line_classes memo) is dropped
+        meta = {k: item[k] for k in self.META_KEYS if k in item}
+        meta["spill_path"] = path
+        self._cold[key] = meta
+
+    def _reload(self, key: str) -> None:
+        meta = self._cold.pop(key)
+        with open(meta["spill_path"], "r", encoding="utf-8", errors="ignore") as f:
+            text = f.read()
+        self._drop_spill(meta)
+        item = {k: v for k, v in meta.items() if k != "spill_path"}
+        item.update({"content": SegmentedText(text), "content_hash": None, "cache": {}})
+        self._hot[key] = item
+
+    @staticmethod
+    def _drop_spill(meta: Dict[str, Any]) -> None:
+        try:
+            os.remove(meta["spill_path"])
+        except OSError:
+            pass
+
+
+class SharedFileStore(BoundedStore):
+    """
+    File store shared by every worker process on the host.
+    Text lives in content-addressed blobs (root/blobs/<sha1>), so identical uploads are stored once;
+    a SQLite index (WAL mode) maps file_key -> its blob segments and metadata. Each process keeps
+    decoded entries and their artifact caches in the inherited LRU budget and reloads an entry
+    whenever the index points it at a different version (i.e. another worker edited it).
+    Writers that mutate an entry in place must call publish(key). Appends publish only the new
+    tail as one more segment; a segment at least as long as the one before it is merged into it,
+    so a file keeps O(log n) segments and chunked uploads write O(n log n) bytes in total.
+    Linking blobs into the index and unlinking unreferenced ones both happen inside one
+    IMMEDIATE transaction, so a release can never delete a blob another worker is linking.
+    The directory and index are created on first use, not when the store object is built.
+    """
+
+    def __init__(self, root: str, max_bytes: int = STORE_MAX_BYTES):
+        super().__init__(max_bytes=max_bytes, spill_dir=root)
+        self.root = root
+        self._local = threading.local()
+        self._ready = False
+        self._ready_lock = threading.Lock()
+        self.projects = SharedProjectIndex(self)
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(os.path.join(self.root, "index.sqlite3"), timeout=30)
+        conn.row_factory = sqlite3.Row
+        # WAL keeps the index consistent without an fsync per commit; chunked uploads commit often
+        conn.execute("PRAGMA synchronous=NORMAL")
+        return conn
+
+    def _setup(self) -> None:
+        with self._ready_lock:
+            if self._ready:
+                return
+            os.makedirs(os.path.join(self.root, "blobs"), exist_ok=True)
+            with self._connect() as db:
+                db.execute("PRAGMA journal_mode=WAL")
+                db.execute("CREATE TABLE IF NOT EXISTS files (key TEXT PRIMARY KEY, filename TEXT, hash TEXT, size INTEGER, "
+                           "saved_at TEXT, session TEXT, project TEXT)")
+                db.execute("CREATE TABLE IF NOT EXISTS segments (key TEXT, seq INTEGER, hash TEXT, chars INTEGER, "
+                           "PRIMARY KEY (key, seq))")
+                db.execute("CREATE INDEX IF NOT EXISTS segments_hash ON segments (hash)")
+                db.execute("CREATE TABLE IF NOT EXISTS projects (id TEXT PRIMARY KEY, name TEXT, files TEXT, saved_at TEXT, session TEXT)")
+            self._ready = True
+
+    def _db(self) -> sqlite3.Connection:
+        # one connection per thread and per process (connections must not cross a fork)
+        conn = getattr(self._local, "conn", None)
+        if conn is None or self._local.pid != os.getpid():
+            if not self._ready:
+                self._setup()
+            conn = self._connect()
+            self._local.conn, self._local.pid = conn, os.getpid()
+        return conn
+
+    @contextmanager
+    def _write_txn(self):
+        """Hold the index's write lock for a whole read-check-write sequence; commit on success."""
+        db = self._db()
+        db.execute("BEGIN IMMEDIATE")
+        with db:
+            yield db
+
+    def _row(self, key: str) -> Optional[sqlite3.Row]:
+        return self._db().execute("SELECT * FROM files WHERE key = ?", (key,)).fetchone()
+
+    def _blob_path(self, digest: str) -> str:
+        return os.path.join(self.root, "blobs", digest[:2], digest)
+
+    def _stage_blob(self, data: bytes, digest: str) -> Optional[str]:
+        """Write data to a temp file next to its blob path (outside the lock); None when the blob already exists."""
+        path = self._blob_path(digest)
+        if os.path.exists(path):
+            return None
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp, "wb") as f:
+            f.write(data)
+        return tmp
+
+    def _link_blob(self, data: bytes, digest: str, tmp: Optional[str]) -> None:
+        """Move the staged blob into place; call inside _write_txn so no release can race it."""
+        path = self._blob_path(digest)
+        if tmp is not None:
+            os.replace(tmp, path)
+        elif not os.path.exists(path):
+            # released by another worker after _stage_blob saw it
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, "wb") as f:
+                f.write(data)
+
+    def _read_blob(self, digest: str) -> str:
+        with open(self._blob_path(digest), "rb") as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                return ""
+            # decode straight from the mapped pages, without an intermediate bytes copy
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                return str(memoryview(mm), "utf-8", "ignore")
+
+    def _release_blobs(self, db: sqlite3.Connection, digests) -> None:
+        """Unlink blobs no key points at any more; call inside _write_txn."""
+        for digest in digests:
+            if not db.execute("SELECT 1 FROM segments WHERE hash = ? LIMIT 1", (digest,)).fetchone():
+                try:
+                    os.remove(self._blob_path(digest))
+                except OSError:
+                    pass
+
+    def _load(self, key: str) -> Optional[Tuple[sqlite3.Row, SegmentedText, List[Tuple[str, int]]]]:
+        """(row, text, segments) of a key from one consistent snapshot of the index; None if it is gone."""
+        db = self._db()
+        for _ in range(3):
+            db.execute("BEGIN")
+            with db:
+                row = db.execute("SELECT * FROM files WHERE key = ?", (key,)).fetchone()
+                digests = [r["hash"] for r in db.execute("SELECT hash FROM segments WHERE key = ? ORDER BY seq", (key,))]
+            if row is None:
+                return None
+            try:
+                content, segments = SegmentedText(), []
+                for digest in digests:
+                    part = self._read_blob(digest)
+                    content.append(part)
+                    segments.append((digest, len(part)))
+                return row, content, segments
+            except FileNotFoundError:
+                # another worker repointed the key and released the old blobs between the two reads
+                continue
+        raise KeyError(key)
+
+    def _forget(self, key: str) -> None:
+        if self._hot.pop(key, None) is not None:
+            self.total_bytes -= self._sizes.pop(key, 0)
+
+    # mapping interface
+    def __len__(self) -> int:
+        return self._db().execute("SELECT COUNT(*) FROM files").fetchone()[0]
+
+    def __iter__(self):
+        return iter([r["key"] for r in self._db().execute("SELECT key FROM files ORDER BY key")])
+
+    def __contains__(self, key) -> bool:
+        return isinstance(key, str) and self._row(key) is not None
+
+    def __getitem__(self, key: str) -> Dict[str, Any]:
+        row = self._row(key)
+        if row is None:
+            self._forget(key)
+            raise KeyError(key)
+        item = self._hot.get(key)
+        if item is None or item.get("blob_hash") != row["hash"]:
+            self._forget(key)
+            loaded = self._load(key)
+            if loaded is None:
+                raise KeyError(key)
+            row, content, segments = loaded
+            self._hot[key] = {"filename": row["filename"], "content": content,
+                              "saved_at": row["saved_at"], "session": row["session"] or "", "project": row["project"],
+                              "blob_hash": row["hash"], "content_hash": row["hash"], "cache": {},
+                              "blob_segments": segments, "blob_ref": weakref.ref(content)}
+        else:
+            self._hot.move_to_end(key)
+        self._account(key)
+        self._enforce(keep=key)
+        return self._hot[key]
+
+    def __setitem__(self, key: str, item: Dict[str, Any]) -> None:
+        self._forget(key)
+        self._hot[key] = item
+        self.publish(key)
+        self._account(key)
+        self._enforce(keep=key)
+
+    def __delitem__(self, key: str) -> None:
+        with self._write_txn() as db:
+            if db.execute("SELECT 1 FROM files WHERE key = ?", (key,)).fetchone() is None:
+                raise KeyError(key)
+            old = {r["hash"] for r in db.execute("SELECT hash FROM segments WHERE key = ?", (key,))}
+            db.execute("DELETE FROM files WHERE key = ?", (key,))
+            db.execute("DELETE FROM segments WHERE key = ?", (key,))
+            self._release_blobs(db, old)
+        self._forget(key)
+
+    def items(self):
+        return [(r["key"], {"filename": r["filename"], "saved_at": r["saved_at"], "session": r["session"] or "",
+                            "project": r["project"]})
+                for r in self._db().execute("SELECT * FROM files ORDER BY key")]
+
+    def clear(self) -> None:
+        with self._write_txn() as db:
+            db.execute("DELETE FROM files")
+            db.execute("DELETE FROM segments")
+            db.execute("DELETE FROM projects")
+            shutil.rmtree(os.path.join(self.root, "blobs"), ignore_errors=True)
+            os.makedirs(os.path.join(self.root, "blobs"), exist_ok=True)
+        self._hot.clear()
+        self._sizes.clear()
+        self.total_bytes = 0
+
+    def publish(self, key: str) -> None:
+        """Write the local entry's new text to blobs and point the index at it."""
+        item = self._hot[key]
+        ref = item.get("blob_ref")
+        # SegmentedText only grows in place; a replaced buffer (an edit) is written out whole
+        if not (ref is not None and ref() is item["content"] and self._publish(key, item, append=True)):
+            self._publish(key, item, append=False)
+
+    def _publish(self, key: str, item: Dict[str, Any], append: bool) -> bool:
+        content = item["content"]
+        if append:
+            segments = list(item.get("blob_segments") or [])
+            published = sum(chars for _, chars in segments)
+            if len(content) < published:
+                return False
+            if len(content) > published:
+                # binary-counter merging: the new tail absorbs every earlier segment that is not longer
+                chars = len(content) - published
+                while segments and segments[-1][1] <= chars:
+                    chars += segments.pop()[1]
+                text = content.slice(len(content) - chars, len(content))
+                segments.append((None, chars))
+        else:
+            text = str(content)
+            segments = [(None, len(text))] if text else []
+        tmp = data = digest = None
+        if segments and segments[-1][0] is None:
+            data = text.encode("utf-8", errors="ignore")
+            digest = hashlib.sha1(data).hexdigest()
+            segments[-1] = (digest, segments[-1][1])
+            tmp = self._stage_blob(data, digest)
+        digests = [d for d, _ in segments]
+        # a single segment keeps the content hash, so identical uploads share one blob and one version id
+        version = digests[0] if len(digests) == 1 else hashlib.sha1("".join(digests).encode()).hexdigest()
+        try:
+            with self._write_txn() as db:
+                row = db.execute("SELECT hash FROM files WHERE key = ?", (key,)).fetchone()
+                if append and (row is None or row["hash"] != item.get("blob_hash")):
+                    # another worker changed the entry since this one last published it
+                    return False
+                if digest is not None:
+                    self._link_blob(data, digest, tmp)
+                    tmp = None
+                old = {r["hash"] for r in db.execute("SELECT hash FROM segments WHERE key = ?", (key,))}
+                db.execute("DELETE FROM segments WHERE key = ?", (key,))
+                db.executemany("INSERT INTO segments (key, seq, hash, chars) VALUES (?, ?, ?, ?)",
+                               [(key, seq, d, chars) for seq, (d, chars) in enumerate(segments)])
+                db.execute("INSERT OR REPLACE INTO files (key, filename, hash, size, saved_at, session, project) "
+                           "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                           (key, item.get("filename", key), version, len(content), item.get("saved_at", ""),
+                            item.get("session", ""), item.get("project")))
+                self._release_blobs(db, old - set(digests))
+        finally:
+            if tmp is not None:
+                os.remove(tmp)
+        item["blob_hash"] = item["content_hash"] = version
+        item["blob_segments"] = segments
+        item["blob_ref"] = weakref.ref(content)
+        return True
+
+    # blobs are already on disk, so spilling just drops the decoded copy
+    def _spill(self, key: str) -> None:
+        self._forget(key)
+
+
+class SharedProjectIndex(MutableMapping):
+    """project_id -> record view over a SharedFileStore's index; artifact caches stay per process."""
+
+    def __init__(self, store: SharedFileStore):
+        self.store = store
+        self._records: Dict[str, Dict[str, Any]] = {}
+
+    def __len__(self) -> int:
+        return self.store._db().execute("SELECT COUNT(*) FROM projects").fetchone()[0]
+
+    def __iter__(self):
+        return iter([r["id"] for r in self.store._db().execute("SELECT id FROM projects ORDER BY id")])
+
+    def __contains__(self, pid) -> bool:
+        return isinstance(pid, str) and self.store._db().execute("SELECT 1 FROM projects WHERE id = ?", (pid,)).fetchone() is not None
+
+    def __getitem__(self, pid: str) -> Dict[str, Any]:
+        row = self.store._db().execute("SELECT * FROM projects WHERE id = ?", (pid,)).fetchone()
+        if row is None:
+            self._records.pop(pid, None)
+            raise KeyError(pid)
+        # keep one record object per project so its "cache" survives between calls
+        rec = self._records.setdefault(pid, {"cache": {}})
+        rec.update({"name": row["name"], "files": json.loads(row["files"]), "saved_at": row["saved_at"], "session": row["session"] or ""})
+        return rec
+
+    def __setitem__(self, pid: str, record: Dict[str, Any]) -> None:
+        with self.store._db() as db:
+            db.execute("INSERT OR REPLACE INTO projects (id, name, files, saved_at, session) VALUES (?, ?, ?, ?, ?)",
+                       (pid, record.get("name", ""), json.dumps(record.get("files", [])), record.get("saved_at", ""),
+                        record.get("session", "")))
+        self._records[pid] = record
+
+    def __delitem__(self, pid: str) -> None:
+        if pid not in self:
+            raise KeyError(pid)
+        with self.store._db() as db:
+            db.execute("DELETE FROM projects WHERE id = ?", (pid,))
+        self._records.pop(pid, None)
+
+    def items(self):
+        return [(r["id"], {"name": r["name"], "saved_at": r["saved_at"], "session": r["session"] or ""})
+                for r in self.store._db().execute("SELECT id, name, saved_at, session FROM projects ORDER BY id")]
+
+
+# Uploads are shared between worker processes through this directory (env or Django setting);
+# set it to "memory" to keep a per-process store instead
+SHARED_STORE_DIR = (os.getenv("VERILOG_SHARED_STORE_DIR") or getattr(settings, "VERILOG_SHARED_STORE_DIR", None)
+                    or os.path.join(tempfile.gettempdir(), "verilog_shared_store"))
+
+# Store for uploaded files and derived state
+# Project workspaces: project_id -> {"name", "files": [file_key, ...], "saved_at", "cache"}
+if SHARED_STORE_DIR != "memory":
+    _STORE: Dict[str, Dict[str, Any]] = SharedFileStore(SHARED_STORE_DIR)
+    _PROJECTS: Dict[str, Dict[str, Any]] = _STORE.projects
+else:
+    _STORE = BoundedStore()
+    _PROJECTS = {}
+
+
+# Shape of the keys save_uploaded_file() / save_project() hand out
+_FILE_KEY_RE = re.compile(r"(?:project_)?\d{14}_[^\n;]+\Z")
+
+
+class UnknownFileKey(KeyError):
+    """A file_key that is not in the store (expired, cleared, or never uploaded)."""
 
 
 class VerilogBackend:
-    def __init__(self, store: Dict[str, Dict[str, Any]] = None, persist_folder: Optional[str] = None):
+    def __init__(self, store: Dict[str, Dict[str, Any]] = None, persist_folder: Optional[str] = None,
+                 projects: Dict[str, Dict[str, Any]] = None, defines: Optional[Dict[str, str]] = None):
         self.store = store if store is not None else _STORE
+        self.projects = projects if projects is not None else _PROJECTS
         self.persist_folder = persist_folder
+        self._last_parse: Optional[VerilogParse] = None
+        self._raw_cache: Optional[Dict[str, Any]] = None
+        self.defines: Dict[str, str] = dict(defines or {})
+        self.preprocessor = VerilogPreprocessor()
         if self.persist_folder:
             os.makedirs(self.persist_folder, exist_ok=True)
+            if isinstance(self.store, BoundedStore) and not self.store.spill_dir:
+                self.store.spill_dir = self.persist_folder
 
     # -----------------------------
     # File store helpers
     # -----------------------------
-    def save_uploaded_file(self, filename: str, data: bytes) -> str:
+    def save_uploaded_file(self, filename: str, data: bytes, session: str = "") -> str:
         """Save uploaded file bytes -> store key"""
+        key = f"{datetime.utcnow().strftime('%Y%m%d%H%M%S')}_{os.path.basename(filename)}"
+        return self._put_file(key, filename, data, session)
+
+    def _put_file(self, key: str, filename: str, data: bytes, session: str = "", project: Optional[str] = None) -> str:
         if isinstance(data, bytes):
             try:
                 text = data.decode("utf-8", errors="ignore")
@@ -717,105 +3546,420 @@ class VerilogBackend:
         else:
             text = str(data)
 
-        key = f"{datetime.utcnow().strftime('%Y%m%d%H%M%S')}_{os.path.basename(filename)}"
         self.store[key] = {
             "filename": filename,
-            "content": text,
+            "content": SegmentedText(text),
             "saved_at": datetime.utcnow().isoformat(),
+            "session": session,
+            "project": project,
             # caches / editor state:
-            "highlight_html": None,
-            "last_explanation": None
+            "content_hash": None,
+            "cache": {}
         }
 
         if self.persist_folder:
             path = os.path.join(self.persist_folder, key)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
             with open(path, "w", encoding="utf-8", errors="ignore") as f:
                 f.write(text)
 
         return key
 
+    # -----------------------------
+    # Project workspaces
+    # -----------------------------
+    def save_project(self, name: str, files: List[Tuple[str, bytes]], session: str = "",
+                     defines: Optional[Dict[str, str]] = None) -> Dict[str, Any]:
+        """
+        Store a whole directory (list of (relative path, bytes)) or archive members as one project.
+        Files are parsed in parallel; hierarchy, testbench and report calls on the project_id
+        then see every module of the design.
+        """
+        expanded = []
+        for path, data in files:
+            if path.lower().endswith((".zip", ".tar", ".tar.gz", ".tgz")):
+                expanded.extend(_archive_members(path, data))
+            elif path.lower().endswith(VERILOG_SOURCE_EXTENSIONS + VERILOG_HEADER_EXTENSIONS):
+                expanded.append((path, data))
+        if not expanded:
+            return {"status": "error", "message": "No Verilog/SystemVerilog files found"}
+        relpaths = [_safe_relpath(path) for path, _ in expanded]
+        clashes = sorted({p for p in relpaths if relpaths.count(p) > 1})
+        if clashes:
+            return {"status": "error", "message": f"Duplicate file paths in project: {', '.join(clashes)}"}
+
+        project_id = f"project_{datetime.utcnow().strftime('%Y%m%d%H%M%S')}_{os.path.splitext(os.path.basename(name or 'design'))[0]}"
+        keys = [self._put_file(f"{project_id}/{relpath}", path, data, session, project_id)
+                for relpath, (path, data) in zip(relpaths, expanded)]
+        self.projects[project_id] = {"name": name, "files": keys, "saved_at": datetime.utcnow().isoformat(),
+                                     "session": session, "defines": dict(defines or {}), "cache": {}}
+
+        sources = [k for k in keys if k.lower().endswith(VERILOG_SOURCE_EXTENSIONS)]
+        for key, parse in zip(sources, parse_sources([self._preprocess(self._resolve(k), k) for k in sources])):
+            self._artifacts(key)[1]["parse"] = parse
+
+        hier = self.get_hierarchy(project_id)
+        return {"status": "ok", "project_id": project_id, "file_keys": keys,
+                "module_count": len(hier.get("modules", [])), "top": hier.get("top")}
+
+    def _project_artifacts(self, project_id: str) -> Tuple[str, Dict[str, Any]]:
+        """
+        Combined code and artifact cache for a project. The cache is keyed by the member
+        files' content hashes, so editing one file re-parses only that file and re-combines.
+        """
+        project = self.projects[project_id]
+        members = [k for k in project["files"] if k in self.store and k.lower().endswith(VERILOG_SOURCE_EXTENSIONS)]
+        parts = []
+        stale = []
+        for key in members:
+            _, cache = self._artifacts(key)
+            if "parse" not in cache:
+                stale.append(key)
+            parts.append((key, cache))
+        for key, parse in zip(stale, parse_sources([self._preprocess(self._resolve(k), k) for k in stale])):
+            self._artifacts(key)[1]["parse"] = parse
+        # headers count too: an edited include changes what the sources expand to
+        headers = [(k, self._artifacts(k)[1]) for k in project["files"]
+                   if k in self.store and k.lower().endswith(VERILOG_HEADER_EXTENSIONS)]
+        digest = hashlib.sha1("\0".join(f"{k}:{c['hash']}" for k, c in parts + headers).encode()).hexdigest()
+        cache = project.get("cache")
+        if not cache or cache.get("hash") != digest:
+            parse = VerilogParse.combine([(k, c["parse"]) for k, c in parts])
+            cache = project["cache"] = {"hash": digest, "parse": parse}
+        return cache["parse"].code, cache
+
     def get_saved_file(self, key: str) -> Optional[str]:
         it = self.store.get(key)
-        return it.get("content") if it else None
+        return str(it.get("content")) if it else None
 
     # -----------------------------
     # Resolve code input
     # -----------------------------
+    def has_source(self, key: str) -> bool:
+        """True when key names a stored file or project (in any worker, for a shared store)."""
+        return bool(key) and (key in self.store or key in self.projects)
+
     def _resolve(self, source_or_key: str) -> str:
         if not source_or_key:
             return ""
         if source_or_key in self.store:
-            return self.store[source_or_key]["content"]
+            return str(self.store[source_or_key]["content"])
+        if _FILE_KEY_RE.match(source_or_key) and source_or_key not in self.projects:
+            # a key nobody stored must not be read as Verilog source
+            raise UnknownFileKey(source_or_key)
         return str(source_or_key)
 
+    # -----------------------------
+    # Parsed-artifact cache (per file_key, keyed by content hash)
+    # -----------------------------
+    def _artifacts(self, source_or_key: str) -> Tuple[str, Dict[str, Any]]:
+        """
+        Resolve code plus the artifact cache that belongs to it.
+        Stored files get a cache that survives until their content hash changes;
+        raw code shares a single-slot cache, so the same pasted code sent to several
+        endpoints in a row is parsed and analysed once.
+        """
+        if source_or_key and source_or_key in self.projects:
+            return self._project_artifacts(source_or_key)
+        code = self._resolve(source_or_key)
+        if not source_or_key or source_or_key not in self.store:
+            digest = hashlib.sha1(code.encode("utf-8", errors="ignore")).hexdigest()
+            if self._raw_cache is None or self._raw_cache["hash"] != digest:
+                self._raw_cache = {"hash": digest}
+            return code, self._raw_cache
+        item = self.store[source_or_key]
+        if not item.get("content_hash"):
+            item["content_hash"] = hashlib.sha1(code.encode("utf-8", errors="ignore")).hexdigest()
+        cache = item.get("cache")
+        if not cache or cache.get("hash") != item["content_hash"]:
+            cache = item["cache"] = {"hash": item["content_hash"]}
+        return code, cache
+
+    def _invalidate(self, key: str) -> None:
+        """Drop the content hash so the next _artifacts() call rehashes and discards stale results."""
+        if key in self.store:
+            self.store[key]["content_hash"] = None
+            self._invalidate_includers(key)
+            # shared stores need to hear about in-place edits so other workers see them
+            publish = getattr(self.store, "publish", None)
+            if publish is not None:
+                publish(key)
+
+    def _invalidate_includers(self, key: str) -> None:
+        """Project members that `include the edited file keep the same hash, so drop their caches explicitly."""
+        project = self.store[key].get("project")
+        if not project or project not in self.projects:
+            return
+        base = key.rsplit("/", 1)[-1]
+        for other in self.projects[project]["files"]:
+            if other != key and other in self.store:
+                text = self._resolve(other)
+                if "`include" in text and base in text:
+                    self.store[other]["cache"] = {}
+
+    def _file_parse(self, source_or_key: str, code: str, cache: Dict[str, Any]) -> VerilogParse:
+        """The cached parse behind every analysis, taken after macro / conditional / include expansion."""
+        return self._cached(cache, "parse", lambda: self._parse(self._preprocess(code, source_or_key)))
+
+    def _preprocess(self, code: str, source_or_key: Optional[str] = None) -> str:
+        """Expanded text for the parser; returns code itself when it uses no macros, conditionals or includes."""
+        if not VerilogPreprocessor.needs_expansion(code):
+            return code
+        project = None
+        if source_or_key and source_or_key in self.store:
+            pid = self.store[source_or_key].get("project")
+            project = self.projects[pid] if pid and pid in self.projects else None
+        defines = {**self.defines, **((project or {}).get("defines") or {})}
+        return self.preprocessor.expand(code, defines, self._include_resolver(source_or_key, project))
+
+    def _include_resolver(self, key: Optional[str], project: Optional[Dict[str, Any]]):
+        """`include lookup inside a project workspace: next to the including file, then anywhere in the project."""
+        if not project:
+            return None
+        files = project["files"]
+        base = key.rsplit("/", 1)[0] if key and "/" in key else ""
+
+        def resolve(name: str) -> Optional[Tuple[str, str]]:
+            rel = _safe_relpath(name)
+            leaf = rel.rsplit("/", 1)[-1]
+            candidates = [f"{base}/{rel}"] + [k for k in files if k.endswith("/" + rel)] \
+                + [k for k in files if k.rsplit("/", 1)[-1] == leaf]
+            for k in candidates:
+                if k in files and k in self.store:
+                    text, cache = self._artifacts(k)
+                    return text, cache["hash"]
+            return None
+        return resolve
+
+    @staticmethod
+    def _cached(cache: Dict[str, Any], name: str, build) -> Any:
+        if name not in cache:
+            cache[name] = build()
+        return cache[name]
+
+    # -----------------------------
+    # Batch analysis
+    # -----------------------------
+    BATCH_ARTIFACTS = ("explanation", "report", "testbench", "uvm", "highlight", "hierarchy")
+
+    def iter_batch(self, source_or_key: str, artifacts: Optional[List[str]] = None, mode: str = "auto"):
+        """
+        Yield (artifact, result) pairs as each one is produced.
+        Every artifact is built from the same parse in the shared artifact cache.
+        """
+        builders = {
+            "explanation": lambda: self.explain_code(source_or_key),
+            "report": lambda: self.generate_design_report(source_or_key),
+            "testbench": lambda: self.generate_testbench(source_or_key, mode=mode),
+            "uvm": lambda: self.generate_uvm_testbench(source_or_key),
+            "highlight": lambda: self.highlight_code(source_or_key),
+            "hierarchy": lambda: self.get_hierarchy(source_or_key),
+        }
+        for name in artifacts or self.BATCH_ARTIFACTS:
+            if name not in builders:
+                yield name, {"status": "error", "message": f"Unknown artifact '{name}'"}
+                continue
+            try:
+                yield name, builders[name]()
+            except Exception as e:
+                yield name, {"status": "error", "message": str(e)}
+
+    def analyze_batch(self, source_or_key: str, artifacts: Optional[List[str]] = None, mode: str = "auto") -> Dict[str, Any]:
+        """All requested artifacts in one response."""
+        code, _ = self._artifacts(source_or_key)
+        if not code.strip():
+            return {"status": "error", "message": "No code provided", "results": {}}
+        results = dict(self.iter_batch(source_or_key, artifacts, mode))
+        ok = all(r.get("status") == "ok" for r in results.values())
+        return {"status": "ok" if ok else "partial", "results": results}
+
     # -----------------------------
     # Explain / parse / report
     # -----------------------------
     def explain_code(self, source_or_key: str) -> Dict[str, Any]:
-        code = self._resolve(source_or_key).strip()
-        if not code:
+        code, cache = self._artifacts(source_or_key)
+        if not code.strip():
             return {"status": "error", "message": "No code provided", "explanation": ""}
 
-        modules = self._fast_extract_modules_optimized(code)
-        explanation = self._generate_explanation_optimized(code, modules)
-        # cache last explanation if key
-        if source_or_key in self.store:
-            self.store[source_or_key]["last_explanation"] = explanation
+        parse = self._file_parse(source_or_key, code, cache)
+        modules = self._cached(cache, "modules", lambda: self._fast_extract_modules_optimized(code, parse))
+        hier = self._cached(cache, "hierarchy", lambda: HierarchyIndex(parse.modules))
+        explanation = self._cached(cache, "explanation", lambda: self._generate_explanation_optimized(code, modules, parse, hier))
 
         return {"status": "ok", "module_count": len(modules), "modules": [{"name": m["name"]} for m in modules],
                 "explanation": explanation}
 
-    def generate_testbench(self, source_or_key: str, mode: str = "auto") -> Dict[str, Any]:
-        code = self._resolve(source_or_key)
-        modules = self._fast_extract_modules_optimized(code)
-        if not modules:
+    def generate_testbench(self, source_or_key: str, mode: str = "auto", module: Optional[str] = None) -> Dict[str, Any]:
+        code, cache = self._artifacts(source_or_key)
+        parse = self._file_parse(source_or_key, code, cache)
+        infos = self._cached(cache, "module_infos", lambda: self._extract_module_infos(parse))
+        if not infos:
             return {"status": "error", "message": "No modules found", "testbench": ""}
-
-        info = self._extract_detailed_module_info(code) or {"module_name": modules[0]["name"], "inputs": [], "outputs": [], "inouts": [], "parameters": []}
-        is_apb, signals = self._detect_apb_protocol(code[:20000])
-        if mode == "apb" or (mode == "auto" and is_apb):
-            tb = self._build_apb_testbench(info, signals)
+        info = self._select_module_info(infos, module)
+        if info is None:
+            return {"status": "error", "message": f"Module '{module}' not found", "testbench": ""}
+
+        name = info["module_name"]
+        protocols = self._cached(cache, "protocols", lambda: self._detect_protocols(parse)).get(name, [])
+        apb = next((p for p in protocols if p["protocol"] == "apb"), None)
+        signals = {sig: locs[0]["name"] for sig, locs in apb["signals"].items()} if apb else {}
+        if mode == "apb" or (mode == "auto" and apb is not None):
+            tb = self._cached(cache, f"testbench_apb:{name}", lambda: self._build_apb_testbench(info, signals))
             kind = "apb"
         else:
-            tb = self._build_comprehensive_testbench(info)
+            tb = self._cached(cache, f"testbench_simple:{name}", lambda: self._build_comprehensive_testbench(info))
             kind = "simple"
-        return {"status": "ok", "module": info.get("module_name"), "type": kind, "testbench": tb}
+        return {"status": "ok", "module": name, "type": kind, "testbench": tb}
 
-    def generate_uvm_testbench(self, source_or_key: str) -> Dict[str, Any]:
-        code = self._resolve(source_or_key)
-        info = self._extract_detailed_module_info(code)
-        if not info:
-            modules = self._fast_extract_modules_optimized(code)
-            if not modules:
-                return {"status": "error", "message": "No modules found", "testbench": ""}
-            info = {"module_name": modules[0]["name"], "inputs": [], "outputs": [], "inouts": [], "parameters": []}
-        tb = self._build_uvm_testbench(info)
-        return {"status": "ok", "module": info.get("module_name"), "testbench": tb}
+    def generate_uvm_testbench(self, source_or_key: str, module: Optional[str] = None) -> Dict[str, Any]:
+        code, cache = self._artifacts(source_or_key)
+        parse = self._file_parse(source_or_key, code, cache)
+        infos = self._cached(cache, "module_infos", lambda: self._extract_module_infos(parse))
+        if not infos:
+            return {"status": "error", "message": "No modules found", "testbench": ""}
+        info = self._select_module_info(infos, module)
+        if info is None:
+            return {"status": "error", "message": f"Module '{module}' not found", "testbench": ""}
+        tb = self._cached(cache, f"testbench_uvm:{info['module_name']}", lambda: self._build_uvm_testbench(info))
+        return {"status": "ok", "module": info["module_name"], "testbench": tb}
+
+    def get_module_infos(self, source_or_key: str) -> Dict[str, Any]:
+        """Port / parameter / clock / reset info for every module in the source, by module name."""
+        code, cache = self._artifacts(source_or_key)
+        parse = self._file_parse(source_or_key, code, cache)
+        infos = self._cached(cache, "module_infos", lambda: self._extract_module_infos(parse))
+        if not infos:
+            return {"status": "error", "message": "No modules found", "modules": {}}
+        return {"status": "ok", "modules": infos}
 
     def generate_design_report(self, source_or_key: str) -> Dict[str, Any]:
-        code = self._resolve(source_or_key)
-        modules = self._fast_extract_modules_optimized(code)
-        sample = code[:200000]
-        total_lines = len(code.splitlines())
-        always_count = len(re.findall(r'always\s*@', sample))
-        assign_count = len(re.findall(r'\bassign\b', sample))
-        instance_count = len(re.findall(r'(\w+)\s+(\w+)\s*\(', sample))
-        module_summaries = []
-        for m in modules[:50]:
-            insts = re.findall(r'\b(\w+)\s+(\w+)\s*\(', m["text"][:20000])
-            module_summaries.append({"name": m["name"], "instances": len(insts), "snippet": m["text"][:400]})
-        top = max(module_summaries, key=lambda x: x["instances"])["name"] if module_summaries else None
+        code, cache = self._artifacts(source_or_key)
+        parse = self._file_parse(source_or_key, code, cache)
+        modules = self._cached(cache, "modules", lambda: self._fast_extract_modules_optimized(code, parse))
+        hier = self._cached(cache, "hierarchy", lambda: HierarchyIndex(parse.modules))
+        return self._cached(cache, "report", lambda: self._build_design_report(code, parse, modules, hier))
+
+    def _build_design_report(self, code: str, parse: VerilogParse, modules: List[ModuleRecord], hier: Optional[HierarchyIndex] = None) -> Dict[str, Any]:
+        # exact whole-design counts: the single lexer pass already visited every module
+        total_lines = parse.line_count
+        always_count = len(parse.always_offsets)
+        assign_count = len(parse.assign_offsets)
+        instance_count = sum(len(m["instances"]) for m in modules)
+        module_summaries = [{"name": m["name"], "instances": len(m["instances"]), "snippet": parse.module_text(m, 400)} for m in modules]
+        hier = hier or HierarchyIndex(parse.modules)
+        top = hier.top if module_summaries else None
         return {
             "status": "ok",
             "total_lines": total_lines,
             "module_count": len(modules),
-            "instance_count_sampled": instance_count,
-            "assign_count_sampled": assign_count,
-            "always_count_sampled": always_count,
+            "instance_count": instance_count,
+            "assign_count": assign_count,
+            "always_count": always_count,
             "top_module_candidate": top,
+            "hierarchy_cycles": hier.cycles,
             "modules": module_summaries
         }
 
+    # -----------------------------
+    # Hierarchy / module views
+    # -----------------------------
+    def _latest_key(self, session: str = "") -> Optional[str]:
+        """
+        Most recently saved project or standalone file_key of one session (the UI's hierarchy
+        panel does not send one); other sessions' uploads are never picked.
+        """
+        candidates = {k: v.get("saved_at", "") for k, v in self.store.items()
+                      if not v.get("project") and v.get("session", "") == session}
+        candidates.update({k: v.get("saved_at", "") for k, v in self.projects.items()
+                           if v.get("session", "") == session})
+        if not candidates:
+            return None
+        return max(candidates, key=candidates.get)
+
+    def _hierarchy(self, source_or_key: Optional[str],
+                   session: str = "") -> Tuple[Optional[HierarchyIndex], Dict[str, Any]]:
+        source_or_key = source_or_key or self._latest_key(session)
+        if not source_or_key:
+            return None, {}
+        code, cache = self._artifacts(source_or_key)
+        parse = self._file_parse(source_or_key, code, cache)
+        return self._cached(cache, "hierarchy", lambda: HierarchyIndex(parse.modules)), cache
+
+    def get_hierarchy(self, source_or_key: Optional[str] = None, session: str = "") -> Dict[str, Any]:
+        hier, _ = self._hierarchy(source_or_key, session)
+        if hier is None or not hier.modules:
+            return {"status": "error", "message": "No modules found", "modules": []}
+        return {"status": "ok", **hier.as_dict()}
+
+    def get_module_detail(self, module: str, source_or_key: Optional[str] = None, session: str = "") -> Dict[str, Any]:
+        hier, cache = self._hierarchy(source_or_key, session)
+        if hier is None or module not in hier.modules:
+            return {"status": "error", "message": f"Module '{module}' not found"}
+        views = cache.setdefault("module_views", {})
+        if module not in views:
+            views[module] = self._build_module_view(cache["parse"], hier, hier.modules[module])
+        view = views[module]
+        return {
+            "status": "ok",
+            "module": module,
+            "inputs": [p["name"] for p in view["inputs"]],
+            "outputs": [p["name"] for p in view["outputs"]],
+            "inouts": [p["name"] for p in view["inouts"]],
+            "internal_signals": view["internal_signals"],
+            "children": hier.as_dict()["children"][module],
+            "parents": hier.parents[module],
+            "counts": {"inputs": len(view["inputs"]), "outputs": len(view["outputs"]), "inouts": len(view["inouts"]),
+                       "signals": len(view["internal_signals"]), "instances": hier.instance_counts[module]},
+        }
+
+    def get_module_graph(self, module: str, source_or_key: Optional[str] = None, session: str = "") -> Dict[str, Any]:
+        hier, cache = self._hierarchy(source_or_key, session)
+        if hier is None or module not in hier.modules:
+            return {"status": "error", "message": f"Module '{module}' not found"}
+        views = cache.setdefault("module_views", {})
+        if module not in views:
+            views[module] = self._build_module_view(cache["parse"], hier, hier.modules[module])
+        view = views[module]
+        return {
+            "status": "ok",
+            "module": module,
+            "inputs": view["inputs"],
+            "outputs": view["outputs"],
+            "inouts": view["inouts"],
+            "internal_signals": view["internal_signals"],
+            "children": [{"module": k, "count": c} for k, c in hier.children[module].items()],
+            "cells": [{"cell": k, "count": c} for k, c in hier.cells[module].items()],
+            "instances": view["instances"],
+        }
+
+    def _build_module_view(self, parse: VerilogParse, hier: HierarchyIndex, mod: ModuleRecord) -> Dict[str, Any]:
+        port_tokens = parse.span_tokens(mod, "ports_span")
+        ports = self._module_ports(parse, mod)
+        port_names = set(parse.declared_names(port_tokens))
+        signals = []
+        seen = set()
+        for _, decl in parse.declarations(mod, ("wire", "reg", "logic", "tri", "uwire", "wand", "wor", "integer")):
+            for name in parse.declared_names(decl):
+                if name not in port_names and name not in seen:
+                    seen.add(name)
+                    signals.append(name)
+        # instances of modules in this design, with the child's parameters and port widths under that instance's #(...) overrides
+        instances = []
+        widths: Dict[int, Dict[str, int]] = {}
+        for inst in mod["instances"]:
+            child = hier.modules.get(inst[0])
+            if child is None:
+                continue
+            env = parse.instance_env(mod, inst, child)
+            if id(env) not in widths:
+                child_ports = self._module_ports(parse, child, env)
+                widths[id(env)] = {p["name"]: p["width"] for d in PORT_DIRECTIONS for p in child_ports[d]}
+            params = {name: env.values[name] for kind, name, _ in parse.parameter_exprs(child)
+                      if kind == "parameter" and name in env.values}
+            instances.append({"name": inst[1], "module": inst[0], "parameters": params, "port_widths": widths[id(env)]})
+        return {"inputs": ports["input"], "outputs": ports["output"], "inouts": ports["inout"], "internal_signals": signals,
+                "instances": instances}
+
     # -----------------------------
     # Copy / Clear / Append / Chunks / Editor helpers
     # -----------------------------
@@ -825,12 +3969,9 @@ class VerilogBackend:
         kind: 'code' or 'explanation' or 'testbench'
         """
         if kind == "explanation":
-            if source_or_key in self.store and self.store[source_or_key].get("last_explanation"):
-                return {"status": "ok", "content": self.store[source_or_key]["last_explanation"]}
-            else:
-                # generate on-the-fly
-                res = self.explain_code(source_or_key)
-                return {"status": res.get("status", "error"), "content": res.get("explanation", "")}
+            # served from the artifact cache when the file is unchanged
+            res = self.explain_code(source_or_key)
+            return {"status": res.get("status", "error"), "content": res.get("explanation", "")}
         elif kind == "testbench":
             res = self.generate_testbench(source_or_key)
             return {"status": res.get("status", "error"), "content": res.get("testbench", "")}
@@ -839,16 +3980,26 @@ class VerilogBackend:
             content = self._resolve(source_or_key)
             return {"status": "ok" if content else "error", "content": content}
 
-    def clear_all(self) -> Dict[str, Any]:
-        """Clear the in-memory store entirely."""
-        self.store.clear()
-        return {"status": "ok", "message": "Store cleared"}
+    def clear_all(self, session: str = "") -> Dict[str, Any]:
+        """
+        Clear the stored files and projects of one session namespace (other sessions are untouched).
+        The empty namespace is shared by every client without a session, so it cannot be cleared.
+        """
+        if not session:
+            return {"status": "error", "message": "session_id required"}
+        keys = [k for k, v in self.store.items() if v.get("session", "") == session]
+        for k in keys:
+            del self.store[k]
+        for pid in [p for p, v in self.projects.items() if v.get("session", "") == session]:
+            del self.projects[pid]
+        return {"status": "ok", "message": "Store cleared", "removed": len(keys)}
 
     def add_chunk(self, key: str, chunk_text: str) -> Dict[str, Any]:
         """Append chunk_text to an existing stored file."""
         if key not in self.store:
             return {"status": "error", "message": "Key not found"}
-        self.store[key]["content"] += str(chunk_text)
+        self.store[key]["content"].append(str(chunk_text))
+        self._invalidate(key)
         if self.persist_folder:
             try:
                 path = os.path.join(self.persist_folder, key)
@@ -860,163 +4011,356 @@ class VerilogBackend:
 
     def apply_next_chunk(self, key: str, offset: int = 0, chunk_size: int = 10000) -> Dict[str, Any]:
         """Return the next chunk from stored content starting at offset. Useful for streaming UI."""
-        content = self.get_saved_file(key)
-        if content is None:
+        if key not in self.store:
             return {"status": "error", "message": "Key not found"}
+        content = self.store[key]["content"]
         total = len(content)
         if offset >= total:
             return {"status": "ok", "chunk": "", "next_offset": total, "done": True}
         end = min(total, offset + chunk_size)
-        chunk = content[offset:end]
+        chunk = content.slice(offset, end)
         done = end >= total
         return {"status": "ok", "chunk": chunk, "next_offset": end, "done": done, "total": total}
 
+    def _text_buffer(self, source_or_key: str) -> SegmentedText:
+        """Stored content buffer (with its line index) for a key; raw code gets one in the single-slot raw cache."""
+        if source_or_key and source_or_key in self.store:
+            return self.store[source_or_key]["content"]
+        if not source_or_key or source_or_key in self.projects:
+            return SegmentedText(str(source_or_key or ""))
+        code, cache = self._artifacts(source_or_key)
+        return self._cached(cache, "buffer", lambda: SegmentedText(code))
+
     def update_line_numbers(self, source_or_key: str) -> Dict[str, Any]:
         """Return the count of lines and a small preview of numbered lines."""
-        content = self._resolve(source_or_key)
-        lines = content.splitlines()
-        count = len(lines)
-        preview_lines = []
+        content = self._text_buffer(source_or_key)
+        count = content.line_count()
         max_preview = 10
-        for i in range(min(count, max_preview)):
-            preview_lines.append({"ln": i + 1, "text": lines[i][:200]})
+        preview_lines = [{"ln": i + 1, "text": ln[:200]} for i, ln in enumerate(content.lines(1, max_preview))]
         return {"status": "ok", "lines": count, "preview": preview_lines}
 
+    def get_lines(self, key: str, start_line: int = 1, end_line: int = 100, highlight: bool = False) -> Dict[str, Any]:
+        """
+        Return lines start_line..end_line (1-based, inclusive) of a stored file for virtualized editors.
+        Uses the line-start index, so the cost follows the size of the range, not the file.
+        """
+        if key not in self.store:
+            return {"status": "error", "message": "Key not found"}
+        content = self.store[key]["content"]
+        total = content.line_count()
+        start_line = max(1, int(start_line))
+        end_line = min(total, int(end_line))
+        lines = content.lines(start_line, end_line)
+        res = {"status": "ok", "start_line": start_line, "end_line": start_line + len(lines) - 1,
+               "total_lines": total, "lines": lines}
+        if highlight:
+            # comment state carries over from the lines above the range
+            res["html"] = "\n".join(self._render_line(line, runs)
+                                    for _, line, runs in self.iter_line_classes(key, start_line, end_line))
+            if lines and lines[-1] == "":
+                # keep a final empty line visible once the client wraps this in <pre>
+                res["html"] += "\n"
+        return res
+
     def on_code_change(self, key: str, new_code: str) -> Dict[str, Any]:
         """
         Update stored code and return a small unified diff preview.
         If key not present, create a new stored item with filename=key.
         """
-        old = self.get_saved_file(key) or ""
-        self.store.setdefault(key, {"filename": key, "content": "", "saved_at": datetime.utcnow().isoformat()})
-        self.store[key]["content"] = new_code
+        old = self.store[key]["content"] if key in self.store else SegmentedText()
+        old_parse = self._artifacts(key)[1].get("parse") if key in self.store else None
+        if old_parse is not None and (old_parse.code != str(old) or VerilogPreprocessor.needs_expansion(new_code)):
+            # the parse is of preprocessed text; edits cannot be mapped onto it
+            old_parse = None
+        new = SegmentedText(new_code)
+        self.store.setdefault(key, {"filename": key, "content": SegmentedText(), "saved_at": datetime.utcnow().isoformat()})
+        # comment-state checkpoints stay valid up to the first changed line
+        changed = new_code.count("\n", 0, _common_prefix_len(str(old), new_code)) + 1
+        new.comment_checkpoints = old.comment_checkpoints[:(changed - 1) // SegmentedText.COMMENT_CHECKPOINT_LINES + 1]
+        if old._trigrams is not None:
+            # re-index only the blocks the edit touched
+            new._trigrams, old._trigrams = old._trigrams, None
+            new._trigrams.rebase(old, new)
+        self.store[key]["content"] = new
         self.store[key]["saved_at"] = datetime.utcnow().isoformat()
+        self._invalidate(key)
+        if old_parse is not None:
+            # carry the parse forward: only modules touched by the edit are re-lexed
+            _, cache = self._artifacts(key)
+            if "parse" not in cache:
+                cache["parse"] = old_parse.updated(new_code)
         # compute small diff
-        old_lines = old.splitlines(keepends=False)
-        new_lines = new_code.splitlines(keepends=False)
-        diff = list(difflib.unified_diff(old_lines[:200], new_lines[:200], lineterm=""))
+        old_lines = old.lines(1, 200)
+        new_lines = new.lines(1, 200)
+        diff = list(difflib.unified_diff(old_lines, new_lines, lineterm=""))
         diff_preview = "\n".join(diff[:200])
         return {"status": "ok", "diff_preview": diff_preview}
 
-    def find_text(self, source_or_key: str, query: str, max_results: int = 50) -> Dict[str, Any]:
-        """Return occurrences (line numbers + small context) for query string or regex."""
-        content = self._resolve(source_or_key)
-        if not content:
+    def find_text(self, source_or_key: str, query: str, max_results: int = 50, cursor: Optional[str] = None) -> Dict[str, Any]:
+        """
+        Return occurrences (line/column + small context) for query string or regex.
+        Pass the returned next_cursor back to continue past max_results.
+        """
+        if source_or_key in self.projects:
+            return self.search_files(query, self.projects[source_or_key]["files"], max_results, cursor)
+        buf = self._text_buffer(source_or_key)
+        if not len(buf):
             return {"status": "error", "message": "No content"}
-        lines = content.splitlines()
-        results = []
+        key = source_or_key if source_or_key in self.store else ""
+        return self._search_buffers([(key, buf)], query, max_results, cursor)
+
+    def search_files(self, query: str, file_keys: Optional[List[str]] = None, max_results: int = 50,
+                     cursor: Optional[str] = None, session: str = "") -> Dict[str, Any]:
+        """Search the given file_keys (default: every file of the session) in one call, with cursor pagination."""
+        if not file_keys:
+            file_keys = sorted(k for k, v in self.store.items() if v.get("session", "") == session)
+        keys = [k for k in file_keys if k in self.store]
+        if not keys:
+            return {"status": "error", "message": "No content"}
+        return self._search_buffers([(k, self.store[k]["content"]) for k in keys], query, max_results, cursor)
+
+    def _search_buffers(self, buffers: List[Tuple[str, SegmentedText]], query: str, max_results: int, cursor: Optional[str]) -> Dict[str, Any]:
         pattern = None
         is_regex = False
         try:
-            pattern = re.compile(query)
+            pattern = re.compile(query, re.MULTILINE)
             is_regex = True
         except re.error:
             pattern = None
             is_regex = False
+        literal = _required_literal(pattern) if is_regex else query
+        after_key, after_line, after_col = None, 0, 0
+        if cursor:
+            try:
+                after_key, after_line, after_col = json.loads(base64.urlsafe_b64decode(cursor.encode()).decode())
+            except Exception:
+                return {"status": "error", "message": "Invalid cursor"}
 
-        for idx, line in enumerate(lines, start=1):
-            if is_regex:
-                if pattern.search(line):
-                    results.append({"line": idx, "text": line.strip()})
+        results = []
+        next_cursor = None
+        skipping = after_key is not None
+        for key, buf in buffers:
+            if skipping:
+                if key != after_key:
+                    continue
+                skipping = False
+                first_line = after_line
             else:
-                if query in line:
-                    results.append({"line": idx, "text": line.strip()})
-            if len(results) >= max_results:
+                first_line, after_col = 1, 0
+            for line, col, end_col, text in self._iter_matches(buf, pattern, query, literal, first_line):
+                if line == first_line and col <= after_col:
+                    continue
+                if len(results) >= max_results:
+                    last = results[-1]
+                    next_cursor = base64.urlsafe_b64encode(json.dumps([last.get("file_key", ""), last["line"], last["column"]]).encode()).decode()
+                    break
+                hit = {"line": line, "column": col, "end_column": end_col, "text": text}
+                if key:
+                    hit["file_key"] = key
+                results.append(hit)
+            if next_cursor:
                 break
-        return {"status": "ok", "occurrences": len(results), "results": results}
+        return {"status": "ok", "occurrences": len(results), "results": results, "next_cursor": next_cursor}
+
+    def _iter_matches(self, buf: SegmentedText, pattern, query: str, literal: Optional[str], first_line: int = 1):
+        """
+        Yield (line, column, end_column, stripped line text) per match, 1-based columns.
+        The trigram index limits the scan to candidate line blocks; inside them the text is
+        searched in C and hits are mapped back to lines, matching each line on its own.
+        """
+        index = buf.trigram_index()
+        if pattern is None and "\n" in query:
+            return
+        content = buf.text()
+        for first, last in index.candidate_lines(literal):
+            if last < first_line:
+                continue
+            first = max(first, first_line)
+            pos = buf.line_bounds(first)[0]
+            end = buf.line_bounds(last)[1]
+            while pos <= end:
+                if pattern is not None:
+                    m = pattern.search(content, pos, end)
+                    hit = m.start() if m else -1
+                else:
+                    hit = content.find(query, pos, end)
+                if hit < 0:
+                    break
+                line = buf.line_of(hit)
+                start, line_end = buf.line_bounds(line)
+                text = None
+                if pattern is not None:
+                    spans = [mm.span() for mm in pattern.finditer(content, start, line_end)]
+                else:
+                    spans = []
+                    at = content.find(query, start, line_end)
+                    while at >= 0:
+                        spans.append((at, at + len(query)))
+                        at = content.find(query, at + max(1, len(query)), line_end)
+                for ms, me in spans:
+                    if text is None:
+                        text = content[start:line_end].strip()
+                    yield line, ms - start + 1, me - start + 1, text
+                pos = line_end + 1
 
     # -----------------------------
     # Syntax highlighting (backend HTML)
     # -----------------------------
-    def highlight_code(self, source_or_key: str) -> Dict[str, Any]:
-        """Return a simple HTML highlighted version of the code (not exhaustive)."""
-        code = self._resolve(source_or_key)
+    HIGHLIGHT_STYLES = (
+        "<style>"
+        ".kw{color:#d73a49;font-weight:600} "
+        ".comment{color:#6a9955} "
+        ".str{color:#032f62} "
+        ".num{color:#005cc5} "
+        "pre{white-space:pre-wrap;font-family:Consolas,monospace;background:#0b0b0b;color:#cfd0d1;padding:12px;border-radius:6px}"
+        "</style>"
+    )
+
+    def highlight_code(self, source_or_key: str, start_line: Optional[int] = None, end_line: Optional[int] = None) -> Dict[str, Any]:
+        """Return a simple HTML highlighted version of the code (or of a line range of it)."""
+        code, cache = self._artifacts(source_or_key)
         if not code:
             return {"status": "error", "html": ""}
 
-        html = self._highlight_syntax(code)
-        # cache if key
-        if source_or_key in self.store:
-            self.store[source_or_key]["highlight_html"] = html
-        return {"status": "ok", "html": html}
+        if start_line is None and end_line is None:
+            html = self._cached(cache, "highlight_html", lambda: "".join(self.iter_highlight_html(source_or_key)))
+            return {"status": "ok", "html": html}
+        first = max(1, int(start_line or 1))
+        last = int(end_line) if end_line else first + 199
+        html = "".join(self.iter_highlight_html(source_or_key, first, last))
+        return {"status": "ok", "html": html, "start_line": first, "end_line": last}
+
+    HIGHLIGHT_CLASS_NAMES = ("kw", "comment", "str", "num")
 
-    def _highlight_syntax(self, code: str) -> str:
+    def highlight_runs(self, source_or_key: str, start_line: Optional[int] = None, end_line: Optional[int] = None,
+                       binary: bool = False) -> Dict[str, Any]:
         """
-        Very small syntax highlighter for Verilog-like code.
-        Returns HTML string with <span class="kw">..</span> etc.
+        Highlighting as editor decorations instead of HTML: per line a flat [column, length, class, ...]
+        list, class being an index into "classes". With binary=True, "data" holds little-endian integers
+        ("dtype" uint16, or uint32 when a value needs it): line count, then per line its run count
+        followed by the (column, length, class) triples.
         """
-        # escape HTML
+        code, _ = self._artifacts(source_or_key)
+        if not code:
+            return {"status": "error", "message": "No code provided"}
+        # same line numbering as get_lines(): a trailing empty line after "\n\n" is a line of its own
+        total = self._text_buffer(source_or_key).line_count()
+        first = max(1, int(start_line or 1))
+        last = min(total, int(end_line)) if end_line else total
+        index = {name: i for i, name in enumerate(self.HIGHLIGHT_CLASS_NAMES)}
+        lines = []
+        for _, _, runs in self.iter_line_classes(source_or_key, first, last):
+            lines.append([v for col, length, cls in runs for v in (col, length, index[cls])])
+        res = {"status": "ok", "classes": list(self.HIGHLIGHT_CLASS_NAMES), "start_line": first,
+               "end_line": first + len(lines) - 1, "total_lines": total}
+        if not binary:
+            res["lines"] = lines
+            return res
+        packed = array("I", [len(lines)])
+        for flat in lines:
+            packed.append(len(flat) // 3)
+            packed.extend(flat)
+        if max(packed) < 1 << 16:
+            packed = array("H", packed)
+        if sys.byteorder == "big":
+            packed.byteswap()
+        res["dtype"] = "uint16" if packed.typecode == "H" else "uint32"
+        res["data"] = packed.tobytes()
+        return res
+
+    def iter_highlight_html(self, source_or_key: str, start_line: int = 1, end_line: Optional[int] = None, block: int = 500):
+        """The highlighted HTML document in pieces of `block` lines, for streaming responses."""
+        yield f"{self.HIGHLIGHT_STYLES}<pre>"
+        out = []
+        first = True
+        line = None
+        for _, line, runs in self.iter_line_classes(source_or_key, start_line, end_line):
+            if not first:
+                out.append("\n")
+            first = False
+            out.append(self._render_line(line, runs))
+            if len(out) >= 2 * block:
+                yield "".join(out)
+                out = []
+        if line == "":
+            # <pre> swallows one trailing newline, which would hide a final empty line
+            out.append("\n")
+        out.append("</pre>")
+        yield "".join(out)
+
+    @staticmethod
+    def _render_line(line: str, runs: Tuple[Tuple[int, int, str], ...]) -> str:
         esc = lambda s: (s.replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;"))
-
-        # simple tokenization: comments, strings, keywords, numbers
-        # 1) protect multiline comments and single-line
-        code_escaped = esc(code)
-
-        # mark multiline comments
-        code_escaped = re.sub(r'(/\*.*?\*/)', r'<span class="comment">\1</span>', code_escaped, flags=re.DOTALL)
-        # single line comments
-        code_escaped = re.sub(r'(//.*?$)', r'<span class="comment">\1</span>', code_escaped, flags=re.MULTILINE)
-
-        # strings
-        code_escaped = re.sub(r'(\".*?\")', r'<span class="str">\1</span>', code_escaped)
-
-        # keywords (a small set)
-        keywords = r'\b(module|endmodule|input|output|inout|wire|reg|logic|always|assign|if|else|begin|end|parameter|module)\b'
-        code_escaped = re.sub(keywords, r'<span class="kw">\1</span>', code_escaped)
-
-        # numbers
-        code_escaped = re.sub(r'\b(\d+\'[bdhBDH]?[0-9a-fA-FxXzZ_]+|\d+)\b', r'<span class="num">\1</span>', code_escaped)
-
-        # wrap in pre
-        styles = (
-            "<style>"
-            ".kw{color:#d73a49;font-weight:600} "
-            ".comment{color:#6a9955} "
-            ".str{color:#032f62} "
-            ".num{color:#005cc5} "
-            "pre{white-space:pre-wrap;font-family:Consolas,monospace;background:#0b0b0b;color:#cfd0d1;padding:12px;border-radius:6px}"
-            "</style>"
-        )
-        html = f"{styles}<pre>{code_escaped}</pre>"
-        return html
+        parts = []
+        last = 0
+        for col, length, cls in runs:
+            if col > last:
+                parts.append(esc(line[last:col]))
+            parts.append(f'<span class="{cls}">{esc(line[col:col + length])}</span>')
+            last = col + length
+        parts.append(esc(line[last:]))
+        return "".join(parts)
+
+    def iter_line_classes(self, source_or_key: str, start_line: int = 1, end_line: Optional[int] = None, block: int = 2000):
+        """
+        Yield (line number, text, runs) for start_line..end_line, runs being (column, length, class).
+        Runs are memoized per (line text, starts-in-comment) on the stored file and survive edits,
+        so after an edit only changed lines (or lines whose comment state changed) are re-lexed.
+        The walk starts at the buffer's nearest comment-state checkpoint at or before start_line
+        and records new checkpoints as it passes them; edits drop the ones past the changed line.
+        """
+        buf = self._text_buffer(source_or_key)
+        total = buf.line_count()
+        last = total if end_line is None else min(int(end_line), total)
+        if source_or_key and source_or_key in self.store:
+            item = self.store[source_or_key]
+            memo = item.get("line_classes") or {}
+        else:
+            item, memo = None, {}
+        seen: Dict[Tuple[str, bool], Any] = {}
+        checkpoints, every = buf.comment_checkpoints, buf.COMMENT_CHECKPOINT_LINES
+        k = min((max(1, int(start_line)) - 1) // every, len(checkpoints) - 1)
+        state = checkpoints[k]
+        no = first = k * every
+        while no < last:
+            for line in buf.lines(no + 1, min(no + block, last)):
+                if no % every == 0 and no // every == len(checkpoints):
+                    checkpoints.append(state)
+                no += 1
+                key = (line, state)
+                hit = seen.get(key) or memo.get(key)
+                if hit is None:
+                    hit = _line_runs(line, state)
+                seen[key] = hit
+                runs, state = hit
+                if no >= start_line:
+                    yield no, line, runs
+        if item is not None:
+            # a full walk replaces the memo (dropping lines that no longer exist); a partial one adds to it
+            if first == 0 and last >= total:
+                item["line_classes"] = seen
+            else:
+                memo.update(seen)
+                item["line_classes"] = memo
 
     # -----------------------------
     # Internal parsing functions (adapted)
     # -----------------------------
-    def _fast_extract_modules_optimized(self, code: str) -> List[Dict[str, str]]:
-        modules = []
-        lines = code.splitlines()
-        n = len(lines)
-        MAX_LINES = 200000
-        if n > MAX_LINES:
-            lines = lines[:MAX_LINES]
-            n = MAX_LINES
-        inside = False
-        buf = []
-        name = ""
-        module_count = 0
-        MAX_MODULES = 500
-        for i, line in enumerate(lines):
-            stripped = line.strip()
-            if not inside and stripped.startswith("module"):
-                inside = True
-                buf = [line]
-                m = re.match(r"module\s+(\w+)", stripped)
-                name = m.group(1) if m else "unknown"
-                continue
-            if inside:
-                buf.append(line)
-                if stripped.startswith("endmodule"):
-                    inside = False
-                    modules.append({"name": name, "text": "\n".join(buf)})
-                    module_count += 1
-                    buf = []
-                    name = ""
-                    if module_count >= MAX_MODULES:
-                        break
-        return modules
-
-    def _generate_explanation_optimized(self, code: str, modules: List[Dict[str, str]]) -> str:
+    def _parse(self, code: str) -> VerilogParse:
+        """Lex code once; repeated calls on the same content reuse the previous parse."""
+        last = self._last_parse
+        if last is not None and last.code == code:
+            return last
+        self._last_parse = VerilogParse.parallel(code)
+        return self._last_parse
+
+    def _fast_extract_modules_optimized(self, code: str, parse: Optional[VerilogParse] = None) -> List[ModuleRecord]:
+        parse = parse or self._parse(code)
+        return list(parse.modules)
+
+    def _generate_explanation_optimized(self, code: str, modules: List[ModuleRecord], parse: Optional[VerilogParse] = None, hier: Optional[HierarchyIndex] = None) -> str:
+        parse = parse or self._parse(code)
+        hier = hier or HierarchyIndex(parse.modules)
         lines = []
         lines.append(f"EXPLANATION GENERATED: {datetime.utcnow().isoformat()}")
         lines.append("=" * 60)
@@ -1030,16 +4374,17 @@ class VerilogBackend:
         lines.append("")
         module_data = []
         for idx, mod in enumerate(modules):
-            text = mod["text"]
-            insts = re.findall(r'\b(\w+)\s+(\w+)\s*\(', text[:50000])
-            header_match = re.search(r'\((.*?)\);', text[:2000], flags=re.DOTALL)
-            port_block = header_match.group(1) if header_match else ""
-            inputs = len(re.findall(r'\binput\b', port_block))
-            outputs = len(re.findall(r'\boutput\b', port_block))
-            inouts = len(re.findall(r'\binout\b', port_block))
-            module_data.append({"name": mod["name"], "inputs": inputs, "outputs": outputs, "inouts": inouts, "instances": insts[:10], "instance_count": len(insts)})
+            # per-module summaries live on the module record, so modules untouched by an edit keep theirs
+            if "summary" not in mod:
+                insts = [inst[:2] for inst in mod["instances"][:10]]
+                port_words = [t[1] for t in parse.span_tokens(mod, "ports_span") if t[0] == "ident"]
+                inputs = port_words.count("input")
+                outputs = port_words.count("output")
+                inouts = port_words.count("inout")
+                mod["summary"] = {"name": mod["name"], "inputs": inputs, "outputs": outputs, "inouts": inouts, "instances": insts, "instance_count": len(mod["instances"])}
+            module_data.append(mod["summary"])
         if module_data:
-            top = max(module_data, key=lambda x: x["instance_count"])
+            top = next((m for m in module_data if m["name"] == hier.top), None) or max(module_data, key=lambda x: x["instance_count"])
             lines.append(f"TOP MODULE: {top['name']}")
             lines.append(f"Instances inside: {top['instance_count']}")
             lines.append("")
@@ -1055,41 +4400,52 @@ class VerilogBackend:
                 lines.append(f"      - {inst[0]} {inst[1]}")
             lines.append("")
         # simple metrics
-        sample = code[:100000]
-        always_count = len(re.findall(r'always\s*@', sample))
-        assign_count = len(re.findall(r'\bassign\b', sample))
-        total = len(code.splitlines())
         lines.append("DESIGN METRICS:")
-        lines.append(f"  Total lines: {total}")
-        lines.append(f"  always@* (sampled):   {always_count}")
-        lines.append(f"  assign (sampled):     {assign_count}")
+        lines.append(f"  Total lines: {parse.line_count}")
+        lines.append(f"  always@*:    {len(parse.always_offsets)}")
+        lines.append(f"  assign:      {len(parse.assign_offsets)}")
         return "\n".join(lines)
 
     # Reuse the comprehensive builders from earlier adapted versions
-    def _extract_detailed_module_info(self, code: str) -> Optional[Dict[str, Any]]:
-        cleaned = re.sub(r"//.*?$", "", code, flags=re.MULTILINE)
-        cleaned = re.sub(r"/\*.*?\*/", "", cleaned, flags=re.DOTALL)
-        cleaned = cleaned.replace("\r", " ")
-        module_pat = re.compile(
-            r"module\s+(\w+)\s*"
-            r"(#\s*\((.*?)\))?\s*"
-            r"\((.*?)\)\s*;",
-            re.DOTALL | re.MULTILINE
-        )
-        m = module_pat.search(cleaned)
-        if not m:
-            return None
-        module_name = m.group(1)
-        param_block = m.group(3) or ""
-        port_block = m.group(4) or ""
+    def _extract_detailed_module_info(self, code: str, parse: Optional[VerilogParse] = None, module: Optional[str] = None) -> Optional[Dict[str, Any]]:
+        parse = parse or self._parse(code)
+        return self._select_module_info(self._extract_module_infos(parse), module)
+
+    @staticmethod
+    def _select_module_info(infos: Dict[str, Dict[str, Any]], module: Optional[str] = None) -> Optional[Dict[str, Any]]:
+        """The requested module, else the first one that has ports."""
+        if module:
+            return infos.get(module)
+        return next((i for i in infos.values() if i["inputs"] or i["outputs"] or i["inouts"]), None) \
+            or next(iter(infos.values()), None)
+
+    def _extract_module_infos(self, parse: VerilogParse) -> Dict[str, Dict[str, Any]]:
+        """Info for every module in one pass over the parse, keyed by name (first definition wins)."""
+        infos = {}
+        for m in parse.modules:
+            if m["name"] not in infos:
+                infos[m["name"]] = self._module_info(parse, m)
+        return infos
+
+    def _module_info(self, parse: VerilogParse, m: ModuleRecord) -> Dict[str, Any]:
+        module_name = m["name"]
         info = {"module_name": module_name, "parameters": [], "inputs": [], "outputs": [], "inouts": [], "clock": None, "reset": None, "addr_width": None, "data_width": None, "optional_apb": {"slverr": False, "pstrb": False, "pprot": False}}
-        # params
-        for pm in re.finditer(r"parameter\s+(?:\w+\s+)?(\w+)\s*=\s*([^, )\n]+)", param_block, re.IGNORECASE):
-            info["parameters"].append({"name": pm.group(1).strip(), "value": pm.group(2).strip()})
-        # ports via parse helper
-        info["inputs"] = self._parse_port_list(port_block, "input")
-        info["outputs"] = self._parse_port_list(port_block, "output")
-        info["inouts"] = self._parse_port_list(port_block, "inout")
+        # params: header #( ... ) list, then body `parameter` declarations (non-ANSI style)
+        pieces = _split_top_level(parse.span_tokens(m, "params_span"))
+        for _, decl in parse.declarations(m, ("parameter",)):
+            pieces.extend(_split_top_level(decl))
+        for piece in pieces:
+            texts = [t[1] for t in piece]
+            if "=" not in texts:
+                continue
+            eq = texts.index("=")
+            names = [t[1] for t in piece[:eq] if t[0] == "ident" and t[1] not in VERILOG_KEYWORDS]
+            if names:
+                info["parameters"].append({"name": names[-1], "value": "".join(texts[eq + 1:])})
+        ports = self._module_ports(parse, m)
+        info["inputs"] = ports["input"]
+        info["outputs"] = ports["output"]
+        info["inouts"] = ports["inout"]
         all_ports = info["inputs"] + info["outputs"] + info["inouts"]
         for p in all_ports:
             low = p["name"].lower()
@@ -1098,73 +4454,79 @@ class VerilogBackend:
             if any(k in low for k in ["resetn", "presetn", "rst_n", "reset", "rst"]) and not info["reset"]:
                 info["reset"] = p["name"]
         # widths from parameters
+        env = parse.param_env(m)
         for prm in info["parameters"]:
             ln = prm["name"].lower()
-            try:
-                val = int(eval(prm["value"]))
-            except Exception:
-                val = None
+            val = env.values.get(prm["name"])
             if val is None:
                 continue
             if "addr" in ln:
                 info["addr_width"] = val
             if "data" in ln:
                 info["data_width"] = val
-        low = cleaned.lower()
-        info["optional_apb"]["slverr"] = bool(re.search(r"\bpslverr\b", low))
-        info["optional_apb"]["pstrb"] = bool(re.search(r"\bpstrb\b", low))
-        info["optional_apb"]["pprot"] = bool(re.search(r"\bpprot\b", low))
-        info["is_sequential"] = bool(re.search(r"always\s*@\s*\(.*posedge", cleaned))
-        info["has_fsm"] = bool(re.search(r"\b(case|unique\s+case)\b", cleaned))
+        idents = parse.module_identifiers(m)
+        info["optional_apb"]["slverr"] = "pslverr" in idents
+        info["optional_apb"]["pstrb"] = "pstrb" in idents
+        info["optional_apb"]["pprot"] = "pprot" in idents
+        info["is_sequential"] = m["posedge_always"]
+        info["has_fsm"] = m["has_case"]
         return info
 
-    def _parse_port_list(self, ports_str: str, direction: str) -> List[Dict[str, Any]]:
-        text = ports_str or ""
-        text = re.sub(r"//.*?$", "", text, flags=re.MULTILINE)
-        text = re.sub(r"/\*.*?\*/", "", text, flags=re.DOTALL)
-        parts, cur, depth = [], "", 0
-        for ch in text:
-            if ch in "[{(":
-                depth += 1
-            elif ch in "]})":
-                depth -= 1 if depth > 0 else 0
-            if ch == "," and depth == 0:
-                if cur.strip():
-                    parts.append(cur.strip())
-                cur = ""
-            else:
-                cur += ch
-        if cur.strip():
-            parts.append(cur.strip())
+    def _module_ports(self, parse: VerilogParse, m: ModuleRecord, env: Optional[ConstEnv] = None) -> Dict[str, List[Dict[str, Any]]]:
+        """Ports of one module by direction, from an ANSI header or from body input/output declarations; env defaults to its own parameters."""
+        header = parse.span_tokens(m, "ports_span")
+        env = env or parse.param_env(m)
+        ports = {d: self._parse_port_list(header, d, env) for d in PORT_DIRECTIONS}
+        if any(ports.values()):
+            return ports
+        # non-ANSI: the header only names the ports, directions and ranges are declared in the body
+        order = {name: i for i, name in enumerate(parse.declared_names(header))}
+        for kind, decl in parse.declarations(m, PORT_DIRECTIONS):
+            ports[kind].extend(self._parse_port_list([("ident", kind, -1)] + decl, kind, env))
+        for d in PORT_DIRECTIONS:
+            ports[d].sort(key=lambda p: order.get(p["name"], len(order)))
+        return ports
+
+    def _parse_port_list(self, port_tokens: List[Tuple[str, str, int]], direction: str, env: Optional[ConstEnv] = None) -> List[Dict[str, Any]]:
+        """Ports of one direction from the tokens between a module header's parentheses."""
         results = []
-        dir_re = r"\b(input|output|inout)\b"
-        last_prefix = None
-        name_only_pat = re.compile(r"^\s*(\w+)\s*(\[[^\]]+\])?\s*$", flags=re.IGNORECASE)
-        for raw in parts:
-            piece = raw.strip()
-            has_direction = re.search(dir_re, piece) is not None
-            if has_direction:
-                last_prefix = piece
-                explicit_dir = re.search(dir_re, piece, flags=re.IGNORECASE).group(1).lower()
-                if explicit_dir != direction:
+        last_dir = None
+        last_range = ""
+        for piece in _split_top_level(port_tokens):
+            # walk the declaration at bracket depth 0: [direction] [type] [range] name [unpacked]
+            words, ranges = [], {}
+            k = 0
+            while k < len(piece):
+                kind, text, _ = piece[k]
+                if text == "[" or text == "(":
+                    close = _match_close(piece, k)
+                    if text == "[":
+                        ranges[len(words)] = "".join(t[1] for t in piece[k:close + 1])
+                    k = close + 1
                     continue
-                to_parse = piece
-            else:
-                if not last_prefix:
-                    continue
-                if not last_prefix.lower().startswith(direction):
-                    continue
-                to_parse = last_prefix + " " + piece
-            mo = name_only_pat.search(to_parse)
-            if mo:
-                name = mo.group(1)
-                rngs = re.findall(r"\[[^\]]+\]", to_parse)
-                packed = rngs[-1] if rngs else ""
-                w = self._width_from_range(packed)
-                results.append({"name": name, "width": w, "is_bus": w > 1, "range": packed})
+                if kind in ("ident", "escid"):
+                    words.append(text)
+                k += 1
+            if not words:
+                continue
+            if words[0] in PORT_DIRECTIONS:
+                last_dir = words[0]
+                last_range = ""
+            if last_dir != direction:
+                continue
+            names = [(idx, w) for idx, w in enumerate(words) if w not in VERILOG_KEYWORDS]
+            if not names:
+                continue
+            idx, name = names[-1]
+            if idx in ranges:
+                last_range = ranges[idx]
+            w = self._width_from_range(last_range, env)
+            results.append({"name": name, "width": w, "is_bus": w > 1, "range": last_range})
         return results
 
-    def _width_from_range(self, rng: str) -> int:
+    def _width_from_range(self, rng: str, env: Optional[ConstEnv] = None) -> int:
+        if env is not None:
+            return env.width(rng)
         m = re.match(r"\[\s*(\d+)\s*:\s*(\d+)\s*\]", rng or "")
         if not m:
             return 1
@@ -1235,14 +4597,62 @@ class VerilogBackend:
         lines.append(self._build_uvm_testbench(info))
         return "\n".join(lines)
 
-    def _detect_apb_protocol(self, sample: str) -> Tuple[bool, Dict[str, str]]:
-        low = (sample or "").lower()
-        want = ["paddr", "psel", "pwrite", "pwdata", "prdata"]
-        signals = {}
-        found = False
-        for w in want:
-            if re.search(rf"\b{w}\b", low):
-                signals[w] = w
-                found = True
-        return found, signals
+    def _detect_protocols(self, parse: VerilogParse) -> Dict[str, Dict[str, Any]]:
+        """
+        Bus protocols per module. The identifiers of all modules are fed through one Aho-Corasick
+        automaton ('_' + name + '_' against '_' + signal + '_'), then each module's tokens are walked
+        once to locate the first use of every matched identifier.
+        """
+        matcher = _protocol_matcher()
+        hits_by_ident: Dict[str, List[str]] = {}
+        for m in parse.modules:
+            for ident in parse.module_identifiers(m):
+                if ident not in hits_by_ident:
+                    hits_by_ident[ident] = [pat[1:-1] for _, pat in matcher.find(f"_{ident}_")]
+        result = {}
+        for m in parse.modules:
+            if m["name"] in result:
+                continue
+            where: Dict[str, Dict[str, Any]] = {}
+            # tokens come in source order, so count newlines incrementally from the previous hit
+            line, last = m["line"], m["start"]
+            for kind, text, pos in parse.module_tokens(m):
+                if kind == "ident" and hits_by_ident.get(text.lower()) and text not in where:
+                    line += parse.code.count("\n", last, pos)
+                    last = pos
+                    where[text] = {"name": text, "line": line, "offset": pos}
+            by_signal: Dict[str, List[Dict[str, Any]]] = {}
+            for text, loc in where.items():
+                for sig in hits_by_ident[text.lower()]:
+                    by_signal.setdefault(sig, []).append(loc)
+            found = []
+            for proto, spec in PROTOCOL_SIGNATURES.items():
+                if not all(r in by_signal for r in spec["required"]):
+                    continue
+                core = [s for s in spec["core"] if s in by_signal]
+                score = len(core) / len(spec["core"])
+                if score < PROTOCOL_MIN_SCORE and not any(s in by_signal for s in spec.get("sufficient", ())):
+                    continue
+                names = [s for s in spec["core"] + spec["optional"] if s in by_signal]
+                if proto == "axi4" and not _AXI4_BURST_SIGNALS & set(names):
+                    proto = "axi4_lite"
+                found.append({"protocol": proto, "score": round(score, 3),
+                              "signals": {s: by_signal[s] for s in names},
+                              "missing": [s for s in spec["core"] if s not in by_signal]})
+            found.sort(key=lambda p: -p["score"])
+            result[m["name"]] = found
+        return result
+
+    def detect_protocols(self, source_or_key: Optional[str] = None, session: str = "") -> Dict[str, Any]:
+        """Bus interfaces (APB, AHB, AXI4 / AXI4-Lite, AXI-Stream, Wishbone) per module, with match locations."""
+        source_or_key = source_or_key or self._latest_key(session)
+        if not source_or_key:
+            return {"status": "error", "message": "No code provided", "modules": {}}
+        code, cache = self._artifacts(source_or_key)
+        parse = self._file_parse(source_or_key, code, cache)
+        per_module = self._cached(cache, "protocols", lambda: self._detect_protocols(parse))
+        if not per_module:
+            return {"status": "error", "message": "No modules found", "modules": {}}
+        detected = sorted({p["protocol"] for found in per_module.values() for p in found})
+        return {"status": "ok", "protocols": detected, "modules": per_module}
 
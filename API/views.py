@@ -4,7 +4,7 @@ from rest_framework.parsers import MultiPartParser, FormParser
 from rest_framework import status
 from rest_framework.exceptions import ValidationError
 from .utils import *
-from django.http import FileResponse, JsonResponse, HttpResponse
+from django.http import FileResponse, JsonResponse, HttpResponse, StreamingHttpResponse
 from django.shortcuts import render
 import base64
 import os
@@ -17,6 +17,7 @@ from rest_framework.exceptions import ValidationError
 from bson import ObjectId
 from datetime import datetime
 import re
+import json
 import shutil
 import tempfile
 import subprocess
@@ -34,85 +35,42 @@ class UvmRalGeneratorView(APIView):
     parser_classes = (MultiPartParser, FormParser)
 
     def post(self, request):
-        # Get the uploaded Excel file from the request
+        # Get the uploaded register map (Excel, CSV, JSON or IP-XACT) from the request
         excel_file = request.FILES.get('file')
 
         if not excel_file:
             return Response({"error": "No file provided"}, status=status.HTTP_400_BAD_REQUEST)
 
-        # Define temporary paths for the input and output files
-        excel_file_path = f"/tmp/{excel_file.name}"
-        output_file = "/tmp/uvm_ral_model.sv"
-
-        # Save the uploaded file to a temporary location
+        # Rendered in memory straight from the upload, or served from the RAL cache
         try:
-            with open(excel_file_path, 'wb') as f:
-                for chunk in excel_file.chunks():
-                    f.write(chunk)
-
-            # Call the function to generate the .sv file
-            try:
-                excel_to_uvm_ral(excel_file_path, output_file)
-            except Exception as e:
-                return Response({"error": f"Error generating .sv file: {str(e)}"}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
-        finally:
-            # Clean up the uploaded file
-            if os.path.exists(excel_file_path):
-                os.remove(excel_file_path)
-
-        # Return the generated .sv file as a response
-        if os.path.exists(output_file):
-            response = FileResponse(open(output_file, 'rb'), as_attachment=True, filename="uvm_ral_model.sv")
-            # Clean up the output file after returning it
-            response["file-cleanup-path"] = output_file  # Adding metadata for cleanup
-            return response
-        else:
-            return Response({"error": "Failed to generate .sv file"}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+            chunks, hit = cached_uvm_ral(excel_file)
+        except Exception as e:
+            return Response({"error": f"Error generating .sv file: {str(e)}"}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+        # Stream the generated .sv file as a download
+        response = StreamingHttpResponse(chunks, content_type="text/plain")
+        response["Content-Disposition"] = 'attachment; filename="uvm_ral_model.sv"'
+        response["X-RAL-Cache"] = "hit" if hit else "miss"
+        return response
 
 
 class UvmRalGeneratorbase64View(APIView):
     parser_classes = (MultiPartParser, FormParser)
 
     def post(self, request):
-        # Get the uploaded Excel file from the request
+        # Get the uploaded register map (Excel, CSV, JSON or IP-XACT) from the request
         excel_file = request.FILES.get('file')
 
         if not excel_file:
             return Response({"error": "No file provided"}, status=status.HTTP_400_BAD_REQUEST)
 
-        # Define temporary paths for the input and output files
-        excel_file_path = f"/tmp/{excel_file.name}"
-        output_file = "/tmp/uvm_ral_model.sv"
-
-        # Save the uploaded file to a temporary location
+        # Return the generated .sv file as a Base64-encoded string, encoded chunk by chunk
         try:
-            with open(excel_file_path, 'wb') as f:
-                for chunk in excel_file.chunks():
-                    f.write(chunk)
-
-            # Call the function to generate the .sv file
-            try:
-                excel_to_uvm_ral(excel_file_path, output_file)
-            except Exception as e:
-                return Response({"error": f"Error generating .sv file: {str(e)}"}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
-        finally:
-            # Clean up the uploaded file
-            if os.path.exists(excel_file_path):
-                os.remove(excel_file_path)
-
-        # Return the generated .sv file as a Base64-encoded string
-        if os.path.exists(output_file):
-            try:
-                with open(output_file, 'rb') as f:
-                    file_content = f.read()
-                    base64_encoded_content = base64.b64encode(file_content).decode('utf-8')
-                # Clean up the output file after encoding
-                os.remove(output_file)
-                return Response({"file": base64_encoded_content}, status=status.HTTP_200_OK)
-            except Exception as e:
-                return Response({"error": f"Error encoding file to Base64: {str(e)}"}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
-        else:
-            return Response({"error": "Failed to generate .sv file"}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+            base64_encoded_content, hit = cached_uvm_ral_base64(excel_file)
+        except Exception as e:
+            return Response({"error": f"Error generating .sv file: {str(e)}"}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+        return Response({"file": base64_encoded_content}, status=status.HTTP_200_OK,
+                        headers={"X-RAL-Cache": "hit" if hit else "miss"})
 
 class DrawSystemBlockAPIView(APIView):
     def post(self, request):
@@ -428,6 +386,26 @@ class MermaidCircuitAPIView(APIView):
 
 backend = VerilogBackend()  # single instance for app lifetime
 
+
+def _session_id(request) -> str:
+    """
+    Namespace for stored files: explicit session_id / X-Session-Id, else the Django session,
+    which is created on first use so anonymous clients do not all share the "" namespace.
+    "" only when neither is available (no session middleware).
+    """
+    sid = request.data.get("session_id") or request.query_params.get("session_id") or request.headers.get("X-Session-Id")
+    if not sid:
+        session = getattr(request, "session", None)
+        if session is not None and not session.session_key:
+            session.create()
+        sid = getattr(session, "session_key", None)
+    return sid or ""
+
+
+def _unknown_file_key(file_key) -> Response:
+    """404 for a file_key no worker has stored, instead of reading the key string as Verilog code."""
+    return Response({"status": "error", "message": f"Unknown file_key: {file_key}"}, status=status.HTTP_404_NOT_FOUND)
+
 class UploadFileView(APIView):
     parser_classes = (MultiPartParser, FormParser)
 
@@ -435,14 +413,34 @@ class UploadFileView(APIView):
         f = request.FILES.get("file")
         if not f:
             return Response({"status": "error", "message": "No file provided (field 'file')"}, status=status.HTTP_400_BAD_REQUEST)
-        key = backend.save_uploaded_file(f.name, f.read())
+        key = backend.save_uploaded_file(f.name, f.read(), session=_session_id(request))
         preview = backend.get_saved_file(key)[:1000] if backend.get_saved_file(key) else ""
         return Response({"status": "ok", "file_key": key, "filename": f.name, "preview": preview}, status=status.HTTP_201_CREATED)
 
+class UploadFolderView(APIView):
+    parser_classes = (MultiPartParser, FormParser)
+
+    def post(self, request, *args, **kwargs):
+        files = request.FILES.getlist("files") or request.FILES.getlist("file")
+        if not files:
+            return Response({"status": "error", "message": "No files provided (field 'files')"}, status=status.HTTP_400_BAD_REQUEST)
+        # multipart file names lose their directories, so relative paths come in a parallel "paths" field
+        paths = request.data.getlist("paths") or request.data.getlist("paths[]") or [f.name for f in files]
+        if len(paths) != len(files):
+            return Response({"status": "error", "message": "'paths' must list one relative path per file"},
+                            status=status.HTTP_400_BAD_REQUEST)
+        top_dir = paths[0].replace("\\", "/").lstrip("/").split("/")
+        name = request.data.get("project_name", "") or (top_dir[0] if len(top_dir) > 1 else "") or "design"
+        res = backend.save_project(name, [(p, f.read()) for p, f in zip(paths, files)], session=_session_id(request))
+        status_code = status.HTTP_201_CREATED if res.get("status") == "ok" else status.HTTP_400_BAD_REQUEST
+        return Response(res, status=status_code)
+
 class ExplainCodeView(APIView):
     def post(self, request, *args, **kwargs):
         file_key = request.data.get("file_key", "")
         code = request.data.get("code", "")
+        if file_key and not backend.has_source(file_key):
+            return _unknown_file_key(file_key)
         src = file_key or code
         res = backend.explain_code(src)
         status_code = status.HTTP_200_OK if res.get("status") == "ok" else status.HTTP_400_BAD_REQUEST
@@ -453,8 +451,10 @@ class GenerateTestbenchView(APIView):
         file_key = request.data.get("file_key", "")
         code = request.data.get("code", "")
         mode = request.query_params.get("mode", "auto")
+        if file_key and not backend.has_source(file_key):
+            return _unknown_file_key(file_key)
         src = file_key or code
-        res = backend.generate_testbench(src, mode=mode)
+        res = backend.generate_testbench(src, mode=mode, module=request.data.get("module") or None)
         status_code = status.HTTP_200_OK if res.get("status") == "ok" else status.HTTP_400_BAD_REQUEST
         return Response(res, status=status_code)
 
@@ -463,8 +463,10 @@ class GenerateUVMView(APIView):
     def post(self, request, *args, **kwargs):
         file_key = request.data.get("file_key", "")
         code = request.data.get("code", "")
+        if file_key and not backend.has_source(file_key):
+            return _unknown_file_key(file_key)
         src = file_key or code
-        res = backend.generate_uvm_testbench(src)
+        res = backend.generate_uvm_testbench(src, module=request.data.get("module") or None)
         status_code = status.HTTP_200_OK if res.get("status") == "ok" else status.HTTP_400_BAD_REQUEST
         return Response(res, status=status_code)
 
@@ -472,6 +474,8 @@ class DesignReportView(APIView):
     def post(self, request, *args, **kwargs):
         file_key = request.data.get("file_key", "")
         code = request.data.get("code", "")
+        if file_key and not backend.has_source(file_key):
+            return _unknown_file_key(file_key)
         src = file_key or code
         res = backend.generate_design_report(src)
         return Response(res)
@@ -481,6 +485,8 @@ class CopyContentView(APIView):
         file_key = request.data.get("file_key", "")
         code = request.data.get("code", "")
         kind = request.data.get("kind", "code")  # 'code'|'explanation'|'testbench'
+        if file_key and not backend.has_source(file_key):
+            return _unknown_file_key(file_key)
         src = file_key or code
         res = backend.copy_content(src, kind=kind)
         status_code = status.HTTP_200_OK if res.get("status") in ("ok",) else status.HTTP_400_BAD_REQUEST
@@ -488,15 +494,102 @@ class CopyContentView(APIView):
 
 class ClearAllView(APIView):
     def delete(self, request, *args, **kwargs):
-        res = backend.clear_all()
+        res = backend.clear_all(session=_session_id(request))
+        status_code = status.HTTP_200_OK if res.get("status") == "ok" else status.HTTP_400_BAD_REQUEST
+        return Response(res, status=status_code)
+
+class DetectProtocolView(APIView):
+    def get(self, request, *args, **kwargs):
+        file_key = request.query_params.get("file_key")
+        if file_key and not backend.has_source(file_key):
+            return _unknown_file_key(file_key)
+        res = backend.detect_protocols(file_key, session=_session_id(request))
+        status_code = status.HTTP_200_OK if res.get("status") == "ok" else status.HTTP_404_NOT_FOUND
+        return Response(res, status=status_code)
+
+    def post(self, request, *args, **kwargs):
+        file_key = request.data.get("file_key", "")
+        if file_key and not backend.has_source(file_key):
+            return _unknown_file_key(file_key)
+        src = file_key or request.data.get("code", "")
+        res = backend.detect_protocols(src or None, session=_session_id(request))
+        status_code = status.HTTP_200_OK if res.get("status") == "ok" else status.HTTP_404_NOT_FOUND
+        return Response(res, status=status_code)
+
+class HierarchyView(APIView):
+    def get(self, request, *args, **kwargs):
+        file_key = request.query_params.get("file_key")
+        if file_key and not backend.has_source(file_key):
+            return _unknown_file_key(file_key)
+        res = backend.get_hierarchy(file_key, session=_session_id(request))
         return Response(res)
 
+class ModuleDetailView(APIView):
+    def post(self, request, *args, **kwargs):
+        module = request.data.get("module")
+        if not module:
+            return Response({"status": "error", "message": "module required"}, status=status.HTTP_400_BAD_REQUEST)
+        file_key = request.data.get("file_key")
+        if file_key and not backend.has_source(file_key):
+            return _unknown_file_key(file_key)
+        res = backend.get_module_detail(module, file_key, session=_session_id(request))
+        status_code = status.HTTP_200_OK if res.get("status") == "ok" else status.HTTP_404_NOT_FOUND
+        return Response(res, status=status_code)
+
+class ModuleGraphView(APIView):
+    def get(self, request, *args, **kwargs):
+        module = request.query_params.get("module")
+        if not module:
+            return Response({"status": "error", "message": "module required"}, status=status.HTTP_400_BAD_REQUEST)
+        file_key = request.query_params.get("file_key")
+        if file_key and not backend.has_source(file_key):
+            return _unknown_file_key(file_key)
+        res = backend.get_module_graph(module, file_key, session=_session_id(request))
+        status_code = status.HTTP_200_OK if res.get("status") == "ok" else status.HTTP_404_NOT_FOUND
+        return Response(res, status=status_code)
+
+class BatchAnalysisView(APIView):
+    def post(self, request, *args, **kwargs):
+        file_key = request.data.get("file_key", "")
+        code = request.data.get("code", "")
+        if file_key and not backend.has_source(file_key):
+            return _unknown_file_key(file_key)
+        src = file_key or code
+        artifacts = request.data.get("artifacts") or None
+        if isinstance(artifacts, str):
+            artifacts = [a.strip() for a in artifacts.split(",") if a.strip()]
+        mode = request.data.get("mode", "auto")
+        if str(request.data.get("stream", "")).lower() in ("1", "true", "yes"):
+            # one NDJSON line per artifact, flushed as soon as it is built
+            lines = (json.dumps({"artifact": name, **res}) + "\n" for name, res in backend.iter_batch(src, artifacts, mode))
+            return StreamingHttpResponse(lines, content_type="application/x-ndjson")
+        res = backend.analyze_batch(src, artifacts, mode)
+        status_code = status.HTTP_200_OK if res.get("status") != "error" else status.HTTP_400_BAD_REQUEST
+        return Response(res, status=status_code)
+
 class HighlightView(APIView):
     def post(self, request, *args, **kwargs):
         file_key = request.data.get("file_key", "")
         code = request.data.get("code", "")
+        if file_key and not backend.has_source(file_key):
+            return _unknown_file_key(file_key)
         src = file_key or code
-        res = backend.highlight_code(src)
+        start_line = request.data.get("start_line")
+        end_line = request.data.get("end_line")
+        fmt = request.data.get("format", "html")
+        if fmt in ("runs", "binary"):
+            res = backend.highlight_runs(src, start_line, end_line, binary=fmt == "binary")
+            if res.get("status") != "ok" or fmt == "runs":
+                return Response(res, status=status.HTTP_200_OK if res.get("status") == "ok" else status.HTTP_400_BAD_REQUEST)
+            response = HttpResponse(res["data"], content_type="application/octet-stream")
+            response["X-Highlight-Classes"] = ",".join(res["classes"])
+            response["X-Start-Line"] = str(res["start_line"])
+            response["X-Highlight-Dtype"] = res["dtype"]
+            return response
+        if str(request.data.get("stream", "")).lower() in ("1", "true", "yes"):
+            chunks = backend.iter_highlight_html(src, int(start_line or 1), int(end_line) if end_line else None)
+            return StreamingHttpResponse(chunks, content_type="text/html")
+        res = backend.highlight_code(src, start_line, end_line)
         return Response(res)
 
 class NextChunkView(APIView):
@@ -509,6 +602,18 @@ class NextChunkView(APIView):
         res = backend.apply_next_chunk(key, offset=offset, chunk_size=chunk_size)
         return Response(res)
 
+class LineRangeView(APIView):
+    def post(self, request, *args, **kwargs):
+        key = request.data.get("file_key")
+        if not key:
+            return Response({"status": "error", "message": "file_key required"}, status=status.HTTP_400_BAD_REQUEST)
+        start_line = int(request.data.get("start_line", 1))
+        end_line = int(request.data.get("end_line", start_line + 99))
+        highlight = str(request.data.get("highlight", "false")).lower() in ("1", "true", "yes")
+        res = backend.get_lines(key, start_line=start_line, end_line=end_line, highlight=highlight)
+        status_code = status.HTTP_200_OK if res.get("status") == "ok" else status.HTTP_404_NOT_FOUND
+        return Response(res, status=status_code)
+
 class AddChunkView(APIView):
     def post(self, request, *args, **kwargs):
         key = request.data.get("file_key")
@@ -534,7 +639,15 @@ class FindTextView(APIView):
         query = request.data.get("query")
         if not query:
             return Response({"status": "error", "message": "query required"}, status=status.HTTP_400_BAD_REQUEST)
+        if file_key and not backend.has_source(file_key):
+            return _unknown_file_key(file_key)
         src = file_key or code
         max_results = int(request.data.get("max_results", 50))
-        res = backend.find_text(src, query, max_results=max_results)
+        cursor = request.data.get("cursor")
+        file_keys = request.data.get("file_keys")
+        if file_keys or str(request.data.get("all_files", "false")).lower() in ("1", "true", "yes"):
+            res = backend.search_files(query, file_keys=file_keys or None, max_results=max_results, cursor=cursor,
+                                       session=_session_id(request))
+        else:
+            res = backend.find_text(src, query, max_results=max_results, cursor=cursor)
         return Response(res)
\ No newline at end of file
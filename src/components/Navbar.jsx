@@ -266,6 +266,7 @@ const Navbar = ({
       filtered.forEach((file) => {
         const blob = new Blob([file.content], { type: "text/plain" });
         formData.append("files", blob, file.path);
+        formData.append("paths", file.path);
       });
 
       await axios.post(`${baseUrl_1}/upload/folder/`, formData, {